@@ -0,0 +1,104 @@
+from django.conf import settings
+from collections import defaultdict
+from .models import Activity, Tester
+from .proxmox import ProxmoxConnector
+from .clusters import default_cluster
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Synchronization of the Proxmox ACLs granting the testers of each activity access to its pool.
+
+The desired state is one PROXMOX_TESTER_ROLE entry on /pool/{poolid} (propagated to the pool VMs) for every tester
+of the activity having a user on the cluster. It is compared with a single read of /access/acl; user entries of
+that role on the activity pools, or given to a tester on any pool, are managed, so the ones not desired any more
+are revoked. The differences are applied grouped by path, with up to PROXMOX_ACL_BATCH_SIZE users per
+PUT /access/acl call (PVE takes a single path per call). Running it again with nothing changed makes no call.
+"""
+
+
+def pool_path(poolid: str) -> str:
+    return "/pool/{poolid}".format(poolid=poolid)
+
+
+def tester_role() -> str:
+    return getattr(settings, "PROXMOX_TESTER_ROLE", "PVEVMUser")
+
+
+class AclPlan(object):
+
+    def __init__(self):
+        self.grants = defaultdict(set)
+        self.revokes = defaultdict(set)
+        self.missing_users = set()
+        self.missing_pools = set()
+
+    def __bool__(self):
+        return bool(self.grants or self.revokes)
+
+    def batches(self):
+        """(path, users, delete) for every call needed to apply the plan"""
+        size = getattr(settings, "PROXMOX_ACL_BATCH_SIZE", 50)
+        for changes, delete in ((self.revokes, True), (self.grants, False)):
+            for path, users in sorted(changes.items()):
+                users = sorted(users)
+                for start in range(0, len(users), size):
+                    yield path, users[start:start + size], delete
+
+
+def _activities(cluster: str):
+    default = default_cluster()
+    return [activity for activity in Activity.objects.prefetch_related("testers")
+            if (activity.cluster or default) == cluster]
+
+
+def plan(cluster: str = None, activities: list = None) -> AclPlan:
+    """
+    Grants and revokes needed on the cluster; when activities are given, only their pool paths are considered
+    """
+    cluster = cluster or default_cluster()
+    connector = ProxmoxConnector(cluster)
+    role = tester_role()
+    users = {user.get('userid') for user in connector.get_users()}
+    pools = {pool.get('poolid') for pool in connector.get_pools()}
+    scoped = activities is not None
+    activities = _activities(cluster) if activities is None else activities
+    result = AclPlan()
+    desired = defaultdict(set)
+    for activity in activities:
+        if activity.px_pool_id not in pools:
+            result.missing_pools.add(activity.px_pool_id)
+            continue
+        for tester in activity.testers.all():
+            if tester.px_userid in users:
+                desired[pool_path(activity.px_pool_id)].add(tester.px_userid)
+            else:
+                result.missing_users.add(tester.px_userid)
+    paths = {pool_path(activity.px_pool_id) for activity in activities}
+    testers = set() if scoped else {tester.px_userid for tester in Tester.objects.all()}
+    current = defaultdict(set)
+    for entry in connector.get_acl():
+        path = entry.get('path', '')
+        if entry.get('roleid') != role or entry.get('type') != 'user' or not path.startswith("/pool/"):
+            continue
+        if path in paths or entry.get('ugid') in testers:
+            current[path].add(entry.get('ugid'))
+    for path in set(desired) | set(current):
+        if desired[path] - current[path]:
+            result.grants[path] = desired[path] - current[path]
+        if current[path] - desired[path]:
+            result.revokes[path] = current[path] - desired[path]
+    return result
+
+
+def sync(cluster: str = None, activities: list = None) -> AclPlan:
+    """Compute and apply the plan, returns it"""
+    cluster = cluster or default_cluster()
+    result = plan(cluster, activities)
+    if result.missing_users:
+        logger.warning("Testers without a user on %s, not authorized: %s", cluster,
+                       ", ".join(sorted(result.missing_users)))
+    connector = ProxmoxConnector(cluster)
+    for path, users, delete in result.batches():
+        connector.update_acl(path=path, roles=[tester_role()], users=users, delete=delete)
+    return result
@@ -1,19 +1,62 @@
 from django.contrib import admin
 
 from django.contrib.auth.models import Group
-from django.forms import ModelForm, ModelChoiceField
+from django.forms import ModelForm, ModelChoiceField, ValidationError
+from django.urls import reverse
 from django_select2.forms import Select2Widget, HeavySelect2Widget
-from .models import Company, Tester, Activity, Network, VirtualMachine, TesterIpAddress
+from .models import Company, Tester, Activity, Network, VirtualMachine, TesterIpAddress, Job, WarmPoolMetric, SyncState
+from . import jobs
+from . import ipam
+from . import acl
+from .clusters import default_cluster
+from .scope import memoized
+from .reconciler import sync_states
 admin.site.site_header = admin.site.index_title = 'Pannello di gestione'
 admin.site.site_title = "Virtual Platform for Penetration Testing"
 admin.site.site_url = None
 
+
+def stored_sync_state(kind, obj):
+    """The state saved by the reconciler, loaded once per request for all the rows of a page"""
+    return memoized(("sync_states", None, kind), lambda: sync_states(kind)).get(obj.pk)
+
+
+def sync_status_column(kind):
+    def display(self, obj):
+        state = stored_sync_state(kind, obj)
+        return state.get_status_display() if state else "Non verificato"
+    display.short_description = "Stato Proxmox"
+    return display
+
 class NetworkInlineForm(ModelForm):
-    ip = ModelChoiceField(queryset=TesterIpAddress.objects.all(), empty_label="DHCP", required=False)
+    ip = ModelChoiceField(queryset=TesterIpAddress.objects.none(), empty_label="DHCP", required=False)
+    vm_object = None
     class Meta:
         model = VirtualMachine.network.through
         fields = ("net", "vm", 'ip',)
 
+    def __init__(self, *args, **kwargs):
+        """Only the free, valid addresses of the activity testers, plus the one already bound to this NIC"""
+        super(NetworkInlineForm, self).__init__(*args, **kwargs)
+        activity = self.vm_object.activity if self.vm_object else None
+        if activity:
+            manager = ipam.AddressManager.for_activity(activity)
+        else:
+            manager = ipam.AddressManager.build()
+        ids = [address.pk for address in manager.free_addresses()]
+        if self.instance.ip_id:
+            ids.append(self.instance.ip_id)
+        self.fields["ip"].queryset = TesterIpAddress.objects.filter(pk__in=ids).order_by("ip")
+
+    def clean(self):
+        cleaned_data = super(NetworkInlineForm, self).clean()
+        if cleaned_data.get("net") and cleaned_data.get("ip"):
+            try:
+                ipam.check_assignment(cleaned_data["net"], cleaned_data["ip"], self.instance)
+            except ipam.IPAMError as e:
+                raise ValidationError({"ip": str(e)})
+        return cleaned_data
+
 class NetworkInline(admin.StackedInline):
     model = VirtualMachine.network.through
     extra = 1
@@ -22,15 +65,45 @@ class NetworkInline(admin.StackedInline):
     def __init__(self, parent_model, admin_site):
         super(NetworkInline, self).__init__(parent_model, admin_site)
 
+    def get_formset(self, request, obj=None, **kwargs):
+        kwargs["form"] = type("NetworkInlineForm", (self.form,), {"vm_object": obj})
+        return super(NetworkInline, self).get_formset(request, obj, **kwargs)
+
 
 
 class VirtualMachineAdmin(admin.ModelAdmin):
-    fields = ("activity", "name", "os", "ram", "cpu", )
-    list_display = ("activity", "name", "os", "ram", "cpu", )
+    fields = ("activity", "name", "os", "ram", "cpu", "px_status")
+    readonly_fields = ("px_status",)
+    list_display = ("activity", "name", "os", "ram", "cpu", "px_status")
+    list_select_related = ("activity",)
     inlines = [NetworkInline]
+    PX_STATUSES = {
+        None: "Non creata",
+        "running": "Accesa",
+        "stopped": "Spenta",
+        "locked": "Bloccata",
+        "missing": "Mancante",
+    }
+
+    def px_status(self, obj):
+        """Read from the state stored by the reconciler, rendering the page makes no Proxmox call"""
+        state = stored_sync_state("virtualmachine", obj)
+        if state is None:
+            return "Non verificata"
+        if state.status == SyncState.PENDING:
+            return self.PX_STATUSES[None]
+        if state.status == SyncState.MISSING:
+            return self.PX_STATUSES["missing"]
+        status = "locked" if state.details.get("lock") else state.details.get("status")
+        label = self.PX_STATUSES.get(status, status)
+        if state.status == SyncState.DRIFTED:
+            label += " (diverge: {keys})".format(keys=", ".join(state.details.get("differences", [])))
+        return label
+    px_status.short_description = "Stato Proxmox"
 
     def has_change_permission(self, request, obj=None):
-        if obj and obj.px_has_vm_been_created():
+        state = stored_sync_state("virtualmachine", obj) if obj else None
+        if obj and (state.status in (SyncState.IN_SYNC, SyncState.DRIFTED) if state else obj.vmid):
             return False
         else:
             return super(VirtualMachineAdmin, self).has_change_permission(request, obj)
@@ -42,8 +115,9 @@ class IPAddressAdmin(admin.StackedInline):
 
 class TesterAdmin(admin.ModelAdmin):
     fields = ("tester_identifier", "name", "company", "user",)
-    list_display = ("tester_identifier", "name", "company", )
+    list_display = ("tester_identifier", "name", "company", "sync_status")
     inlines = [IPAddressAdmin]
+    sync_status = sync_status_column("tester")
 
 class VmInlineAdd(admin.TabularInline):
     fields = ("name", "os", "ram", "cpu",)
@@ -60,14 +134,44 @@ class VmInlineAdd(admin.TabularInline):
 
 
 class ActivityAdmin(admin.ModelAdmin):
-    fields = ("activity_identifier", "target_application_identifier", "target_application_name", "testers", )
-    list_display = ("activity_identifier", "target_application_identifier", "target_application_name")
+    fields = ("activity_identifier", "target_application_identifier", "target_application_name", "testers", "cluster", )
+    list_display = ("activity_identifier", "target_application_identifier", "target_application_name", "sync_status")
     inlines = [VmInlineAdd]
+    sync_status = sync_status_column("activity")
+    actions = ["provision_vms", "assign_addresses", "sync_authorizations", "teardown"]
+
+    def provision_vms(self, request, queryset):
+        for activity in queryset:
+            jobs.enqueue("provision_activity", activity=activity)
+        self.message_user(request, "Creazione VM accodata per {count} attività".format(count=queryset.count()))
+    provision_vms.short_description = "Crea le VM su Proxmox"
+
+    def assign_addresses(self, request, queryset):
+        count = sum(len(ipam.allocate_activity(activity)) for activity in queryset)
+        self.message_user(request, "Assegnati {count} indirizzi IP alle schede in DHCP".format(count=count))
+    assign_addresses.short_description = "Assegna gli indirizzi dei tester alle schede in DHCP"
+
+    def sync_authorizations(self, request, queryset):
+        by_cluster = {}
+        for activity in queryset.prefetch_related("testers"):
+            by_cluster.setdefault(activity.cluster or default_cluster(), []).append(activity)
+        changes = 0
+        for cluster, activities in by_cluster.items():
+            result = acl.sync(cluster, activities=activities)
+            changes += sum(len(users) for users in list(result.grants.values()) + list(result.revokes.values()))
+        self.message_user(request, "Autorizzazioni sincronizzate, {count} modifiche".format(count=changes))
+    sync_authorizations.short_description = "Sincronizza le autorizzazioni dei tester sui pool"
+
+    def teardown(self, request, queryset):
+        for activity in queryset:
+            jobs.enqueue("teardown_activity", activity=activity)
+        self.message_user(request, "Smantellamento accodato per {count} attività".format(count=queryset.count()))
+    teardown.short_description = "Distruggi le VM e il pool su Proxmox"
 
 class NetworkAdminForm(ModelForm):
     class Meta:
         model = Network
-        fields = ("network_description", "bridge_name",)
+        fields = ("network_description", "bridge_name", "subnet", "cidr",)
         widgets = {
             "bridge_name": HeavySelect2Widget(data_view="pxe_networks", attrs={
                 'data-placeholder': 'Reti disponibili',
@@ -75,13 +179,79 @@ class NetworkAdminForm(ModelForm):
             })
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            # keep offering the bridge of the network being edited
+            self.fields["bridge_name"].widget.data_url = "{url}?network={pk}".format(url=reverse("pxe_networks"),
+                                                                                     pk=self.instance.pk)
+
 class NetworkAdmin(admin.ModelAdmin):
-    fields = ("network_description", "bridge_name",)
-    list_display = ("network_description", "bridge_name",)
+    fields = ("network_description", "bridge_name", "subnet", "cidr",)
+    list_display = ("network_description", "bridge_name", "subnet", "cidr", "free_addresses")
     form = NetworkAdminForm
 
+    def free_addresses(self, obj):
+        """The address index is built once per request, see orchestrator.scope"""
+        return len(memoized(("ipam", None), ipam.AddressManager.build).free_addresses(obj))
+    free_addresses.short_description = "Indirizzi liberi"
+
 class TesterIpAddressAdmin(admin.ModelAdmin):
     list_display = fields = ("ip", "cidr", "gateway" ,"tester")
+    list_select_related = ("tester",)
+
+    def get_list_display(self, request):
+        return self.list_display + ("conflict",)
+
+    def conflict(self, obj):
+        count = memoized(("ipam_duplicates", None), ipam.duplicated_addresses).get(obj.ip)
+        return "Usato da {count} tester".format(count=count) if count else ""
+    conflict.short_description = "Conflitti"
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("__str__", "activity", "status", "attempts", "created_at", "started_at", "finished_at")
+    list_filter = ("status", "kind")
+    list_select_related = ("activity",)
+    readonly_fields = ("kind", "activity", "status", "progress", "attempts", "max_attempts", "error", "run_after",
+                       "created_at", "started_at", "finished_at", "lease_expires_at")
+    actions = ["retry_jobs"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry_jobs(self, request, queryset):
+        for job in queryset:
+            jobs.retry(job)
+    retry_jobs.short_description = "Riprova"
+
+class WarmPoolMetricAdmin(admin.ModelAdmin):
+    list_display = ("os", "ready", "hits", "misses", "hit_rate_display", "refills", "last_refill_lag",
+                    "depleted_since")
+    readonly_fields = list_display
+
+    def has_add_permission(self, request):
+        return False
+
+    def ready(self, obj):
+        """The inventories of all the clusters are fetched in parallel, once per request"""
+        from .warmpool import available_in
+        from .inventory import inventory
+        snapshots = memoized(("inventory_snapshots", None), inventory.snapshots)
+        return sum(len(available_in(snapshot, obj.os)) for snapshot in snapshots.values()
+                   if not isinstance(snapshot, Exception))
+    ready.short_description = "VM pronte"
+
+    def hit_rate_display(self, obj):
+        return "-" if obj.hit_rate is None else "{:.0%}".format(obj.hit_rate)
+    hit_rate_display.short_description = "Hit rate"
+
+class SyncStateAdmin(admin.ModelAdmin):
+    list_display = ("kind", "object_id", "cluster", "status", "changed_at", "checked_at")
+    list_filter = ("kind", "status", "cluster")
+    readonly_fields = ("kind", "object_id", "cluster", "status", "detail", "input_hash", "changed_at", "checked_at")
+
+    def has_add_permission(self, request):
+        return False
 
 admin.site.unregister(Group)
 admin.site.register(Company)
@@ -89,4 +259,7 @@ admin.site.register(Tester, TesterAdmin)
 admin.site.register(Activity, ActivityAdmin)
 admin.site.register(Network, NetworkAdmin)
 admin.site.register(VirtualMachine, VirtualMachineAdmin)
-admin.site.register(TesterIpAddress, TesterIpAddressAdmin)
\ No newline at end of file
+admin.site.register(TesterIpAddress, TesterIpAddressAdmin)
+admin.site.register(Job, JobAdmin)
+admin.site.register(WarmPoolMetric, WarmPoolMetricAdmin)
+admin.site.register(SyncState, SyncStateAdmin)
\ No newline at end of file
@@ -0,0 +1,115 @@
+from django.conf import settings
+from contextlib import contextmanager
+from contextvars import ContextVar
+from .limits import KeyedSemaphore, TokenBucket
+from .metrics import endpoint
+import asyncio
+import threading
+import re
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Admission control for the requests sent to the Proxmox API.
+
+Every request waits for a token of its cluster bucket (PROXMOX_RATE_LIMIT requests per second, PROXMOX_RATE_BURST
+at once), then for a slot of its node: heavy operations (clone, migrate, delete, ...) share
+PROXMOX_MAX_HEAVY_CALLS_PER_NODE slots, light calls get PROXMOX_MAX_LIGHT_CALLS_PER_NODE slots per lane. Calls
+outside /nodes/ count against the "cluster" node.
+
+Requests belong to the bulk lane unless they are made while serving a web request (InteractiveLaneMiddleware) or
+inside interactive_lane(). Bulk requests leave PROXMOX_RATE_INTERACTIVE_RESERVE tokens of the bucket to the
+interactive lane and have their own light slots, so admin pages never queue behind a provisioning run.
+"""
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+HEAVY_ENDPOINTS = (
+    "POST /nodes/{node}/qemu/{vmid}/clone",
+    "POST /nodes/{node}/qemu/{vmid}/migrate",
+    "POST /nodes/{node}/qemu/{vmid}/template",
+    "POST /nodes/{node}/qemu/{vmid}/move_disk",
+    "PUT /nodes/{node}/qemu/{vmid}/resize",
+    "DELETE /nodes/{node}/qemu/{vmid}",
+    "POST /nodes/{node}/storage/{storage}/upload",
+)
+
+NODE_PATTERN = re.compile(r"/nodes/([^/]+)")
+
+_lane = ContextVar("proxmox_lane", default=BULK)
+
+heavy_slots_per_node = KeyedSemaphore("PROXMOX_MAX_HEAVY_CALLS_PER_NODE", 2)
+light_slots_per_node = KeyedSemaphore("PROXMOX_MAX_LIGHT_CALLS_PER_NODE", 4)
+
+
+def current_lane() -> str:
+    return _lane.get()
+
+
+@contextmanager
+def interactive_lane():
+    token = _lane.set(INTERACTIVE)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def is_heavy(method: str, url: str) -> bool:
+    return endpoint(method, url) in getattr(settings, "PROXMOX_HEAVY_ENDPOINTS", HEAVY_ENDPOINTS)
+
+
+def node_of(url: str) -> str:
+    match = NODE_PATTERN.search(url)
+    return match.group(1) if match else "cluster"
+
+
+def _floor(lane: str) -> int:
+    return 0 if lane == INTERACTIVE else getattr(settings, "PROXMOX_RATE_INTERACTIVE_RESERVE", 5)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket_for(cluster: str) -> TokenBucket:
+    with _buckets_lock:
+        if cluster not in _buckets:
+            _buckets[cluster] = TokenBucket(getattr(settings, "PROXMOX_RATE_LIMIT", 20),
+                                            getattr(settings, "PROXMOX_RATE_BURST", 40))
+        return _buckets[cluster]
+
+
+@contextmanager
+def admitted(cluster: str, method: str, url: str):
+    """Hold a token and a node slot for the duration of one request"""
+    lane = current_lane()
+    bucket_for(cluster).take(_floor(lane))
+    node = node_of(url)
+    if is_heavy(method, url):
+        slot = heavy_slots_per_node((cluster, node))
+    else:
+        slot = light_slots_per_node((cluster, node, lane))
+    with slot:
+        yield
+
+
+async def admitted_async(cluster: str):
+    """Token bucket only: the asyncio client bounds its concurrency with its own semaphore"""
+    floor = _floor(current_lane())
+    wait = bucket_for(cluster).try_take(floor)
+    while wait:
+        await asyncio.sleep(wait)
+        wait = bucket_for(cluster).try_take(floor)
+
+
+def admit_session(session, cluster: str):
+    """Route every request of the (proxmoxer) requests session through admitted()"""
+    request = session.request
+
+    def admitted_request(method, url, *args, **kwargs):
+        with admitted(cluster, method, url):
+            return request(method, url, *args, **kwargs)
+    session.request = admitted_request
+    return session
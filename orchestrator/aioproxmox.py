@@ -0,0 +1,247 @@
+from django.conf import settings
+from .clusters import cluster_settings, default_cluster
+from .proxmox import ProxmoxNotConnectedException, ProxmoxTransientError, ProxmoxLockedError, \
+    ProxmoxPermanentError, default_node
+from .admission import admitted_async, node_of
+from .resilience import breaker_for, classify, retry_delay, LOCKED, TRANSIENT
+from .metrics import instrumented_async, observe_async_request, error_class
+import asyncio
+import contextvars
+import threading
+import time
+import aiohttp
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Asyncio Proxmox client for fanning out many calls at once (configs of a whole pool, bulk config updates...).
+
+Clients live on a single background event loop; Django views and taskflow tasks use them through the blocking
+run() and gather() helpers. Each client keeps an HTTP/1.1 keep-alive pool whose size and concurrency are bounded by
+PROXMOX_ASYNC_MAX_CONNECTIONS.
+"""
+
+
+class AsyncProxmoxClient(object):
+
+    def __init__(self, cluster: str = None):
+        self.cluster_name = cluster or default_cluster()
+        config = cluster_settings(self.cluster_name)
+        self.config = config
+        self.base_url = "https://{host}:{port}/api2/json".format(host=config["URL"], port=config["PORT"])
+        self._session = None
+        self._login_lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(getattr(settings, "PROXMOX_ASYNC_MAX_CONNECTIONS", 20))
+
+    async def _login(self):
+        async with self._login_lock:
+            if self._session is not None:
+                return self._session
+            connector = aiohttp.TCPConnector(limit=getattr(settings, "PROXMOX_ASYNC_MAX_CONNECTIONS", 20),
+                                             ssl=None if self.config["VERIFY_SSL"] else False,
+                                             keepalive_timeout=60)
+            session = aiohttp.ClientSession(connector=connector,
+                                            timeout=aiohttp.ClientTimeout(total=getattr(settings,
+                                                                                        "PROXMOX_ASYNC_TIMEOUT", 30)))
+            try:
+                async with session.post(self.base_url + "/access/ticket",
+                                        data={"username": self.config["USER"], "password": self.config["PWD"]}) \
+                        as response:
+                    response.raise_for_status()
+                    data = (await response.json())["data"]
+            except Exception:
+                await session.close()
+                raise
+            session.cookie_jar.update_cookies({"PVEAuthCookie": data["ticket"]})
+            session.headers["CSRFPreventionToken"] = data["CSRFPreventionToken"]
+            self._session = session
+            return session
+
+    async def _expire(self, session):
+        """Forget a session whose ticket was refused; requests still using it get a grace period to complete"""
+        async with self._login_lock:
+            if self._session is session:
+                self._session = None
+                asyncio.get_event_loop().call_later(60, lambda: asyncio.ensure_future(session.close()))
+
+    async def _send(self, method: str, path: str, params: dict = None, data: dict = None):
+        # PVE tickets expire after two hours: on a 401 the client logs in again and sends the request once more
+        for attempt in range(2):
+            session = self._session or await self._login()
+            await admitted_async(self.cluster_name)
+            started = time.perf_counter()
+            error = None
+            try:
+                async with self._semaphore:
+                    async with session.request(method, self.base_url + path, params=params, data=data) as response:
+                        if response.status >= 400:
+                            error = "HTTP{status}".format(status=response.status)
+                        if response.status != 401 or attempt:
+                            if response.status >= 400:
+                                message = "{method} {path}: {status} {reason}".format(method=method, path=path,
+                                                                                      status=response.status,
+                                                                                      reason=response.reason)
+                                kind = classify(response.status, response.reason)
+                                if kind == LOCKED:
+                                    raise ProxmoxLockedError(message)
+                                if kind == TRANSIENT:
+                                    raise ProxmoxTransientError(message)
+                                raise ProxmoxPermanentError(message)
+                            return (await response.json()).get("data")
+            except Exception as e:
+                error = error or error_class(e)
+                raise
+            finally:
+                observe_async_request(self.cluster_name, method, self.base_url + path,
+                                      time.perf_counter() - started, error)
+            await self._expire(session)
+
+    async def request(self, method: str, path: str, params: dict = None, data: dict = None):
+        """Same retry policy and circuit breakers as the connector, see orchestrator.resilience"""
+        node = node_of(path)
+        breaker = breaker_for(self.cluster_name, node)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise ProxmoxNotConnectedException("Node {node} of {cluster} is failing, requests suspended".format(
+                    node=node, cluster=self.cluster_name))
+            try:
+                result = await self._send(method, path, params=params, data=data)
+                breaker.success()
+                return result
+            except ProxmoxTransientError as e:
+                if isinstance(e, ProxmoxLockedError):
+                    breaker.success()
+                else:
+                    breaker.failure()
+                delay = retry_delay(LOCKED if isinstance(e, ProxmoxLockedError) else TRANSIENT, method, attempt,
+                                    executed=" 595 " not in str(e))
+                if delay is None:
+                    raise
+                failure = e
+            except ProxmoxPermanentError:
+                breaker.success()
+                raise
+            except aiohttp.ClientSSLError:
+                breaker.release()
+                raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                breaker.failure()
+                delay = retry_delay(TRANSIENT, method, attempt,
+                                    executed=not isinstance(e, aiohttp.ClientConnectorError))
+                if delay is None:
+                    raise ProxmoxNotConnectedException from e
+                failure = e
+            except BaseException:
+                breaker.release()
+                raise
+            logger.warning("%s %s failed (%s), retrying in %.2fs", method, path, failure, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _node(self, node: str = None) -> str:
+        return default_node(node, self.cluster_name)
+
+    @instrumented_async
+    async def get_vm(self, vmid, node: str = None):
+        return await self.request("GET", "/nodes/{node}/qemu/{vmid}/status/current".format(node=self._node(node),
+                                                                                              vmid=vmid))
+
+    @instrumented_async
+    async def get_vm_config(self, vmid, node: str = None):
+        return await self.request("GET", "/nodes/{node}/qemu/{vmid}/config".format(node=self._node(node), vmid=vmid))
+
+    @instrumented_async
+    async def update_vm_config(self, vmid, node: str = None, **changes):
+        return await self.request("POST", "/nodes/{node}/qemu/{vmid}/config".format(node=self._node(node),
+                                                                                       vmid=vmid), data=changes)
+
+    @instrumented_async
+    async def clone_vm(self, name, template, node: str = None, pool: str = None, target: str = None):
+        """Returns (new vmid, UPID of the clone task)"""
+        node = self._node(node)
+        newid = await self.request("GET", "/cluster/nextid")
+        data = {"newid": newid, "name": name}
+        if pool:
+            data["pool"] = pool
+        if target and target != node:
+            data["target"] = target
+        upid = await self.request("POST", "/nodes/{node}/qemu/{template}/clone".format(node=node, template=template),
+                                  data=data)
+        return newid, upid
+
+    @instrumented_async
+    async def get_pools(self):
+        return await self.request("GET", "/pools")
+
+    @instrumented_async
+    async def get_resource_pool(self, poolid: str):
+        return await self.request("GET", "/pools/{poolid}".format(poolid=poolid))
+
+    @instrumented_async
+    async def get_interfaces_list(self, node: str = None, type: str = 'bridge'):
+        return await self.request("GET", "/nodes/{node}/network".format(node=self._node(node)), params={"type": type})
+
+    @instrumented_async
+    async def get_cluster_resources(self):
+        return await self.request("GET", "/cluster/resources")
+
+    @instrumented_async
+    async def get_sdn_vnets(self):
+        return await self.request("GET", "/cluster/sdn/vnets")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class SyncBridge(object):
+    """Runs coroutines on a private event loop thread and blocks the caller until they are done"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._clients = {}
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="proxmox-asyncio", daemon=True).start()
+            return self._loop
+
+    def client(self, cluster: str = None) -> AsyncProxmoxClient:
+        cluster = cluster or default_cluster()
+        loop = self._ensure_loop()
+        with self._lock:
+            if cluster not in self._clients:
+                # asyncio primitives must be created on the loop that will use them
+                self._clients[cluster] = asyncio.run_coroutine_threadsafe(self._create(cluster), loop).result()
+            return self._clients[cluster]
+
+    @staticmethod
+    async def _create(cluster: str) -> AsyncProxmoxClient:
+        return AsyncProxmoxClient(cluster)
+
+    def run(self, coroutine):
+        # the task is created in a copy of the caller's context, so the admission lane (and any other ContextVar)
+        # follows the call to the loop thread; tasks started by the coroutine inherit it
+        return contextvars.copy_context().run(asyncio.run_coroutine_threadsafe, coroutine,
+                                              self._ensure_loop()).result()
+
+    def gather(self, coroutines, return_exceptions: bool = False) -> list:
+        async def _gather():
+            return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+        return self.run(_gather())
+
+
+bridge = SyncBridge()
+
+
+def fetch_vm_configs(vms, cluster: str = None) -> dict:
+    """(node, vmid) pairs -> {vmid: config or raised exception}, fetched concurrently"""
+    vms = list(vms)
+    client = bridge.client(cluster)
+    configs = bridge.gather([client.get_vm_config(vmid, node=node) for node, vmid in vms], return_exceptions=True)
+    return {str(vmid): config for (node, vmid), config in zip(vms, configs)}
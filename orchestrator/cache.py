@@ -0,0 +1,132 @@
+from django.conf import settings
+from django.core.cache import cache
+from .metrics import observe_cache
+import threading
+import time
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Read-through cache for Proxmox reads.
+
+Entries are stored as (value, loaded_at). A fresh entry is served as is, a stale one is served while a single
+background thread reloads it (stale-while-revalidate), a missing one is loaded synchronously.
+Keys are grouped in families (vm, vms, pools, ...) so that a mutating call can drop a single key or a whole family,
+and every family lives in the namespace of its cluster.
+While the event watcher of a cluster is alive (orchestrator.events) its families are invalidated as soon as the
+cluster changes, and freshness is judged against the longer WATCHED_TTLS; it is judged at read time, so entries
+fall back to the short TTLs as soon as the watcher stops. Pool, user and ACL edits produce no task, so those
+families keep their short TTLs.
+"""
+
+DEFAULT_TTLS = {
+    'vms': 10,
+    'vm': 10,
+    'vm_config': 10,
+    'interfaces': 20,
+    'pools': 30,
+    'pool': 30,
+    'users': 60,
+    'acl': 30,
+    'network_index': 300,
+}
+
+WATCHED_TTLS = {
+    'vms': 600,
+    'vm': 600,
+    'vm_config': 600,
+    'interfaces': 1800,
+    'network_index': 1800,
+}
+
+DEFAULT_NAMESPACE = "default"
+DEFAULT_TTL = 10
+DEFAULT_STALE_TTL = 60
+REFRESH_LOCK_TTL = 30
+
+
+_watched_until = {}
+
+
+def mark_watched(namespace: str, until: float):
+    """Called by the event watcher of the namespace after each successful poll"""
+    _watched_until[namespace] = until
+
+
+def is_watched(namespace: str = DEFAULT_NAMESPACE) -> bool:
+    return _watched_until.get(namespace, 0) > time.time()
+
+
+def get_ttl(family: str, namespace: str = DEFAULT_NAMESPACE) -> int:
+    if is_watched(namespace):
+        ttl = getattr(settings, "PROXMOX_WATCHED_CACHE_TTLS", {}).get(family, WATCHED_TTLS.get(family))
+        if ttl is not None:
+            return ttl
+    return getattr(settings, "PROXMOX_CACHE_TTLS", {}).get(family, DEFAULT_TTLS.get(family, DEFAULT_TTL))
+
+
+def get_stale_ttl() -> int:
+    return getattr(settings, "PROXMOX_CACHE_STALE_TTL", DEFAULT_STALE_TTL)
+
+
+def _version_key(family: str, namespace: str) -> str:
+    return "px_{namespace}_family_{family}".format(namespace=namespace, family=family)
+
+
+def family_version(family: str, namespace: str = DEFAULT_NAMESPACE) -> int:
+    version_key = _version_key(family, namespace)
+    cache.add(version_key, 1, None)
+    return cache.get(version_key, 1)
+
+
+def cache_key(family: str, *parts, namespace: str = DEFAULT_NAMESPACE) -> str:
+    return "px_{namespace}_{family}_v{version}_{parts}".format(
+        namespace=namespace, family=family, version=family_version(family, namespace),
+        parts="_".join(str(part) for part in parts))
+
+
+def _load(key: str, loader, ttl: int):
+    try:
+        value = loader()
+        cache.set(key, (value, time.time()), ttl + get_stale_ttl())
+        return value
+    finally:
+        cache.delete(key + "_refreshing")
+
+
+def _background_load(key: str, loader, ttl: int):
+    try:
+        _load(key, loader, ttl)
+    except Exception:
+        logger.exception("Background refresh of %s failed, serving stale data", key)
+
+
+def read_through(family: str, *parts, loader=None, ttl: int = None, namespace: str = DEFAULT_NAMESPACE):
+    """Return the cached value for (family, parts), calling loader() only on a miss or a stale entry."""
+    key = cache_key(family, *parts, namespace=namespace)
+    ttl = get_ttl(family, namespace) if ttl is None else ttl
+    entry = cache.get(key)
+    if entry is None:
+        observe_cache("cache", namespace, family, "miss")
+        return _load(key, loader, ttl)
+    value, loaded_at = entry
+    if time.time() >= loaded_at + ttl:
+        observe_cache("cache", namespace, family, "stale")
+        if cache.add(key + "_refreshing", True, REFRESH_LOCK_TTL):
+            threading.Thread(target=_background_load, args=(key, loader, ttl), daemon=True).start()
+    else:
+        observe_cache("cache", namespace, family, "hit")
+    return value
+
+
+def invalidate(family: str, *parts, namespace: str = DEFAULT_NAMESPACE):
+    """Drop a single entry, or the whole family when no parts are given."""
+    if parts:
+        cache.delete(cache_key(family, *parts, namespace=namespace))
+    else:
+        version_key = _version_key(family, namespace)
+        cache.add(version_key, 1, None)
+        try:
+            cache.incr(version_key)
+        except ValueError:
+            cache.set(version_key, 2, None)
@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.db.models import Prefetch
+from django.template import Context, Engine
+from ..models import Activity, VirtualMachine, VMNet
+from ..proxmox import ProxmoxConnector, ProxmoxDriverException
+from ..aioproxmox import fetch_vm_configs
+from ..vmconfig import parse_net
+from .media import content_hash
+import threading
+import yaml
+import os
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Rendering of the cloud-init documents from VirtualMachine, VMNet and TesterIpAddress.
+
+The templates (templates/cloudinit, or PROXMOX_CLOUDINIT_TEMPLATES_DIR) are compiled once per process by a
+dedicated engine without autoescaping. NICs are matched to the netN entries of the VM config by bridge, like
+ConfigureVM does, to get their MAC addresses. publish() skips the VMs whose documents hash to the value stored on
+the VM since the last upload.
+"""
+
+DOCUMENTS = ("meta-data", "user-data", "network-config")
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def engine() -> Engine:
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = Engine(
+                dirs=[getattr(settings, "PROXMOX_CLOUDINIT_TEMPLATES_DIR",
+                              os.path.join(settings.BASE_DIR, "templates", "cloudinit"))],
+                loaders=[("django.template.loaders.cached.Loader", ["django.template.loaders.filesystem.Loader"])],
+                autoescape=False)
+        return _engine
+
+
+def templates() -> dict:
+    return {name: engine().get_template(name) for name in DOCUMENTS}
+
+
+def nics_of(vm: VirtualMachine, config: dict) -> list:
+    nets = {key: parse_net(value) for key, value in config.items() if key.startswith("net") and key[3:].isdigit()}
+    nics = {}
+    for vmnet in vm.vmnet_set.all():
+        for key in sorted(nets, key=lambda key: int(key[3:])):
+            if nets[key].get("bridge") == vmnet.net.bridge_name:
+                nics.setdefault(int(key[3:]), {"index": int(key[3:]), "mac_address": nets[key].get("macaddr"),
+                                               "bridge": vmnet.net.bridge_name, "ip": vmnet.ip})
+                break
+    return [nics[index] for index in sorted(nics)]
+
+
+def user_data(vm: VirtualMachine, testers: list) -> str:
+    """The #cloud-config body, dumped by PyYAML so that names and identifiers are quoted as needed"""
+    # hostname is a SafeText, which the safe dumper refuses to represent (str() keeps the subclass)
+    document = {"hostname": str.__str__(vm.hostname), "manage_etc_hosts": True}
+    if testers:
+        document["users"] = ["default"] + [{"name": tester.tester_identifier.lower(), "gecos": tester.name,
+                                            "lock_passwd": True, "groups": ["sudo"]} for tester in testers]
+    return yaml.safe_dump(document, default_flow_style=False, sort_keys=False, allow_unicode=True)
+
+
+def render(vm: VirtualMachine, config: dict, testers: list, compiled: dict = None) -> dict:
+    context = Context({"vm": vm, "nics": nics_of(vm, config), "testers": testers,
+                       "user_data": user_data(vm, testers)})
+    return {name: template.render(context).replace("\r\n", "\n")
+            for name, template in (compiled or templates()).items()}
+
+
+def _vms(queryset):
+    return queryset.filter(vmid__isnull=False).prefetch_related(
+        Prefetch("vmnet_set", queryset=VMNet.objects.select_related("net", "ip").order_by("pk")))
+
+
+def render_vm(vm: VirtualMachine) -> dict:
+    vm = _vms(VirtualMachine.objects.filter(pk=vm.pk)).select_related("activity").get()
+    config = ProxmoxConnector(vm.px_cluster).get_vm_config(vm.vmid, node=vm.node)
+    testers = list(vm.activity.testers.all()) if vm.activity else []
+    return render(vm, config, testers)
+
+
+def render_activity(activity: Activity) -> dict:
+    """VirtualMachine -> documents for every created VM of the activity, the VM configs are read concurrently"""
+    vms = list(_vms(activity.vms.all()))
+    testers = list(activity.testers.all())
+    configs = fetch_vm_configs([(vm.node, vm.vmid) for vm in vms], activity.cluster)
+    compiled = templates()
+    rendered = {}
+    for vm in vms:
+        config = configs[str(vm.vmid)]
+        if isinstance(config, Exception):
+            logger.warning("Could not read the config of VM %s, cloud-init skipped: %s", vm.vmid, config)
+            continue
+        rendered[vm] = render(vm, config, testers, compiled)
+    return rendered
+
+
+def publish(vm: VirtualMachine, documents: dict, force: bool = False) -> bool:
+    """Upload and attach the documents unless they are unchanged since the last upload"""
+    digest = content_hash(documents)
+    if not force and vm.cloudinit_hash == digest:
+        return False
+    ProxmoxConnector(vm.px_cluster).cloudinit_prepare(vmid=vm.vmid, documents=documents, node=vm.node)
+    vm.cloudinit_hash = digest
+    vm.save(update_fields=["cloudinit_hash"])
+    return True
+
+
+def prepare_activity(activity: Activity, force: bool = False) -> dict:
+    """VirtualMachine pk -> True (uploaded), False (unchanged) or the raised exception"""
+    results = {}
+    for vm, documents in render_activity(activity).items():
+        try:
+            results[vm.pk] = publish(vm, documents, force=force)
+        except ProxmoxDriverException as e:
+            logger.error("Cloud-init upload for VM %s failed: %s", vm.vmid, e)
+            results[vm.pk] = e
+    return results
@@ -0,0 +1,47 @@
+import pycdlib
+import hashlib
+import json
+import io
+import os
+
+"""
+Packaging of rendered cloud-init documents (meta-data, user-data, network-config).
+
+build_iso() writes a NoCloud seed image (volume label "cidata") to a file object, in memory unless one is given, so
+that it can be sent to the storage upload endpoint as is. write_snippets() writes the documents into a snippets
+directory (a shared storage mounted on the orchestrator host) to be referenced through cicustom.
+"""
+
+CICUSTOM_KINDS = {"meta-data": "meta", "user-data": "user", "network-config": "network"}
+
+
+def content_hash(documents: dict) -> str:
+    return hashlib.sha256(json.dumps(documents, sort_keys=True).encode()).hexdigest()
+
+
+def build_iso(documents: dict, filename: str, fileobj=None):
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=3, joliet=3, rock_ridge="1.09", vol_ident="cidata")
+    for name, content in sorted(documents.items()):
+        data = content.encode()
+        iso.add_fp(io.BytesIO(data), len(data), "/{name}.;1".format(name=name.upper().replace("-", "_")),
+                   rr_name=name, joliet_path="/" + name)
+    fileobj = fileobj or io.BytesIO()
+    iso.write_fp(fileobj)
+    iso.close()
+    fileobj.seek(0)
+    fileobj.name = filename
+    return fileobj
+
+
+def write_snippets(documents: dict, directory: str, prefix: str) -> dict:
+    """cicustom kind -> file name, each file replaced atomically"""
+    files = {}
+    for name, content in documents.items():
+        filename = "{prefix}-{name}.yaml".format(prefix=prefix, name=name)
+        path = os.path.join(directory, filename)
+        with open(path + ".part", "w") as snippet:
+            snippet.write(content)
+        os.replace(path + ".part", path)
+        files[CICUSTOM_KINDS[name]] = filename
+    return files
@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from concurrent.futures import ThreadPoolExecutor
+from .cache import DEFAULT_NAMESPACE
+
+"""
+Proxmox clusters known to the orchestrator.
+
+PROXMOX_CLUSTERS maps a cluster name to its connection settings (URL, USER, PWD, VERIFY_SSL, PORT, NODE_NAME).
+When it is not set, a single "default" cluster is built from the legacy PROXMOX_* settings.
+"""
+
+DEFAULT_CLUSTER = DEFAULT_NAMESPACE
+
+
+def _legacy_cluster() -> dict:
+    return {
+        "URL": settings.PROXMOX_URL,
+        "USER": settings.PROXMOX_USER,
+        "PWD": settings.PROXMOX_PWD,
+        "VERIFY_SSL": settings.PROXMOX_VERIFY_SSL,
+        "PORT": getattr(settings, "PROXMOX_PORT", 8006),
+        "NODE_NAME": settings.PROXMOX_NODE_NAME,
+    }
+
+
+def all_clusters() -> dict:
+    return getattr(settings, "PROXMOX_CLUSTERS", None) or {DEFAULT_CLUSTER: _legacy_cluster()}
+
+
+def cluster_names() -> list:
+    return list(all_clusters())
+
+
+def default_cluster() -> str:
+    return getattr(settings, "PROXMOX_DEFAULT_CLUSTER", None) or cluster_names()[0]
+
+
+def validate_cluster(value: str):
+    """Model field validator: the cluster must be one of PROXMOX_CLUSTERS, read when the value is validated"""
+    if value and value not in all_clusters():
+        raise ValidationError("Cluster %(value)s sconosciuto, quelli configurati sono: %(clusters)s",
+                              params={"value": value, "clusters": ", ".join(cluster_names())})
+
+
+def cluster_settings(cluster: str = None) -> dict:
+    config = {"PORT": 8006, "VERIFY_SSL": True, "NODE_NAME": getattr(settings, "PROXMOX_NODE_NAME", None)}
+    config.update(all_clusters()[cluster or default_cluster()])
+    return config
+
+
+def fan_out(func, clusters: list = None) -> dict:
+    """Call func(cluster) for every cluster in parallel, returns cluster -> result (or the raised exception)"""
+    clusters = clusters or cluster_names()
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(clusters)) as executor:
+        futures = {cluster: executor.submit(func, cluster) for cluster in clusters}
+        for cluster, future in futures.items():
+            results[cluster] = future.exception() or future.result()
+    return results
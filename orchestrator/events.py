@@ -0,0 +1,137 @@
+from django.conf import settings
+from .cache import invalidate, mark_watched, WATCHED_TTLS
+from .proxmox import ProxmoxConnector
+from .clusters import default_cluster
+import threading
+import time
+import re
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Event driven invalidation of the Proxmox caches.
+
+One watcher thread per cluster tails /cluster/tasks and /cluster/log: each finished task, and each "end task" or
+"update VM" line of the cluster log, is mapped to the cache entries and inventory it may have changed, which are
+dropped at once. Entries already seen are remembered for PROXMOX_EVENT_WINDOW seconds, so every event is handled
+once even when it shows up late from another node. After every successful poll the cluster is marked as watched,
+letting orchestrator.cache and orchestrator.inventory keep their data much longer.
+"""
+
+UPID_PATTERN = re.compile(r"UPID:[^\s:]+:[0-9A-F]+:[0-9A-F]+:[0-9A-F]+:[^\s:]*:[^\s:]*:[^\s:]*:")
+UPDATE_VM_PATTERN = re.compile(r"update VM (\d+)")
+
+VM_STATE_TASKS = ("qmstart", "qmstop", "qmshutdown", "qmreboot", "qmreset", "qmsuspend", "qmresume", "qmpause")
+VM_CONFIG_TASKS = ("qmconfig", "qmmove", "qmresize", "qmtemplate", "qmsnapshot", "qmrollback", "qmdelsnapshot")
+VM_CREATE_TASKS = ("qmclone", "qmcreate", "qmrestore")
+NETWORK_SERVICES = ("networking",)
+
+
+def parse_upid(upid: str) -> dict:
+    # UPID:{node}:{pid}:{pstart}:{starttime}:{type}:{id}:{user}:
+    parts = upid.split(":")
+    return {"upid": upid, "node": parts[1], "type": parts[5], "id": parts[6], "user": parts[7]}
+
+
+def invalidations(kind: str, node: str, vmid: str = None) -> list:
+    """(family, *parts) entries that a finished task of this kind may have made stale"""
+    if kind in VM_STATE_TASKS:
+        return [("vm", node, vmid), ("vms", node), ("inventory",)]
+    if kind in VM_CONFIG_TASKS:
+        return [("vm", node, vmid), ("vm_config", node, vmid), ("vms", node), ("inventory",)]
+    if kind in VM_CREATE_TASKS:
+        # a clone may land on another node and its vmid is not in the UPID
+        return [("vms",), ("pool",), ("inventory",)]
+    if kind == "qmdestroy":
+        return [("vm", node, vmid), ("vm_config", node, vmid), ("vms", node), ("pool",), ("inventory",)]
+    if kind == "qmigrate":
+        return [("vm",), ("vm_config",), ("vms",), ("pool",), ("inventory",)]
+    if kind in ("srvreload", "srvrestart") and vmid in NETWORK_SERVICES:
+        return [("interfaces",), ("network_index",)]
+    if kind.startswith("qm") or kind.startswith("vz"):
+        return [("vms", node), ("inventory",)]
+    return []
+
+
+class EventWatcher(object):
+
+    def __init__(self, cluster: str):
+        self.cluster = cluster
+        self._lock = threading.Lock()
+        self._thread = None
+        self._seen_tasks = {}
+        self._seen_log = {}
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True,
+                                                name="proxmox-event-watcher-" + self.cluster)
+                self._thread.start()
+
+    def _apply(self, entries) -> int:
+        for entry in entries:
+            invalidate(entry[0], *entry[1:], namespace=self.cluster)
+        return len(entries)
+
+    def _new(self, seen: dict, events: list) -> list:
+        """Events not handled yet, given as (key, timestamp, event); forgets the keys older than the window"""
+        fresh = [(key, timestamp, event) for key, timestamp, event in events if key not in seen]
+        for key, timestamp, event in fresh:
+            seen[key] = timestamp
+        horizon = max(seen.values(), default=0) - getattr(settings, "PROXMOX_EVENT_WINDOW", 600)
+        for key in [key for key, timestamp in seen.items() if timestamp < horizon]:
+            del seen[key]
+        return [event for key, timestamp, event in fresh if timestamp >= horizon]
+
+    def poll(self) -> int:
+        """Handle the events that appeared since the previous poll, returns how many invalidations were made"""
+        connector = ProxmoxConnector(self.cluster)
+        tasks = [(task["upid"], task["endtime"], task) for task in connector.get_cluster_tasks()
+                 if task.get("upid") and task.get("endtime")]
+        log = [((entry.get("node"), entry.get("uid")), entry.get("time", 0), entry)
+               for entry in connector.get_cluster_log(max=getattr(settings, "PROXMOX_EVENT_LOG_SIZE", 200))]
+        new_tasks, new_log = self._new(self._seen_tasks, tasks), self._new(self._seen_log, log)
+        if not self._started:
+            # whatever was cached before the watcher started may be stale already
+            self._started = True
+            return self._apply([(family,) for family in list(WATCHED_TTLS) + ["inventory"]])
+        entries = []
+        for task in new_tasks:
+            entries += invalidations(task.get("type", ""), task.get("node"), task.get("id"))
+        for line in new_log:
+            message = line.get("msg", "")
+            match = UPID_PATTERN.search(message)
+            if match and message.startswith("end task"):
+                task = parse_upid(match.group(0))
+                entries += invalidations(task["type"], task["node"], task["id"])
+            match = UPDATE_VM_PATTERN.search(message)
+            if match:
+                entries += invalidations("qmconfig", line.get("node"), match.group(1))
+        return self._apply(sorted(set(entries), key=str))
+
+    def _loop(self):
+        interval = getattr(settings, "PROXMOX_EVENT_POLL_INTERVAL", 2)
+        while True:
+            try:
+                count = self.poll()
+                mark_watched(self.cluster, time.time() + 3 * interval)
+                if count:
+                    logger.debug("%d cache entries of %s invalidated from cluster events", count, self.cluster)
+            except Exception:
+                logger.exception("Could not read the events of %s, falling back to the short cache TTLs",
+                                 self.cluster)
+            time.sleep(interval)
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def watcher_for(cluster: str = None) -> EventWatcher:
+    cluster = cluster or default_cluster()
+    with _watchers_lock:
+        if cluster not in _watchers:
+            _watchers[cluster] = EventWatcher(cluster)
+        return _watchers[cluster]
@@ -0,0 +1,409 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+import subprocess
+import tempfile
+import threading
+import hashlib
+import json
+import ssl
+import os
+import re
+import time
+
+"""
+Local stand-in for the Proxmox VE API, covering the endpoints used by the orchestrator.
+
+It keeps an in-memory cluster (nodes, storages, bridges, VMs, pools, tasks, ACLs), answers over HTTPS with a
+throw-away self-signed certificate, sleeps `latency` seconds on every request and completes tasks after
+`task_duration` seconds. Requests are counted per endpoint template, e.g. "GET /nodes/{node}/qemu/{vmid}/config".
+"""
+
+GB = 1024 ** 3
+
+
+def parse_body(content_type: str, body: bytes) -> dict:
+    """Form fields of a request body; the files of a multipart upload are kept as bytes"""
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(
+            "Content-Type: {content_type}\r\n\r\n".format(content_type=content_type).encode() + body)
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            fields[name] = payload if part.get_filename() else payload.decode()
+        return fields
+    if content_type.startswith("application/x-www-form-urlencoded") or not content_type:
+        return {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+    return {}
+
+
+class FakeProxmoxError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super(FakeProxmoxError, self).__init__(message)
+        self.status = status
+
+
+class FakeCluster(object):
+
+    def __init__(self, nodes=("pve",), templates=None, bridges=("vmbr0", "vmbr1", "vmbr2"), task_duration=0.0):
+        self.lock = threading.RLock()
+        self.task_duration = task_duration
+        self.nodes = {node: {"maxmem": 128 * GB, "mem": 8 * GB, "maxcpu": 32, "cpu": 0.05} for node in nodes}
+        self.storages = {(node, "local-lvm"): {"maxdisk": 2048 * GB, "disk": 100 * GB} for node in nodes}
+        self.bridges = {node: list(bridges) for node in nodes}
+        self.vms = {}
+        self.pools = {}
+        self.tasks = {}
+        self.log = []
+        self.acl = []
+        self.users = [{"userid": "root@pam"}]
+        for index, (os_name, vmid) in enumerate(sorted((templates or {}).items())):
+            node = list(self.nodes)[index % len(self.nodes)]
+            self.vms[int(vmid)] = {"node": node, "name": "template-" + os_name.lower(), "status": "stopped",
+                                   "template": 1, "pool": None, "lock": None,
+                                   "config": {"name": "template-" + os_name.lower(), "memory": 2048, "cores": 2,
+                                              "template": 1}}
+
+    # tasks
+
+    def start_task(self, node: str, kind: str, vmid, user: str = "root@pam", on_finish=None) -> str:
+        now = time.time()
+        upid = "UPID:{node}:{pid:08X}:{pstart:08X}:{start:08X}:{kind}:{vmid}:{user}:".format(
+            node=node, pid=os.getpid(), pstart=len(self.tasks), start=int(now), kind=kind, vmid=vmid, user=user)
+        self.tasks[upid] = {"upid": upid, "node": node, "type": kind, "id": str(vmid), "user": user,
+                            "starttime": int(now), "due": now + self.task_duration, "on_finish": on_finish}
+        self.log.append({"uid": len(self.log) + 1, "time": int(now), "node": node, "user": user,
+                         "msg": "starting task {upid}".format(upid=upid)})
+        self.settle()
+        return upid
+
+    def settle(self):
+        now = time.time()
+        for task in self.tasks.values():
+            if "status" not in task and task["due"] <= now:
+                task["status"], task["endtime"] = "OK", int(now)
+                if task["on_finish"]:
+                    task["on_finish"]()
+
+    def task_view(self, task: dict) -> dict:
+        return {key: value for key, value in task.items() if key not in ("due", "on_finish")}
+
+    # helpers
+
+    def vm(self, vmid, node: str = None) -> dict:
+        vm = self.vms.get(int(vmid))
+        if vm is None or (node and vm["node"] != node):
+            raise FakeProxmoxError(500, "Configuration file 'nodes/{node}/qemu-server/{vmid}.conf' does not exist"
+                                   .format(node=node, vmid=vmid))
+        return vm
+
+    @staticmethod
+    def digest(config: dict) -> str:
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def resources(self) -> list:
+        resources = []
+        for node, info in self.nodes.items():
+            resources.append(dict(info, type="node", node=node, id="node/" + node, status="online"))
+        for (node, storage), info in self.storages.items():
+            resources.append(dict(info, type="storage", node=node, storage=storage, status="available",
+                                  id="storage/{node}/{storage}".format(node=node, storage=storage)))
+        for vmid, vm in self.vms.items():
+            resource = {"type": "qemu", "id": "qemu/{vmid}".format(vmid=vmid), "vmid": vmid, "node": vm["node"],
+                        "name": vm["name"], "status": vm["status"], "template": vm["template"],
+                        "maxmem": int(vm["config"].get("memory", 512)) * 1024 * 1024}
+            if vm["pool"]:
+                resource["pool"] = vm["pool"]
+            if vm["lock"]:
+                resource["lock"] = vm["lock"]
+            resources.append(resource)
+        for poolid in self.pools:
+            resources.append({"type": "pool", "id": "/pool/" + poolid, "pool": poolid})
+        return resources
+
+    def add_to_pool(self, poolid: str, vmid):
+        if poolid not in self.pools:
+            raise FakeProxmoxError(500, "pool '{poolid}' does not exist".format(poolid=poolid))
+        self.vm(vmid)["pool"] = poolid
+
+
+class FakeProxmoxServer(object):
+    """FakeProxmoxServer(...).start() returns (host, port); use cluster_settings() to point a cluster at it"""
+
+    def __init__(self, latency: float = 0.0, task_duration: float = 0.0, **cluster_options):
+        self.latency = latency
+        self.cluster = FakeCluster(task_duration=task_duration, **cluster_options)
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self._certdir = None
+        self.routes = [
+            ("POST", r"/access/ticket", self.login),
+            ("GET", r"/version", lambda match, data: {"version": "6.4", "release": "6.4"}),
+            ("GET", r"/cluster/resources", lambda match, data: self.cluster.resources()),
+            ("GET", r"/cluster/nextid", self.next_id),
+            ("GET", r"/cluster/tasks", self.cluster_tasks),
+            ("GET", r"/cluster/log", self.cluster_log),
+            ("GET", r"/cluster/sdn/vnets", lambda match, data: []),
+            ("GET", r"/nodes/(?P<node>[^/]+)/network", self.network),
+            ("GET", r"/nodes/(?P<node>[^/]+)/tasks/(?P<upid>[^/]+)/status", self.task_status),
+            ("GET", r"/nodes/(?P<node>[^/]+)/qemu", self.list_vms),
+            ("GET", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)", self.vm_index),
+            ("DELETE", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)", self.destroy_vm),
+            ("GET", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/status/current", self.vm_status),
+            ("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/status/(?P<action>start|stop|shutdown)",
+             self.vm_power),
+            ("GET", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/config", self.get_config),
+            ("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/config", self.set_config),
+            ("PUT", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/config", self.set_config),
+            ("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/clone", self.clone),
+            ("POST", r"/nodes/(?P<node>[^/]+)/storage/(?P<storage>[^/]+)/upload", self.upload),
+            ("DELETE", r"/nodes/(?P<node>[^/]+)/storage/(?P<storage>[^/]+)/content/(?P<volume>[^/]+)",
+             lambda match, data: None),
+            ("GET", r"/pools", lambda match, data: [{"poolid": poolid, "comment": pool["comment"]}
+                                                    for poolid, pool in self.cluster.pools.items()]),
+            ("POST", r"/pools", self.create_pool),
+            ("GET", r"/pools/(?P<poolid>[^/]+)", self.get_pool),
+            ("PUT", r"/pools/(?P<poolid>[^/]+)", self.update_pool),
+            ("DELETE", r"/pools/(?P<poolid>[^/]+)", self.delete_pool),
+            ("GET", r"/access/users", lambda match, data: self.cluster.users),
+            ("GET", r"/access/acl", lambda match, data: self.cluster.acl),
+            ("PUT", r"/access/acl", self.update_acl),
+        ]
+        self.routes = [(method, re.compile("^/api2/json" + pattern + "/?$"), handler,
+                        re.sub(r"\(\?P<(\w+)>[^)]*\)", r"{\1}", pattern))
+                       for method, pattern, handler in self.routes]
+
+    # lifecycle
+
+    def _ssl_context(self) -> ssl.SSLContext:
+        self._certdir = tempfile.TemporaryDirectory()
+        cert, key = os.path.join(self._certdir.name, "cert.pem"), os.path.join(self._certdir.name, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        return context
+
+    def start(self, host: str = "127.0.0.1", port: int = 0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                fake.handle(self)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._server.socket = self._ssl_context().wrap_socket(self._server.socket, server_side=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-proxmox", daemon=True)
+        self._thread.start()
+        return self._server.server_address
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._certdir:
+            self._certdir.cleanup()
+
+    def cluster_settings(self, node_name: str = None) -> dict:
+        host, port = self._server.server_address
+        return {"URL": host, "PORT": port, "USER": "root@pam", "PWD": "fake", "VERIFY_SSL": False,
+                "NODE_NAME": node_name or list(self.cluster.nodes)[0]}
+
+    def reset_counts(self):
+        with self._counts_lock:
+            self.counts.clear()
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.counts.values())
+
+    # dispatch
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        url = urlsplit(request.path)
+        data = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(request.headers.get("Content-Length") or 0)
+        if length:
+            data.update(parse_body(request.headers.get("Content-Type", ""), request.rfile.read(length)))
+        if self.latency:
+            time.sleep(self.latency)
+        status, payload = 501, {"errors": "Not implemented"}
+        for method, pattern, handler, template in self.routes:
+            match = pattern.match(unquote(url.path))
+            if method == request.command and match:
+                with self._counts_lock:
+                    self.counts["{method} {template}".format(method=method, template=template)] += 1
+                try:
+                    with self.cluster.lock:
+                        self.cluster.settle()
+                        status, payload = 200, {"data": handler(match.groupdict(), data)}
+                except FakeProxmoxError as e:
+                    status, payload = e.status, {"errors": str(e), "data": None}
+                break
+        else:
+            with self._counts_lock:
+                self.counts["{method} {path} (unknown)".format(method=request.command, path=url.path)] += 1
+        body = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json;charset=UTF-8")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    # handlers
+
+    def login(self, match, data):
+        return {"ticket": "PVE:{user}:FAKE{time}".format(user=data.get("username"), time=int(time.time())),
+                "CSRFPreventionToken": "FAKE", "username": data.get("username")}
+
+    def next_id(self, match, data):
+        return str(max([100] + [vmid + 1 for vmid in self.cluster.vms if vmid < 9000]))
+
+    def cluster_tasks(self, match, data):
+        return [self.cluster.task_view(task) for task in self.cluster.tasks.values()]
+
+    def cluster_log(self, match, data):
+        return list(reversed(self.cluster.log[-int(data.get("max", 50)):]))
+
+    def network(self, match, data):
+        kind = data.get("type")
+        return [{"iface": bridge, "type": "bridge", "active": 1} for bridge in self.cluster.bridges[match["node"]]
+                if kind in (None, "bridge", "any_bridge")]
+
+    def task_status(self, match, data):
+        task = self.cluster.tasks.get(match["upid"])
+        if task is None:
+            raise FakeProxmoxError(500, "no such task")
+        return {"upid": task["upid"], "node": task["node"], "status": "stopped" if "status" in task else "running",
+                "exitstatus": task.get("status")}
+
+    def list_vms(self, match, data):
+        return [{"vmid": vmid, "name": vm["name"], "status": vm["status"], "template": vm["template"]}
+                for vmid, vm in self.cluster.vms.items() if vm["node"] == match["node"]]
+
+    def vm_index(self, match, data):
+        self.cluster.vm(match["vmid"], match["node"])
+        return [{"subdir": subdir} for subdir in ("config", "status", "clone")]
+
+    def vm_status(self, match, data):
+        vm = self.cluster.vm(match["vmid"], match["node"])
+        status = {"vmid": int(match["vmid"]), "name": vm["name"], "status": vm["status"]}
+        if vm["lock"]:
+            status["lock"] = vm["lock"]
+        return status
+
+    def vm_power(self, match, data):
+        vm = self.cluster.vm(match["vmid"], match["node"])
+        target = "running" if match["action"] == "start" else "stopped"
+
+        def finish():
+            vm["status"] = target
+        return self.cluster.start_task(match["node"], "qm" + match["action"], match["vmid"], on_finish=finish)
+
+    def destroy_vm(self, match, data):
+        vmid = int(match["vmid"])
+        vm = self.cluster.vm(vmid, match["node"])
+        if vm["status"] == "running":
+            raise FakeProxmoxError(500, "VM {vmid} is running - destroy failed".format(vmid=vmid))
+        if vm["lock"]:
+            raise FakeProxmoxError(500, "VM is locked ({lock})".format(lock=vm["lock"]))
+        vm["lock"] = "destroyed"
+        return self.cluster.start_task(match["node"], "qmdestroy", vmid,
+                                       on_finish=lambda: self.cluster.vms.pop(vmid, None))
+
+    def get_config(self, match, data):
+        config = dict(self.cluster.vm(match["vmid"], match["node"])["config"])
+        config["digest"] = self.cluster.digest(config)
+        return config
+
+    def set_config(self, match, data):
+        vm = self.cluster.vm(match["vmid"], match["node"])
+        if vm["lock"]:
+            raise FakeProxmoxError(500, "VM is locked ({lock})".format(lock=vm["lock"]))
+        if data.get("digest") and data["digest"] != self.cluster.digest(vm["config"]):
+            raise FakeProxmoxError(500, "detected modified configuration - file changed by other user?")
+        for key in [key for key in data.get("delete", "").split(",") if key]:
+            vm["config"].pop(key, None)
+        vm["config"].update({key: value for key, value in data.items() if key not in ("delete", "digest")})
+        vm["name"] = vm["config"].get("name", vm["name"])
+        self.cluster.log.append({"uid": len(self.cluster.log) + 1, "time": int(time.time()), "node": match["node"],
+                                 "msg": "update VM {vmid}: {keys}".format(vmid=match["vmid"], keys=sorted(data))})
+        return None
+
+    def clone(self, match, data):
+        source = self.cluster.vm(match["vmid"], match["node"])
+        newid = int(data["newid"])
+        if newid in self.cluster.vms:
+            raise FakeProxmoxError(500, "VM {vmid} already exists".format(vmid=newid))
+        config = {key: value for key, value in source["config"].items() if key != "template"}
+        config["name"] = data.get("name", "Copy-of-VM-" + source["name"])
+        vm = {"node": data.get("target") or match["node"], "name": config["name"], "status": "stopped",
+              "template": 0, "pool": None, "lock": "clone", "config": config}
+        self.cluster.vms[newid] = vm
+        if data.get("pool"):
+            self.cluster.add_to_pool(data["pool"], newid)
+
+        def finish():
+            vm["lock"] = None
+        return self.cluster.start_task(match["node"], "qmclone", match["vmid"], on_finish=finish)
+
+    def upload(self, match, data):
+        return self.cluster.start_task(match["node"], "imgcopy", "")
+
+    def create_pool(self, match, data):
+        if data["poolid"] in self.cluster.pools:
+            raise FakeProxmoxError(500, "create pool failed: pool '{poolid}' already exists".format(**data))
+        self.cluster.pools[data["poolid"]] = {"comment": data.get("comment", "")}
+        return None
+
+    def get_pool(self, match, data):
+        if match["poolid"] not in self.cluster.pools:
+            raise FakeProxmoxError(500, "pool '{poolid}' does not exist".format(**match))
+        members = [resource for resource in self.cluster.resources()
+                   if resource["type"] == "qemu" and resource.get("pool") == match["poolid"]]
+        return {"comment": self.cluster.pools[match["poolid"]]["comment"], "members": members}
+
+    def update_pool(self, match, data):
+        vmids = [vmid for vmid in data.get("vms", "").split(",") if vmid]
+        for vmid in vmids:
+            if data.get("delete") in ("1", 1):
+                self.cluster.vm(vmid)["pool"] = None
+            else:
+                self.cluster.add_to_pool(match["poolid"], vmid)
+        return None
+
+    def delete_pool(self, match, data):
+        if [vm for vm in self.cluster.vms.values() if vm["pool"] == match["poolid"]]:
+            raise FakeProxmoxError(500, "delete pool failed: pool not empty")
+        self.cluster.pools.pop(match["poolid"], None)
+        return None
+
+    def update_acl(self, match, data):
+        paths = [path for path in data.get("path", "").split(",") if path]
+        roles = [role for role in data.get("roles", "").split(",") if role]
+        users = [user for user in data.get("users", "").split(",") if user]
+        for path in paths:
+            for role in roles:
+                for user in users:
+                    entry = {"path": path, "roleid": role, "type": "user", "ugid": user,
+                             "propagate": int(data.get("propagate", 1))}
+                    self.cluster.acl = [acl for acl in self.cluster.acl
+                                        if (acl["path"], acl["roleid"], acl["ugid"]) != (path, role, user)]
+                    if data.get("delete") not in ("1", 1):
+                        self.cluster.acl.append(entry)
+        return None
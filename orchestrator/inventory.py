@@ -0,0 +1,126 @@
+from django.conf import settings
+from collections import defaultdict
+from .cache import family_version, is_watched
+from .proxmox import ProxmoxConnector
+from .clusters import default_cluster, fan_out
+import threading
+import time
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+In-memory view of the whole cluster built from a single /cluster/resources call.
+
+Snapshots are immutable: a refresh builds a new one and swaps the reference, so readers always see a consistent
+index. Mutating connector calls bump the "inventory" cache family, which forces the next read to refresh.
+There is one inventory per cluster; snapshots() fetches all of them in parallel.
+"""
+
+
+class InventorySnapshot(object):
+
+    def __init__(self, resources, version=None):
+        self.fetched_at = time.time()
+        self.version = version
+        self.vms = {}
+        self.nodes = {}
+        self.storages = {}
+        self.by_pool = defaultdict(list)
+        self.by_node = defaultdict(list)
+        self.by_name = defaultdict(list)
+        for resource in resources:
+            kind = resource.get('type')
+            if kind in ('qemu', 'lxc'):
+                vmid = str(resource.get('vmid'))
+                self.vms[vmid] = resource
+                if resource.get('pool'):
+                    self.by_pool[resource['pool']].append(resource)
+                self.by_node[resource.get('node')].append(resource)
+                self.by_name[resource.get('name')].append(resource)
+            elif kind == 'node':
+                self.nodes[resource.get('node')] = resource
+            elif kind == 'storage':
+                self.storages[(resource.get('node'), resource.get('storage'))] = resource
+
+    def has_vm(self, vmid) -> bool:
+        return str(vmid) in self.vms
+
+    def get_vm(self, vmid):
+        return self.vms.get(str(vmid))
+
+    def vm_status(self, vmid):
+        vm = self.get_vm(vmid)
+        return vm.get('status') if vm else None
+
+    def vms_in_pool(self, poolid: str):
+        return self.by_pool.get(poolid, [])
+
+    def vms_on_node(self, node: str):
+        return self.by_node.get(node, [])
+
+    def vms_named(self, name: str):
+        return self.by_name.get(name, [])
+
+
+class ClusterInventory(object):
+
+    def __init__(self, cluster: str):
+        self.cluster = cluster
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def refresh_interval(self):
+        """Longer while the event watcher invalidates the inventory on every change (usage figures still age)"""
+        if is_watched(self.cluster):
+            return getattr(settings, "PROXMOX_WATCHED_INVENTORY_REFRESH_INTERVAL", 60)
+        return getattr(settings, "PROXMOX_INVENTORY_REFRESH_INTERVAL", 10)
+
+    def _is_current(self, snapshot):
+        return snapshot is not None \
+               and time.time() - snapshot.fetched_at < self.refresh_interval() \
+               and snapshot.version == family_version('inventory', self.cluster)
+
+    def refresh(self) -> InventorySnapshot:
+        version = family_version('inventory', self.cluster)
+        snapshot = InventorySnapshot(ProxmoxConnector(self.cluster).get_cluster_resources(), version=version)
+        self._snapshot = snapshot
+        return snapshot
+
+    def snapshot(self) -> InventorySnapshot:
+        snapshot = self._snapshot
+        if self._is_current(snapshot):
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if self._is_current(snapshot):
+                return snapshot
+            return self.refresh()
+
+
+class InventoryRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inventories = {}
+
+    def for_cluster(self, cluster: str = None) -> ClusterInventory:
+        cluster = cluster or default_cluster()
+        with self._lock:
+            if cluster not in self._inventories:
+                self._inventories[cluster] = ClusterInventory(cluster)
+            return self._inventories[cluster]
+
+    def snapshot(self, cluster: str = None) -> InventorySnapshot:
+        return self.for_cluster(cluster).snapshot()
+
+    def discard(self, cluster: str = None):
+        """Drop the snapshot held for the cluster, the next lookup fetches a new one"""
+        with self._lock:
+            self._inventories.pop(cluster or default_cluster(), None)
+
+    def snapshots(self, clusters: list = None) -> dict:
+        """cluster -> snapshot (or the exception raised while fetching it), fetched in parallel"""
+        return fan_out(self.snapshot, clusters)
+
+
+inventory = InventoryRegistry()
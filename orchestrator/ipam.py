@@ -0,0 +1,170 @@
+from django.db import transaction
+from django.db.models import Count
+from .models import Activity, Network, TesterIpAddress, VMNet
+import ipaddress
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+IP address management for the tester addresses assigned to VM NICs.
+
+Addresses are indexed per subnet in two bitmaps (Python ints, one bit per host offset): the addresses that exist
+and the ones already bound to a VMNet. The next free address is the lowest bit of available & ~used, found in
+constant time whatever the number of addresses. An index is built in bulk with two queries and then kept up to
+date by the allocations made through it.
+"""
+
+
+class IPAMError(Exception):
+    pass
+
+
+def subnet_of(network: Network):
+    """The subnet declared on the Network, None when it accepts any address"""
+    if network.subnet and network.cidr is not None:
+        return ipaddress.ip_network("{subnet}/{cidr}".format(subnet=network.subnet, cidr=network.cidr), strict=False)
+    return None
+
+
+class SubnetIndex(object):
+
+    def __init__(self, subnet):
+        self.subnet = subnet
+        self.addresses = {}
+        self.available = 0
+        self.used = 0
+        self.conflicts = {}
+        self.invalid = []
+
+    def offset(self, ip) -> int:
+        return int(ipaddress.ip_address(ip)) - int(self.subnet.network_address)
+
+    def is_host(self, offset: int) -> bool:
+        if self.subnet.prefixlen >= 31:
+            return True
+        return 0 < offset < self.subnet.num_addresses - 1
+
+    def add(self, address: TesterIpAddress, used: bool = False):
+        offset = self.offset(address.ip)
+        if not self.is_host(offset) or address.ip == address.gateway:
+            self.invalid.append(address)
+            return
+        if offset in self.addresses:
+            self.conflicts.setdefault(str(address.ip), [self.addresses[offset]]).append(address)
+            return
+        self.addresses[offset] = address
+        self.available |= 1 << offset
+        if used:
+            self.used |= 1 << offset
+
+    def free(self) -> int:
+        return self.available & ~self.used
+
+    def free_count(self) -> int:
+        return bin(self.free()).count("1")
+
+    def free_addresses(self) -> list:
+        free = self.free()
+        return [address for offset, address in sorted(self.addresses.items()) if free >> offset & 1]
+
+    def allocate(self):
+        free = self.free()
+        if not free:
+            return None
+        lowest = free & -free
+        self.used |= lowest
+        return self.addresses[lowest.bit_length() - 1]
+
+    def release(self, address: TesterIpAddress):
+        self.used &= ~(1 << self.offset(address.ip))
+
+
+class AddressManager(object):
+    """Index of a set of tester addresses, grouped by the subnet they declare (ip/cidr)"""
+
+    def __init__(self, addresses, used_ids):
+        self.subnets = {}
+        for address in addresses:
+            subnet = ipaddress.ip_network("{ip}/{cidr}".format(ip=address.ip, cidr=address.cidr), strict=False)
+            if subnet not in self.subnets:
+                self.subnets[subnet] = SubnetIndex(subnet)
+            self.subnets[subnet].add(address, used=address.pk in used_ids)
+
+    @classmethod
+    def build(cls, addresses=None):
+        addresses = TesterIpAddress.objects.all() if addresses is None else addresses
+        used_ids = set(VMNet.objects.filter(ip__isnull=False).values_list("ip_id", flat=True))
+        return cls(list(addresses.order_by("pk")), used_ids)
+
+    @classmethod
+    def for_activity(cls, activity: Activity):
+        return cls.build(TesterIpAddress.objects.filter(tester__in=activity.testers.all()))
+
+    def indexes_for(self, network: Network) -> list:
+        """The subnet indexes usable on a Network: the ones inside its subnet, or all of them"""
+        subnet = subnet_of(network)
+        return [index for key, index in sorted(self.subnets.items())
+                if subnet is None or key.subnet_of(subnet)]
+
+    def allocate(self, network: Network):
+        for index in self.indexes_for(network):
+            address = index.allocate()
+            if address is not None:
+                return address
+        return None
+
+    def free_addresses(self, network: Network = None) -> list:
+        indexes = self.indexes_for(network) if network else self.subnets.values()
+        return [address for index in indexes for address in index.free_addresses()]
+
+    def conflicts(self) -> dict:
+        """ip -> addresses sharing it within the same subnet"""
+        return {ip: addresses for index in self.subnets.values() for ip, addresses in index.conflicts.items()}
+
+    def invalid(self) -> list:
+        """Addresses that are the network or broadcast address of their subnet, or equal to their gateway"""
+        return [address for index in self.subnets.values() for address in index.invalid]
+
+
+def duplicated_addresses():
+    """ip -> number of TesterIpAddress rows sharing it, computed by the database"""
+    return dict(TesterIpAddress.objects.values_list("ip").annotate(count=Count("pk")).filter(count__gt=1))
+
+
+def check_assignment(net: Network, address: TesterIpAddress, vmnet: VMNet = None):
+    """Raise IPAMError when address cannot be bound to a NIC on net"""
+    if address is None:
+        return
+    subnet = subnet_of(net)
+    if subnet is not None and ipaddress.ip_address(address.ip) not in subnet:
+        raise IPAMError("{ip} non appartiene alla rete {subnet}".format(ip=address.ip, subnet=subnet))
+    host = ipaddress.ip_network("{ip}/{cidr}".format(ip=address.ip, cidr=address.cidr), strict=False)
+    index = SubnetIndex(host)
+    index.add(address)
+    if index.invalid:
+        raise IPAMError("{ip} non è un indirizzo host valido".format(ip=address.ip))
+    taken = VMNet.objects.filter(ip=address)
+    if vmnet is not None and vmnet.pk:
+        taken = taken.exclude(pk=vmnet.pk)
+    if taken.exists():
+        raise IPAMError("{ip} è già assegnato".format(ip=address.ip))
+    duplicates = TesterIpAddress.objects.filter(ip=address.ip).exclude(pk=address.pk)
+    if VMNet.objects.filter(ip__in=duplicates).exists():
+        raise IPAMError("{ip} è già assegnato a un altro tester".format(ip=address.ip))
+
+
+def allocate_activity(activity: Activity) -> dict:
+    """Give an address to every NIC of the activity that has none; returns VMNet pk -> TesterIpAddress"""
+    manager = AddressManager.for_activity(activity)
+    vmnets = list(VMNet.objects.filter(vm__activity=activity, ip__isnull=True).select_related("net").order_by("pk"))
+    allocated = {}
+    for vmnet in vmnets:
+        address = manager.allocate(vmnet.net)
+        if address is None:
+            logger.warning("No free address left for %s on %s", activity, vmnet.net)
+            continue
+        vmnet.ip = address
+        allocated[vmnet.pk] = address
+    with transaction.atomic():
+        VMNet.objects.bulk_update([vmnet for vmnet in vmnets if vmnet.pk in allocated], ["ip"])
+    return allocated
@@ -0,0 +1,180 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.utils import timezone
+from datetime import timedelta
+from .models import Job
+from .proxmox import ProxmoxDriverException
+from .scope import lookup_scope
+import threading
+import traceback
+import random
+import json
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+DB-backed job queue: admin actions enqueue jobs, the run_orchestrator_worker command claims and runs them.
+Handlers are registered per Job.kind and receive the job and a progress(step, state) callback.
+
+A claimed job is leased to its worker for ORCHESTRATOR_JOB_LEASE seconds, renewed by a heartbeat while it runs.
+When a worker dies the lease expires and the job is requeued (or failed, when out of attempts) by the next claim.
+"""
+
+JOB_HANDLERS = {}
+
+
+def handler(kind: str):
+    def first_level_wrapper(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return first_level_wrapper
+
+
+def enqueue(kind: str, activity=None, max_attempts: int = None) -> Job:
+    return Job.objects.create(kind=kind, activity=activity,
+                              max_attempts=max_attempts or getattr(settings, "ORCHESTRATOR_JOB_MAX_ATTEMPTS", 3))
+
+
+def lease_duration() -> timedelta:
+    return timedelta(seconds=getattr(settings, "ORCHESTRATOR_JOB_LEASE", 120))
+
+
+def requeue_expired() -> int:
+    """Give back the running jobs whose worker stopped renewing the lease, returns how many were found"""
+    now = timezone.now()
+    expired = Job.objects.filter(status=Job.RUNNING).filter(Q(lease_expires_at__lt=now) |
+                                                            Q(lease_expires_at__isnull=True))
+    error = "The worker running this job stopped renewing its lease"
+    count = expired.filter(attempts__lt=F("max_attempts"))\
+        .update(status=Job.PENDING, run_after=now, error=error, lease_expires_at=None)
+    count += expired.update(status=Job.FAILED, finished_at=now, error=error, lease_expires_at=None)
+    if count:
+        logger.warning("%d jobs with an expired lease taken back from their worker", count)
+    return count
+
+
+def claim_next():
+    """Atomically move the oldest due job from pending to running, a compare-and-set that also works on SQLite"""
+    requeue_expired()
+    candidates = Job.objects.filter(status=Job.PENDING, run_after__lte=timezone.now())\
+        .order_by("run_after", "pk").values_list("pk", flat=True)[:10]
+    for pk in candidates:
+        claimed = Job.objects.filter(pk=pk, status=Job.PENDING)\
+            .update(status=Job.RUNNING, started_at=timezone.now(), attempts=F("attempts") + 1,
+                    lease_expires_at=timezone.now() + lease_duration())
+        if claimed:
+            return Job.objects.get(pk=pk)
+    return None
+
+
+class ProgressRecorder(object):
+    """Collects step states coming from several engine threads and persists them on the job row"""
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.steps = job.steps
+        self._lock = threading.Lock()
+
+    def __call__(self, step: str, state: str):
+        with self._lock:
+            self.steps[step] = state
+            Job.objects.filter(pk=self.job.pk).update(progress=json.dumps(self.steps),
+                                                      lease_expires_at=timezone.now() + lease_duration())
+
+
+class Heartbeat(object):
+    """Renews the lease of a running job from a background thread, for handlers staying long on a single step"""
+
+    def __init__(self, job: Job):
+        self.job = job
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="job-heartbeat-{pk}".format(pk=job.pk))
+
+    def _loop(self):
+        interval = lease_duration().total_seconds() / 3
+        try:
+            while not self._stopped.wait(interval):
+                Job.objects.filter(pk=self.job.pk, status=Job.RUNNING, attempts=self.job.attempts)\
+                    .update(lease_expires_at=timezone.now() + lease_duration())
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+
+def retry_delay(attempts: int) -> timedelta:
+    base = getattr(settings, "ORCHESTRATOR_JOB_RETRY_DELAY", 30)
+    return timedelta(seconds=base * 2 ** (attempts - 1) * random.uniform(1, 1.5))
+
+
+def run_job(job: Job) -> Job:
+    try:
+        with lookup_scope(), Heartbeat(job):
+            JOB_HANDLERS[job.kind](job, ProgressRecorder(job))
+    except Exception:
+        logger.exception("Job %s failed (attempt %s/%s)", job.pk, job.attempts, job.max_attempts)
+        job.error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            job.status = Job.PENDING
+            job.run_after = timezone.now() + retry_delay(job.attempts)
+        else:
+            job.status = Job.FAILED
+            job.finished_at = timezone.now()
+    else:
+        job.status = Job.SUCCEEDED
+        job.error = ""
+        job.finished_at = timezone.now()
+    job.lease_expires_at = None
+    # only the worker still holding the claim may record the outcome, the job may have been requeued meanwhile
+    saved = Job.objects.filter(pk=job.pk, status=Job.RUNNING, attempts=job.attempts)\
+        .update(status=job.status, error=job.error, run_after=job.run_after, finished_at=job.finished_at,
+                lease_expires_at=None)
+    if not saved:
+        logger.warning("Job %s lost its lease while running, its outcome is discarded", job.pk)
+        job.refresh_from_db()
+    return job
+
+
+def retry(job: Job):
+    """Requeue a finished job from scratch; a running one only once its lease has expired"""
+    Job.objects.filter(pk=job.pk).exclude(status=Job.RUNNING, lease_expires_at__gte=timezone.now())\
+        .update(status=Job.PENDING, run_after=timezone.now(), attempts=0, error="", lease_expires_at=None)
+
+
+@handler("provision_activity")
+def provision_activity_job(job: Job, progress):
+    from .vm_creation_flow import provision_activity
+    failures = {pk: exception for pk, exception in provision_activity(job.activity, progress=progress).items()
+                if exception}
+    if failures:
+        raise ProxmoxDriverException("{count} VM could not be created: {vms}".format(
+            count=len(failures), vms=", ".join(str(pk) for pk in failures)))
+
+
+@handler("refill_warm_pool")
+def refill_warm_pool_job(job: Job, progress):
+    from .warmpool import refill_all
+    from .clusters import cluster_names
+    for cluster in cluster_names():
+        progress("refill {cluster}".format(cluster=cluster), "RUNNING")
+    results = refill_all()
+    for cluster, exception in results.items():
+        progress("refill {cluster}".format(cluster=cluster), "FAILURE" if exception else "SUCCESS")
+    failures = {cluster: exception for cluster, exception in results.items() if exception}
+    if failures:
+        raise ProxmoxDriverException("Warm pool refill failed on {clusters}".format(
+            clusters=", ".join("{cluster} ({error})".format(cluster=cluster, error=exception)
+                               for cluster, exception in sorted(failures.items()))))
+
+
+@handler("teardown_activity")
+def teardown_activity_job(job: Job, progress):
+    from .teardown import teardown_activity
+    teardown_activity(job.activity, progress=progress)
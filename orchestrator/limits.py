@@ -0,0 +1,68 @@
+from django.conf import settings
+from contextlib import contextmanager
+import threading
+import time
+
+
+class KeyedSemaphore(object):
+    """A lazily created bounded semaphore for each key (node, storage, ...)"""
+
+    def __init__(self, setting_name: str, default: int):
+        self.setting_name = setting_name
+        self.default = default
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, key) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(getattr(settings, self.setting_name, self.default))
+            return self._semaphores[key]
+
+
+class TokenBucket(object):
+    """
+    Rate limiter refilled at rate tokens per second up to burst. Callers of a lane with a floor only take a token
+    while more than floor are left, so the last floor tokens stay available to the lanes without one.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_take(self, floor: int = 0) -> float:
+        """Take a token and return 0, or return how long to wait before trying again"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= floor + 1:
+                self._tokens -= 1
+                return 0.0
+            return (floor + 1 - self._tokens) / self.rate
+
+    def take(self, floor: int = 0):
+        wait = self.try_take(floor)
+        while wait:
+            time.sleep(wait)
+            wait = self.try_take(floor)
+
+
+clone_slots_per_node = KeyedSemaphore("PROXMOX_MAX_CLONES_PER_NODE", 2)
+clone_slots_per_storage = KeyedSemaphore("PROXMOX_MAX_CLONES_PER_STORAGE", 2)
+
+
+@contextmanager
+def clone_slots(cluster: str, node: str, storage: str = None):
+    """A clone slot on the node and, when the target storage is known, one on that storage of the node"""
+    with clone_slots_per_node((cluster, node)):
+        if storage:
+            with clone_slots_per_storage((cluster, node, storage)):
+                yield
+        else:
+            yield
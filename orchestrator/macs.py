@@ -0,0 +1,109 @@
+from django.core.cache import cache
+from .aioproxmox import fetch_vm_configs
+from .inventory import inventory
+from .clusters import default_cluster
+from .vmconfig import parse_net
+import threading
+import random
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Cluster-wide index of the NIC MAC addresses, used to hand out unique 52:54:00:XX:XX:XX addresses.
+
+The index is built once from the config of every VM in the inventory (fetched concurrently), then kept up to date
+incrementally: VMs appearing in the inventory are read on their own, VMs that disappeared release their addresses,
+and the config builder registers or releases the NICs it writes. With a few thousand addresses in a 2^24 space a
+random candidate is almost always free, so allocation is O(1); a cache.add() reservation keeps concurrent worker
+processes from handing out the same candidate.
+"""
+
+PREFIX = "52:54:00"
+RESERVATION_TTL = 24 * 3600
+
+
+def format_mac(value: int) -> str:
+    return "{prefix}:{a:02X}:{b:02X}:{c:02X}".format(prefix=PREFIX, a=value >> 16 & 0xFF, b=value >> 8 & 0xFF,
+                                                      c=value & 0xFF)
+
+
+def macs_of(config: dict) -> set:
+    return {parse_net(str(value)).get("macaddr", "").upper() for key, value in config.items()
+            if key.startswith("net") and key[3:].isdigit()} - {""}
+
+
+class MacAddressIndex(object):
+
+    def __init__(self, cluster: str):
+        self.cluster = cluster
+        self._lock = threading.Lock()
+        self._used = set()
+        self._indexed = {}
+        self._written = {}
+        self._snapshot = None
+
+    def _forget_vm(self, vmid: str):
+        self._used -= self._indexed.pop(vmid, set()) | self._written.pop(vmid, set())
+
+    def sync(self):
+        """Index the VMs not seen yet and forget the ones gone since the previous inventory snapshot"""
+        snapshot = inventory.snapshot(self.cluster)
+        if snapshot is self._snapshot:
+            return
+        with self._lock:
+            for vmid in (set(self._indexed) | set(self._written)) - set(snapshot.vms):
+                self._forget_vm(vmid)
+            missing = [(vm.get("node"), vmid) for vmid, vm in snapshot.vms.items()
+                       if vmid not in self._indexed and vm.get("type") == "qemu"]
+        configs = fetch_vm_configs(missing, self.cluster) if missing else {}
+        with self._lock:
+            for vmid, config in configs.items():
+                if isinstance(config, Exception):
+                    logger.warning("Could not read the config of VM %s for the MAC index: %s", vmid, config)
+                    continue
+                self._indexed[vmid] = macs_of(config)
+                self._used |= self._indexed[vmid]
+            self._snapshot = snapshot
+
+    def register(self, vmid, mac_address: str):
+        with self._lock:
+            mac_address = mac_address.upper()
+            self._used.add(mac_address)
+            self._written.setdefault(str(vmid), set()).add(mac_address)
+
+    def release(self, vmid, mac_address: str):
+        with self._lock:
+            mac_address = mac_address.upper()
+            self._used.discard(mac_address)
+            self._indexed.get(str(vmid), set()).discard(mac_address)
+            self._written.get(str(vmid), set()).discard(mac_address)
+
+    def is_used(self, mac_address: str) -> bool:
+        return mac_address.upper() in self._used
+
+    def allocate(self, vmid=None) -> str:
+        self.sync()
+        with self._lock:
+            while True:
+                candidate = format_mac(random.getrandbits(24))
+                if candidate in self._used:
+                    continue
+                if not cache.add("px_{cluster}_mac_{mac}".format(cluster=self.cluster, mac=candidate), True,
+                                 RESERVATION_TTL):
+                    continue
+                self._used.add(candidate)
+                if vmid is not None:
+                    self._written.setdefault(str(vmid), set()).add(candidate)
+                return candidate
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def mac_index_for(cluster: str = None) -> MacAddressIndex:
+    cluster = cluster or default_cluster()
+    with _indexes_lock:
+        if cluster not in _indexes:
+            _indexes[cluster] = MacAddressIndex(cluster)
+        return _indexes[cluster]
@@ -0,0 +1,197 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from orchestrator.fake_proxmox import FakeProxmoxServer
+from orchestrator.models import Activity, Network, VirtualMachine, VMNet
+from orchestrator.proxmox import ProxmoxConnector
+from orchestrator.inventory import inventory
+from orchestrator.scope import lookup_scope
+from orchestrator.upid import tracker_for
+from orchestrator.vm_creation_flow import vm_creation_flow, run_flow
+import statistics
+import json
+import time
+
+"""
+Benchmarks the orchestrator against orchestrator.fake_proxmox.
+
+Every scenario runs `--repeat` times: the first run starts from empty caches (cold), the others reuse them (warm).
+For each run the report holds the wall time and the API requests received by the fake server, per endpoint.
+The event watcher is off and every run starts once the tasks of the previous one are no longer polled, so the
+counts only hold the requests of the scenario. A failing scenario aborts the command.
+Database changes made by the scenarios are rolled back.
+"""
+
+CLUSTER = "benchmark"
+TEMPLATES = {"Win7": 9000, "Win10": 9001, "Kali": 9002}
+BRIDGES = ("vmbr0", "vmbr1", "vmbr2")
+
+
+class Command(BaseCommand):
+    help = "Runs the orchestrator against a local fake Proxmox API and reports wall time and API requests as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--latency", type=float, default=0.005, help="Seconds added to every API request")
+        parser.add_argument("--task-duration", type=float, default=0.2, help="Seconds before a Proxmox task ends")
+        parser.add_argument("--nodes", type=int, default=3, help="Nodes of the fake cluster")
+        parser.add_argument("--vms", type=int, default=10, help="VMs of the benchmark activity")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario, the first one is cold")
+        parser.add_argument("--only", nargs="*", help="Run only the scenarios with these names")
+        parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        self.server = FakeProxmoxServer(latency=options["latency"], task_duration=options["task_duration"],
+                                        nodes=["pve{index}".format(index=index + 1)
+                                               for index in range(options["nodes"])],
+                                        templates=TEMPLATES, bridges=BRIDGES)
+        self.server.start()
+        try:
+            with override_settings(DEBUG=False,
+                                   PROXMOX_CLUSTERS={CLUSTER: self.server.cluster_settings()},
+                                   PROXMOX_DEFAULT_CLUSTER=CLUSTER,
+                                   PROXMOX_TEMPLATES=TEMPLATES,
+                                   PROXMOX_WARM_POOL={},
+                                   PROXMOX_EVENT_WATCHER=False):
+                with transaction.atomic():
+                    scenarios = self.run_scenarios(options)
+                    transaction.set_rollback(True)
+        finally:
+            self.server.stop()
+            inventory.discard(CLUSTER)
+        report = json.dumps({
+            "config": {key: options[key] for key in ("latency", "task_duration", "nodes", "vms", "repeat")},
+            "scenarios": scenarios,
+        }, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+    def wait_for_tasks(self, timeout: float = 60):
+        """Let the task tracker forget the tasks started so far, so that its polling is not counted afterwards"""
+        deadline = time.monotonic() + timeout
+        while tracker_for(CLUSTER).pending():
+            if time.monotonic() > deadline:
+                raise CommandError("Proxmox tasks still pending after {timeout}s".format(timeout=timeout))
+            time.sleep(0.05)
+
+    def measure(self, name: str, func, repeat: int, setup=None) -> dict:
+        runs = []
+        for index in range(repeat):
+            if setup:
+                setup()
+            if index == 0:
+                cache.clear()
+                inventory.discard(CLUSTER)
+            self.wait_for_tasks()
+            self.server.reset_counts()
+            started = time.perf_counter()
+            try:
+                with lookup_scope():
+                    func()
+            except Exception as e:
+                raise CommandError("Scenario {name} failed (run {index}): {error!r}".format(
+                    name=name, index=index + 1, error=e)) from e
+            runs.append({
+                "wall_time": time.perf_counter() - started,
+                "requests": self.server.total_requests,
+                "endpoints": dict(self.server.counts),
+            })
+        self.stderr.write("{name}: {time:.3f}s, {requests} requests (cold)".format(
+            name=name, time=runs[0]["wall_time"], requests=runs[0]["requests"]))
+        warm = runs[1:] or runs
+        return {
+            "name": name,
+            "cold": runs[0],
+            "warm": {
+                "wall_time": statistics.median(run["wall_time"] for run in warm),
+                "requests": statistics.median(run["requests"] for run in warm),
+            },
+            "runs": runs,
+        }
+
+    def fixtures(self, vms: int) -> Activity:
+        self.user = User.objects.create_superuser("benchmark", "benchmark@localhost", "benchmark")
+        networks = [Network.objects.create(network_description="Benchmark {bridge}".format(bridge=bridge),
+                                           bridge_name=bridge) for bridge in BRIDGES[1:]]
+        activity = Activity.objects.create(activity_identifier="BENCH", target_application_identifier="BENCH",
+                                           target_application_name="Benchmark", cluster=CLUSTER)
+        oss = [os for os, _ in VirtualMachine.OSS]
+        for index in range(vms):
+            vm = VirtualMachine.objects.create(name="bench {index}".format(index=index), os=oss[index % len(oss)],
+                                               ram=1024, cpu=2, activity=activity)
+            for network in networks:
+                VMNet.objects.create(vm=vm, net=network)
+        return activity
+
+    def run_scenarios(self, options: dict) -> list:
+        repeat = max(options["repeat"], 1)
+        activity = self.fixtures(options["vms"])
+        connector = ProxmoxConnector(CLUSTER)
+        connector.reachable()
+        node = self.server.cluster_settings()["NODE_NAME"]
+        template = TEMPLATES["Kali"]
+        poolid = activity.px_create_pool()
+        vmid = connector.clone_vm("benchmark-fixture", template, node=node, pool=poolid)
+        client = Client()
+        client.force_login(self.user)
+        vms = list(activity.vms.all())
+
+        def reset_vms():
+            for vm in vms:
+                if vm.vmid:
+                    connector.delete_vm(vmid=vm.vmid, node=vm.node)
+                vm.vmid = vm.node = None
+                vm.save(update_fields=["vmid", "node"])
+            # let the destroy tasks complete before the next run
+            time.sleep(options["task_duration"])
+
+        def create_vms():
+            for vm in vms:
+                run_flow(vm_creation_flow, {'vm': vm})
+
+        def attach_and_detach():
+            network, _ = connector.attach_net_to_vm(vmid=vmid, bridge=BRIDGES[1], node=node)
+            connector.detach_net_from_vm(vmid=vmid, network=network.replace("eth", "net"), node=node)
+
+        def create_and_delete_pool():
+            connector.create_resource_pool(poolid="BENCHPOOL", comment="benchmark")
+            connector.delete_resource_pool(poolid="BENCHPOOL")
+
+        def clone_and_delete():
+            clone = connector.clone_vm("benchmark-clone", template, node=node)
+            connector.delete_vm(vmid=clone, node=node)
+
+        scenarios = [
+            ("get_vms", lambda: connector.get_vms(node=node)),
+            ("get_vm", lambda: connector.get_vm(vmid, node=node)),
+            ("get_vm_config", lambda: connector.get_vm_config(vmid, node=node)),
+            ("get_interfaces_list", lambda: connector.get_interfaces_list(node=node)),
+            ("get_pools", connector.get_pools),
+            ("get_resource_pool", lambda: connector.get_resource_pool(poolid)),
+            ("get_cluster_resources", connector.get_cluster_resources),
+            ("assign_ram", lambda: connector.assign_ram(vmid, 2048, 512, node=node)),
+            ("set_cores", lambda: connector.set_cores(vmid, 2, node=node)),
+            ("rename_vm", lambda: connector.rename_vm(vmid, "benchmark-fixture", node=node)),
+            ("attach_and_detach_net", attach_and_detach),
+            ("create_and_delete_pool", create_and_delete_pool),
+            ("clone_and_delete_vm", clone_and_delete),
+            ("vm_creation_flow", create_vms, reset_vms),
+        ]
+        for model in ("virtualmachine", "activity", "network", "job", "warmpoolmetric"):
+            url = reverse("admin:orchestrator_{model}_changelist".format(model=model))
+            scenarios.append(("admin_{model}_changelist".format(model=model), lambda url=url: client.get(url)))
+        scenarios.append(("pxe_networks", lambda: client.get(reverse("pxe_networks"), {"term": ""})))
+
+        results = []
+        for scenario in scenarios:
+            name, func, setup = (scenario + (None,))[:3]
+            if options["only"] and name not in options["only"]:
+                continue
+            results.append(self.measure(name, func, repeat, setup))
+        return results
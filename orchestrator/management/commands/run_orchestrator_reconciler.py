@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from orchestrator.clusters import fan_out
+from orchestrator.proxmox import ProxmoxDriverException
+from orchestrator.reconciler import reconcile, ClusterSnapshot
+import time
+
+
+class Command(BaseCommand):
+    help = "Periodically reconciles activities, VMs and testers with the Proxmox clusters and stores their sync state"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Run a single pass and exit")
+        parser.add_argument("--interval", type=float,
+                            default=getattr(settings, "ORCHESTRATOR_RECONCILE_INTERVAL", 30),
+                            help="Seconds between two passes")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            # the clusters are read in parallel, the passes then write their states one cluster at a time
+            for cluster, snapshot in fan_out(ClusterSnapshot).items():
+                try:
+                    if isinstance(snapshot, Exception):
+                        raise snapshot
+                    counts = reconcile(cluster, snapshot)
+                except ProxmoxDriverException as e:
+                    self.stderr.write("{cluster}: {error!r}".format(cluster=cluster, error=e))
+                    continue
+                self.stdout.write("{cluster}: {counts}".format(
+                    cluster=cluster, counts=", ".join("{} {}".format(count, key) for key, count in sorted(counts.items()))))
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from orchestrator.jobs import claim_next, run_job
+from orchestrator.warmpool import enqueue_refill
+import time
+
+
+class Command(BaseCommand):
+    help = "Runs the queued orchestrator jobs (VM provisioning and the like) outside of the web workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+        parser.add_argument("--sleep", type=float, default=2, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        refill_interval = getattr(settings, "ORCHESTRATOR_WARM_POOL_REFILL_INTERVAL", 600)
+        next_refill = 0
+        while True:
+            close_old_connections()
+            if time.monotonic() >= next_refill:
+                enqueue_refill()
+                next_refill = time.monotonic() + refill_interval
+            job = claim_next()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["sleep"])
+                continue
+            self.stdout.write("Running {job}".format(job=job))
+            job = run_job(job)
+            self.stdout.write("{job}: {status}".format(job=job, status=job.get_status_display()))
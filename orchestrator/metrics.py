@@ -0,0 +1,265 @@
+from django.conf import settings
+from collections import Counter
+from urllib.parse import urlsplit, unquote
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+import threading
+import time
+import re
+
+"""
+In-process metrics of the Proxmox API traffic.
+
+Every connector method call and every HTTP request it issues is timed into a fixed-bucket histogram, keyed by
+cluster, connector method and endpoint template; failures are counted by error class and cache lookups by layer
+(cache, scope), family and outcome. Requests made by the precondition decorators are attributed to the method
+they guard. Calls of the asyncio client are recorded as async_<method>, tracking the method per task instead of
+per thread. Recording is a dict update under a lock, so it can stay on in production
+(ORCHESTRATOR_METRICS_ENABLED). Each worker process keeps its own registry.
+"""
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+ENDPOINT_PATTERNS = (
+    (re.compile(r"^.*?/api2/json"), ""),
+    (re.compile(r"/nodes/[^/]+"), "/nodes/{node}"),
+    (re.compile(r"/(qemu|lxc)/\d+"), r"/\1/{vmid}"),
+    (re.compile(r"/tasks/[^/]+"), "/tasks/{upid}"),
+    (re.compile(r"/pools/[^/]+"), "/pools/{poolid}"),
+    (re.compile(r"/storage/[^/]+"), "/storage/{storage}"),
+)
+
+_local = threading.local()
+_async_method = ContextVar("orchestrator_async_method", default="")
+
+
+def enabled() -> bool:
+    return getattr(settings, "ORCHESTRATOR_METRICS_ENABLED", True)
+
+
+def endpoint(method: str, url: str) -> str:
+    path = unquote(urlsplit(url).path).rstrip("/")
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return "{method} {path}".format(method=method.upper(), path=path)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.buckets):
+            total += count
+            yield bound, total
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the q-quantile"""
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+        return None
+
+    @property
+    def average(self):
+        return self.sum / self.count if self.count else None
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.call_errors = Counter()
+            self.requests = {}
+            self.request_errors = Counter()
+            self.cache = Counter()
+
+    def observe_call(self, cluster: str, method: str, seconds: float, error: str = None):
+        with self._lock:
+            self.calls.setdefault((cluster, method), Histogram()).observe(seconds)
+            if error:
+                self.call_errors[(cluster, method, error)] += 1
+
+    def observe_request(self, cluster: str, method: str, endpoint: str, seconds: float, error: str = None):
+        with self._lock:
+            self.requests.setdefault((cluster, method, endpoint), Histogram()).observe(seconds)
+            if error:
+                self.request_errors[(cluster, method, endpoint, error)] += 1
+
+    def observe_cache(self, layer: str, cluster: str, family: str, outcome: str):
+        with self._lock:
+            self.cache[(layer, cluster, family, current_method(), outcome)] += 1
+
+    def summary(self) -> dict:
+        """Rows for the admin summary page"""
+        with self._lock:
+            calls = [{"cluster": cluster, "method": method, "count": histogram.count,
+                      "errors": sum(count for key, count in self.call_errors.items() if key[:2] == (cluster, method)),
+                      "average": histogram.average, "p50": histogram.quantile(0.5),
+                      "p95": histogram.quantile(0.95)}
+                     for (cluster, method), histogram in sorted(self.calls.items())]
+            requests = [{"cluster": cluster, "method": method, "endpoint": endpoint, "count": histogram.count,
+                         "errors": sum(count for key, count in self.request_errors.items()
+                                       if key[:3] == (cluster, method, endpoint)),
+                         "average": histogram.average, "p95": histogram.quantile(0.95)}
+                        for (cluster, method, endpoint), histogram in sorted(self.requests.items())]
+            lookups = {}
+            for (layer, cluster, family, method, outcome), count in self.cache.items():
+                row = lookups.setdefault((layer, cluster, family), {"layer": layer, "cluster": cluster,
+                                                                    "family": family, "hit": 0, "stale": 0,
+                                                                    "miss": 0})
+                row[outcome] += count
+            errors = sorted(({"cluster": key[0], "method": key[1], "error": key[2], "count": count}
+                             for key, count in self.call_errors.items()), key=lambda row: -row["count"])
+        for row in lookups.values():
+            total = row["hit"] + row["stale"] + row["miss"]
+            row["hit_rate"] = (row["hit"] + row["stale"]) / total if total else None
+        return {"calls": calls, "requests": requests, "cache": [lookups[key] for key in sorted(lookups)],
+                "errors": errors}
+
+    def render_prometheus(self) -> str:
+        lines = []
+
+        def histogram(name: str, help: str, histograms: dict, labels: tuple):
+            lines.append("# HELP {name} {help}".format(name=name, help=help))
+            lines.append("# TYPE {name} histogram".format(name=name))
+            for key, value in sorted(histograms.items()):
+                label_text = _labels(zip(labels, key))
+                for bound, total in value.cumulative():
+                    lines.append('{name}_bucket{{{labels},le="{le}"}} {total}'.format(
+                        name=name, labels=label_text, le="+Inf" if bound == float("inf") else bound, total=total))
+                lines.append("{name}_sum{{{labels}}} {sum}".format(name=name, labels=label_text, sum=value.sum))
+                lines.append("{name}_count{{{labels}}} {count}".format(name=name, labels=label_text,
+                                                                       count=value.count))
+
+        def counter(name: str, help: str, counts: Counter, labels: tuple):
+            lines.append("# HELP {name} {help}".format(name=name, help=help))
+            lines.append("# TYPE {name} counter".format(name=name))
+            for key, count in sorted(counts.items()):
+                lines.append("{name}{{{labels}}} {count}".format(name=name, labels=_labels(zip(labels, key)),
+                                                                 count=count))
+
+        with self._lock:
+            histogram("orchestrator_proxmox_call_duration_seconds", "Duration of ProxmoxConnector method calls",
+                      self.calls, ("cluster", "method"))
+            counter("orchestrator_proxmox_call_errors_total", "Failed ProxmoxConnector method calls",
+                    self.call_errors, ("cluster", "method", "error"))
+            histogram("orchestrator_proxmox_request_duration_seconds", "Duration of Proxmox API requests",
+                      self.requests, ("cluster", "method", "endpoint"))
+            counter("orchestrator_proxmox_request_errors_total", "Failed Proxmox API requests",
+                    self.request_errors, ("cluster", "method", "endpoint", "error"))
+            counter("orchestrator_proxmox_cache_lookups_total", "Cache and lookup scope lookups",
+                    self.cache, ("layer", "cluster", "family", "method", "outcome"))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs) -> str:
+    return ",".join('{name}="{value}"'.format(
+        name=name, value=str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs)
+
+
+registry = MetricsRegistry()
+
+
+def current_method() -> str:
+    methods = getattr(_local, "methods", None)
+    return methods[-1] if methods else ""
+
+
+def error_class(exception: BaseException) -> str:
+    return type(exception).__name__
+
+
+def instrumented(func):
+    """Time a connector method; nested calls (e.g. made by the if_* decorators) are recorded on their own"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return func(*args, **kwargs)
+        methods = getattr(_local, "methods", None)
+        if methods is None:
+            methods = _local.methods = []
+        methods.append(func.__name__)
+        started = time.perf_counter()
+        error = None
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            error = error_class(e)
+            raise
+        finally:
+            methods.pop()
+            registry.observe_call(args[0].cluster_name, func.__name__, time.perf_counter() - started, error)
+    return wrapper
+
+
+def instrumented_async(func):
+    """instrumented for the coroutine methods of orchestrator.aioproxmox.AsyncProxmoxClient"""
+    name = "async_" + func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not enabled():
+            return await func(*args, **kwargs)
+        token = _async_method.set(name)
+        started = time.perf_counter()
+        error = None
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            error = error_class(e)
+            raise
+        finally:
+            _async_method.reset(token)
+            registry.observe_call(args[0].cluster_name, name, time.perf_counter() - started, error)
+    return wrapper
+
+
+def observe_async_request(cluster: str, method: str, url: str, seconds: float, error: str = None):
+    if enabled():
+        registry.observe_request(cluster, _async_method.get(), endpoint(method, url), seconds, error)
+
+
+def instrument_session(session, cluster: str):
+    """Time every request sent through the (proxmoxer) requests session"""
+    request = session.request
+
+    def timed_request(method, url, *args, **kwargs):
+        if not enabled():
+            return request(method, url, *args, **kwargs)
+        started = time.perf_counter()
+        error = None
+        try:
+            response = request(method, url, *args, **kwargs)
+            if response.status_code >= 400:
+                error = "HTTP{status}".format(status=response.status_code)
+            return response
+        except Exception as e:
+            error = error_class(e)
+            raise
+        finally:
+            registry.observe_request(cluster, current_method(), endpoint(method, url),
+                                     time.perf_counter() - started, error)
+    session.request = timed_request
+    return session
+
+
+def observe_cache(layer: str, cluster: str, family: str, outcome: str):
+    if enabled():
+        registry.observe_cache(layer, cluster, family, outcome)
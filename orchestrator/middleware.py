@@ -0,0 +1,24 @@
+from .scope import lookup_scope
+from .admission import interactive_lane
+
+
+class LookupScopeMiddleware(object):
+    """Share the Proxmox lookups made while serving a request, see orchestrator.scope"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with lookup_scope():
+            return self.get_response(request)
+
+
+class InteractiveLaneMiddleware(object):
+    """Send the Proxmox requests made while serving a page through the interactive lane, see orchestrator.admission"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with interactive_lane():
+            return self.get_response(request)
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.13 on 2026-10-17 09:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0004_virtualmachine_vmid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('provision_activity', 'Creazione VM attività')], max_length=30, verbose_name='Tipo')),
+                ('status', models.CharField(choices=[('pending', 'In coda'), ('running', 'In esecuzione'), ('succeeded', 'Completato'), ('failed', 'Fallito')], db_index=True, default='pending', max_length=10, verbose_name='Stato')),
+                ('progress', models.TextField(blank=True, default='{}', verbose_name='Avanzamento')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Tentativi')),
+                ('max_attempts', models.PositiveIntegerField(default=3, verbose_name='Tentativi massimi')),
+                ('error', models.TextField(blank=True, verbose_name='Errore')),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Eseguire dopo')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Creato il')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Avviato il')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Terminato il')),
+                ('activity', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='orchestrator.Activity', verbose_name='Attività')),
+            ],
+            options={
+                'verbose_name': 'Job',
+                'verbose_name_plural': 'Job',
+                'ordering': ('-created_at',),
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.13 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0005_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarmPoolMetric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('os', models.CharField(choices=[('Win7', 'Windows 7'), ('Win10', 'Windows 10'), ('Kali', 'Kali Linux')], max_length=20, unique=True, verbose_name='Sistema operativo')),
+                ('hits', models.PositiveIntegerField(default=0, verbose_name='VM prese dal warm pool')),
+                ('misses', models.PositiveIntegerField(default=0, verbose_name='VM clonate al momento')),
+                ('refills', models.PositiveIntegerField(default=0, verbose_name='VM rifornite')),
+                ('depleted_since', models.DateTimeField(blank=True, null=True, verbose_name='Incompleto dal')),
+                ('last_refill_lag', models.FloatField(blank=True, null=True, verbose_name='Ultimo tempo di rifornimento (s)')),
+            ],
+            options={
+                'verbose_name': 'Metrica warm pool',
+                'verbose_name_plural': 'Metriche warm pool',
+            },
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('provision_activity', 'Creazione VM attività'), ('refill_warm_pool', 'Rifornimento warm pool')], max_length=30, verbose_name='Tipo'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-17 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0006_warmpoolmetric'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='node',
+            field=models.CharField(blank=True, max_length=40, null=True, verbose_name='Nodo'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0007_virtualmachine_node'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='cluster',
+            field=models.CharField(blank=True, max_length=40, null=True, verbose_name='Cluster'),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='cluster',
+            field=models.CharField(blank=True, max_length=40, null=True, verbose_name='Cluster'),
+        ),
+    ]
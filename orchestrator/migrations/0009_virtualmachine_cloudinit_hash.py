@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0008_cluster'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='cloudinit_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Hash cloud-init'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.13 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import orchestrator.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0009_virtualmachine_cloudinit_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='network',
+            name='subnet',
+            field=models.GenericIPAddressField(blank=True, null=True, protocol='IPv4', verbose_name='Indirizzo di rete'),
+        ),
+        migrations.AddField(
+            model_name='network',
+            name='cidr',
+            field=orchestrator.fields.IntegerRangeField(blank=True, null=True, verbose_name='CIDR'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.13 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0010_network_subnet'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('activity', 'Attività'), ('virtualmachine', 'Macchina virtuale'), ('tester', 'Tester')], max_length=20, verbose_name='Tipo')),
+                ('object_id', models.PositiveIntegerField(verbose_name='ID oggetto')),
+                ('cluster', models.CharField(max_length=40, verbose_name='Cluster')),
+                ('status', models.CharField(choices=[('in_sync', 'Allineato'), ('pending', 'Da creare'), ('missing', 'Mancante su Proxmox'), ('drifted', 'Diverso da Proxmox')], db_index=True, max_length=10, verbose_name='Stato')),
+                ('detail', models.TextField(blank=True, default='{}', verbose_name='Dettagli')),
+                ('input_hash', models.CharField(max_length=64, verbose_name='Hash degli input')),
+                ('checked_at', models.DateTimeField(auto_now=True, verbose_name='Verificato il')),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Cambiato il')),
+            ],
+            options={
+                'verbose_name': 'Stato di sincronizzazione',
+                'verbose_name_plural': 'Stati di sincronizzazione',
+                'unique_together': {('kind', 'object_id', 'cluster')},
+            },
+        ),
+    ]
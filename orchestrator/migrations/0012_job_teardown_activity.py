@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0011_syncstate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('provision_activity', 'Creazione VM attività'), ('refill_warm_pool', 'Rifornimento warm pool'), ('teardown_activity', 'Smantellamento attività')], max_length=30, verbose_name='Tipo'),
+        ),
+    ]
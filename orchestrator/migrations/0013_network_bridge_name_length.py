@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0012_job_teardown_activity'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='network',
+            name='bridge_name',
+            field=models.CharField(max_length=15, unique=True, verbose_name='Nome bridge'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-17 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0013_network_bridge_name_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Lease scade il'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.13 on 2026-10-17 14:00
+
+from django.db import migrations, models
+import orchestrator.clusters
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestrator', '0014_job_lease_expires_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activity',
+            name='cluster',
+            field=models.CharField(blank=True, max_length=40, null=True, validators=[orchestrator.clusters.validate_cluster], verbose_name='Cluster'),
+        ),
+        migrations.AlterField(
+            model_name='virtualmachine',
+            name='cluster',
+            field=models.CharField(blank=True, max_length=40, null=True, validators=[orchestrator.clusters.validate_cluster], verbose_name='Cluster'),
+        ),
+    ]
@@ -1,11 +1,17 @@
 from django.db import models
 from django.utils.text import slugify
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.utils.safestring import mark_safe
+from django.utils import timezone
 import unicodedata
+import json
 import re
 from orchestrator.proxmox import ProxmoxConnector, ProxmoxDriverException
+from orchestrator.inventory import inventory
 from .fields import IntegerRangeField
+from .clusters import validate_cluster, default_cluster
 
 
 class Company(models.Model):
@@ -28,8 +34,13 @@ class Tester(models.Model):
     def apx_has_user_been_created(self):
         return True
 
-    def px_has_user_been_created(self):
-        users = ProxmoxConnector().proxmox.access.users.get()
+    @property
+    def px_userid(self):
+        return "{identifier}@{realm}".format(identifier=slugify(self.tester_identifier),
+                                             realm=getattr(settings, "PROXMOX_USER_REALM", "pve"))
+
+    def px_has_user_been_created(self, cluster=None):
+        return self.px_userid in [user.get('userid') for user in ProxmoxConnector(cluster).get_users()]
 
     def px_create_user(self):
         pass
@@ -63,24 +74,32 @@ class Activity(models.Model):
     target_application_identifier = models.CharField("Codice Applicazione", max_length=10)
     target_application_name = models.CharField("Nome applicazione", max_length=50)
     testers = models.ManyToManyField(Tester, related_name="Attività")
+    cluster = models.CharField("Cluster", null=True, blank=True, max_length=40, validators=[validate_cluster])
+
+    @property
+    def px_pool_id(self):
+        return slugify(self.activity_identifier).upper()
 
     def px_has_pool_been_created(self):
-        pool_id = slugify(self.activity_identifier).upper()
+        pool_id = self.px_pool_id
         try:
-            ProxmoxConnector().get_resource_pool(pool_id)
+            ProxmoxConnector(self.cluster).get_resource_pool(pool_id)
             return True
         except ProxmoxDriverException:
             return False
 
     def px_has_authorizations_been_given(self):
-        pass
+        from .acl import plan
+        result = plan(self.cluster, activities=[self])
+        return not (result.grants or result.missing_users or result.missing_pools)
 
     def px_sync_authorizations(self):
-        pass
+        from .acl import sync
+        return sync(self.cluster, activities=[self])
 
     def px_create_pool(self):
         if not self.px_has_pool_been_created():
-            return ProxmoxConnector().create_resource_pool(
+            return ProxmoxConnector(self.cluster).create_resource_pool(
                 poolid=slugify(self.activity_identifier).upper(),
                 comment='{activity_identifier} - {target_application_identifier} {target_application_name}'.format(
                     activity_identifier=self.activity_identifier,
@@ -94,7 +113,7 @@ class Activity(models.Model):
         if not self.px_has_pool_been_created():
             return False
         else:
-            return ProxmoxConnector().delete_resource_pool(
+            return ProxmoxConnector(self.cluster).delete_resource_pool(
                 poolid=slugify(self.activity_identifier).upper()
             )
 
@@ -107,7 +126,9 @@ class Activity(models.Model):
 
 class Network(models.Model):
     network_description = models.CharField("Descrizione", max_length=20)
-    bridge_name = models.CharField("Nome bridge", unique=True, max_length=5)
+    bridge_name = models.CharField("Nome bridge", unique=True, max_length=15)
+    subnet = models.GenericIPAddressField("Indirizzo di rete", protocol="IPv4", null=True, blank=True)
+    cidr = IntegerRangeField("CIDR", min_value=0, max_value=32, null=True, blank=True)
 
     class Meta:
         verbose_name = "Rete"
@@ -144,6 +165,9 @@ class VirtualMachine(models.Model):
     network = models.ManyToManyField(Network, verbose_name="Reti", related_name="vms", through=VMNet)
     activity = models.ForeignKey(Activity, verbose_name="Attività", related_name="vms", on_delete=models.CASCADE, null=True)
     vmid = models.CharField("VM ID", null=True, blank=True, max_length=7)
+    node = models.CharField("Nodo", null=True, blank=True, max_length=40)
+    cluster = models.CharField("Cluster", null=True, blank=True, max_length=40, validators=[validate_cluster])
+    cloudinit_hash = models.CharField("Hash cloud-init", null=True, blank=True, max_length=64, editable=False)
 
     def __str__(self):
         return "{activity} - {name}".format(name=self.name, activity=self.activity) if self.activity else self.name
@@ -157,16 +181,37 @@ class VirtualMachine(models.Model):
         hostname = re.sub(r'^[^a-z]*|[^a-z1-9]*?$', '', hostname)
         return mark_safe(hostname)
 
+    @property
+    def px_cluster(self):
+        """The activity pool and placement decide where a VM lives, cluster only applies to VMs without activity"""
+        return self.activity.cluster if self.activity else self.cluster
+
+    def clean(self):
+        super().clean()
+        if self.activity and self.cluster and self.cluster != (self.activity.cluster or default_cluster()):
+            raise ValidationError({"cluster": "La VM deve stare sul cluster dell'attività ({cluster})".format(
+                cluster=self.activity.cluster or default_cluster())})
+
     def px_has_vm_been_created(self):
         if not self.vmid:
             return False
         else:
             try:
-                ProxmoxConnector().get_vm(self.vmid)
-                return True
+                return inventory.snapshot(self.px_cluster).has_vm(self.vmid)
             except ProxmoxDriverException:
                 return False
 
+    def px_status(self):
+        """running, stopped, locked or missing, None when the VM has not been created yet"""
+        if not self.vmid:
+            return None
+        vm = inventory.snapshot(self.px_cluster).get_vm(self.vmid)
+        if vm is None:
+            return "missing"
+        if vm.get('lock'):
+            return "locked"
+        return vm.get('status')
+
     def px_create_vm(self):
         if not self.px_has_vm_been_created():
             """
@@ -181,13 +226,127 @@ class VirtualMachine(models.Model):
             8 - Attach additional storage
             9 - Save vmid in this object
             """
-            
+            import taskflow.engines
+            from .vm_creation_flow import vm_creation_flow
+            return taskflow.engines.run(vm_creation_flow, store={'vm': self})['vmid']
         else:
             return False
 
     def px_destroy_vm(self):
-        pass
+        """Stop and destroy the VM with its disks, see orchestrator.teardown"""
+        from .teardown import destroy_vm
+        if not self.vmid:
+            return False
+        destroy_vm(ProxmoxConnector(self.px_cluster), self.vmid)
+        self.vmid = self.node = self.cloudinit_hash = None
+        self.save(update_fields=["vmid", "node", "cloudinit_hash"])
+        return True
 
     class Meta:
         verbose_name = "Macchina virtuale"
-        verbose_name_plural = "Macchine virtuali"
\ No newline at end of file
+        verbose_name_plural = "Macchine virtuali"
+
+
+class Job(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUSES = (
+        (PENDING, "In coda"),
+        (RUNNING, "In esecuzione"),
+        (SUCCEEDED, "Completato"),
+        (FAILED, "Fallito"),
+    )
+    KINDS = (
+        ("provision_activity", "Creazione VM attività"),
+        ("refill_warm_pool", "Rifornimento warm pool"),
+        ("teardown_activity", "Smantellamento attività"),
+    )
+    kind = models.CharField("Tipo", choices=KINDS, max_length=30)
+    activity = models.ForeignKey(Activity, verbose_name="Attività", related_name="jobs", on_delete=models.CASCADE,
+                                 null=True, blank=True)
+    status = models.CharField("Stato", choices=STATUSES, default=PENDING, max_length=10, db_index=True)
+    progress = models.TextField("Avanzamento", default="{}", blank=True)
+    attempts = models.PositiveIntegerField("Tentativi", default=0)
+    max_attempts = models.PositiveIntegerField("Tentativi massimi", default=3)
+    error = models.TextField("Errore", blank=True)
+    run_after = models.DateTimeField("Eseguire dopo", default=timezone.now)
+    created_at = models.DateTimeField("Creato il", auto_now_add=True)
+    started_at = models.DateTimeField("Avviato il", null=True, blank=True)
+    finished_at = models.DateTimeField("Terminato il", null=True, blank=True)
+    lease_expires_at = models.DateTimeField("Lease scade il", null=True, blank=True)
+
+    @property
+    def steps(self):
+        return json.loads(self.progress or "{}")
+
+    def __str__(self):
+        return "{kind} #{pk}".format(kind=self.get_kind_display(), pk=self.pk)
+
+    class Meta:
+        verbose_name = "Job"
+        verbose_name_plural = "Job"
+        ordering = ("-created_at",)
+
+
+class WarmPoolMetric(models.Model):
+    os = models.CharField("Sistema operativo", choices=VirtualMachine.OSS, max_length=20, unique=True)
+    hits = models.PositiveIntegerField("VM prese dal warm pool", default=0)
+    misses = models.PositiveIntegerField("VM clonate al momento", default=0)
+    refills = models.PositiveIntegerField("VM rifornite", default=0)
+    depleted_since = models.DateTimeField("Incompleto dal", null=True, blank=True)
+    last_refill_lag = models.FloatField("Ultimo tempo di rifornimento (s)", null=True, blank=True)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def __str__(self):
+        return self.get_os_display()
+
+    class Meta:
+        verbose_name = "Metrica warm pool"
+        verbose_name_plural = "Metriche warm pool"
+
+
+class SyncState(models.Model):
+    """Outcome of the last reconciliation of a model object against its cluster, see orchestrator.reconciler"""
+    IN_SYNC = "in_sync"
+    PENDING = "pending"
+    MISSING = "missing"
+    DRIFTED = "drifted"
+    STATUSES = (
+        (IN_SYNC, "Allineato"),
+        (PENDING, "Da creare"),
+        (MISSING, "Mancante su Proxmox"),
+        (DRIFTED, "Diverso da Proxmox"),
+    )
+    KINDS = (
+        ("activity", "Attività"),
+        ("virtualmachine", "Macchina virtuale"),
+        ("tester", "Tester"),
+    )
+    kind = models.CharField("Tipo", choices=KINDS, max_length=20)
+    object_id = models.PositiveIntegerField("ID oggetto")
+    cluster = models.CharField("Cluster", max_length=40)
+    status = models.CharField("Stato", choices=STATUSES, max_length=10, db_index=True)
+    detail = models.TextField("Dettagli", default="{}", blank=True)
+    input_hash = models.CharField("Hash degli input", max_length=64)
+    checked_at = models.DateTimeField("Verificato il", auto_now=True)
+    changed_at = models.DateTimeField("Cambiato il", default=timezone.now)
+
+    @property
+    def details(self):
+        return json.loads(self.detail or "{}")
+
+    def __str__(self):
+        return "{kind} #{object_id} @ {cluster}: {status}".format(kind=self.get_kind_display(),
+                                                                  object_id=self.object_id, cluster=self.cluster,
+                                                                  status=self.get_status_display())
+
+    class Meta:
+        verbose_name = "Stato di sincronizzazione"
+        verbose_name_plural = "Stati di sincronizzazione"
+        unique_together = (("kind", "object_id", "cluster"),)
@@ -0,0 +1,108 @@
+from .aioproxmox import bridge
+from .cache import read_through
+from .clusters import fan_out
+from .inventory import inventory
+from .proxmox import ProxmoxDriverException, ProxmoxNotConnectedException, default_node
+import hashlib
+import json
+import time
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Index of the networks a NIC can be attached to, served by the pxe_networks view.
+
+The bridges and VLAN interfaces of every online node and the SDN vnets of the cluster are read concurrently and
+merged into one sorted list, where an interface found on several nodes appears once. The list is cached per
+cluster as the "network_index" family together with its digest and build time, which the view sends as ETag and
+Last-Modified. A build where no node could be read raises instead of caching an empty list. Networks are not tied
+to a cluster, so the view offers the indexes of every cluster merged.
+"""
+
+INTERFACE_TYPES = ("any_bridge", "vlan")
+
+
+class NetworkIndex(object):
+
+    def __init__(self, entries: list, built_at: int = None):
+        self.entries = sorted(entries, key=lambda entry: entry["id"])
+        self.built_at = built_at or int(time.time())
+        self.digest = hashlib.sha1(json.dumps(self.entries, sort_keys=True).encode()).hexdigest()
+
+    def search(self, term: str = "", exclude=()) -> list:
+        term = (term or "").strip().lower()
+        return [entry for entry in self.entries
+                if entry["id"] not in exclude and (not term or term in entry["text"].lower())]
+
+
+def _entry(iface: str, kind: str, nodes, zone: str = None) -> dict:
+    if kind == "vnet":
+        text = "{vnet} (SDN, zona {zone})".format(vnet=iface, zone=zone)
+    else:
+        text = "{iface} ({kind}, {nodes})".format(iface=iface, kind=kind, nodes=", ".join(sorted(nodes)))
+    return {"id": iface, "kind": kind, "nodes": sorted(nodes), "zone": zone, "text": text}
+
+
+def _online_nodes(cluster: str) -> list:
+    nodes = [name for name, node in inventory.snapshot(cluster).nodes.items() if node.get("status") == "online"]
+    return sorted(nodes) or [default_node(cluster=cluster)]
+
+
+def build_index(cluster: str) -> NetworkIndex:
+    client = bridge.client(cluster)
+    calls = [(node, kind) for node in _online_nodes(cluster) for kind in INTERFACE_TYPES]
+    results = bridge.gather([client.get_interfaces_list(node=node, type=kind) for node, kind in calls] +
+                            [client.get_sdn_vnets()], return_exceptions=True)
+    interfaces = {}
+    for (node, kind), result in zip(calls, results):
+        if isinstance(result, Exception):
+            logger.warning("Could not list the %s interfaces of node %s: %s", kind, node, result)
+            continue
+        for interface in result or []:
+            iface = interface.get("iface")
+            if iface:
+                interfaces.setdefault(iface, (interface.get("type", kind), set()))[1].add(node)
+    failures = [result for result in results[:-1] if isinstance(result, Exception)]
+    if calls and len(failures) == len(calls):
+        if all(isinstance(failure, ProxmoxNotConnectedException) for failure in failures):
+            raise ProxmoxNotConnectedException(str(failures[0]))
+        raise ProxmoxDriverException("Could not list the networks of {cluster}: {error}".format(
+            cluster=cluster, error=failures[0]))
+    entries = [_entry(iface, kind, nodes) for iface, (kind, nodes) in interfaces.items()]
+    vnets = results[-1]
+    if isinstance(vnets, Exception):
+        # SDN is optional (PVE 6.2+ with libpve-network-perl installed)
+        logger.debug("SDN vnets not available: %s", vnets)
+        vnets = []
+    for vnet in vnets or []:
+        if vnet.get("vnet") and vnet["vnet"] not in interfaces:
+            entries.append(_entry(vnet["vnet"], "vnet", [], zone=vnet.get("zone")))
+    return NetworkIndex(entries)
+
+
+def merge(indexes: dict) -> NetworkIndex:
+    """One index out of cluster -> index, the nodes being named cluster/node"""
+    merged = {}
+    for cluster, index in sorted(indexes.items()):
+        for entry in index.entries:
+            nodes = ["{cluster}/{node}".format(cluster=cluster, node=node) for node in entry["nodes"]]
+            if entry["id"] in merged:
+                nodes += merged[entry["id"]]["nodes"]
+            merged[entry["id"]] = _entry(entry["id"], entry["kind"], nodes, zone=entry.get("zone"))
+    return NetworkIndex(list(merged.values()), built_at=max(index.built_at for index in indexes.values()))
+
+
+def network_index(cluster: str = None) -> NetworkIndex:
+    """The index of the cluster, or without one the indexes of all the clusters (read in parallel) merged"""
+    if cluster:
+        return read_through("network_index", loader=lambda: build_index(cluster), namespace=cluster)
+    results = fan_out(network_index)
+    indexes = {}
+    for name, result in results.items():
+        if isinstance(result, Exception):
+            logger.warning("Networks of %s not offered: %s", name, result)
+        else:
+            indexes[name] = result
+    if not indexes:
+        raise next(iter(results.values()))
+    return next(iter(indexes.values())) if len(results) == 1 else merge(indexes)
@@ -0,0 +1,100 @@
+from django.conf import settings
+from collections import Counter
+from .proxmox import ProxmoxDriverException
+
+"""
+Chooses the node that will host each new VM from the free RAM, CPU load and storage headroom reported by
+/cluster/resources.
+
+The scheduler works on a plain model of the cluster built from the resources list, so it can be fed the live
+inventory or a hand written fake cluster. Every placement reserves its RAM and cores in the model, so placing
+a whole activity in one go stays consistent.
+"""
+
+SPREAD = "spread"
+BINPACK = "binpack"
+MB = 1024 * 1024
+
+
+class NodeCapacity(object):
+
+    def __init__(self, name: str, maxmem: int, mem: int, maxcpu: int, cpu: float, storages: dict = None):
+        self.name = name
+        self.free_mem = maxmem - mem
+        self.maxmem = maxmem
+        self.maxcpu = maxcpu
+        self.cpu_load = cpu
+        self.allocated_cores = 0
+        self.storages = storages or {}
+
+    @property
+    def mem_ratio(self) -> float:
+        return self.free_mem / self.maxmem if self.maxmem else 0
+
+    @property
+    def cpu_ratio(self) -> float:
+        return self.cpu_load + (self.allocated_cores / self.maxcpu if self.maxcpu else 1)
+
+    def fits(self, ram_mb: int, storage: str = None, min_storage_free: int = 0) -> bool:
+        if self.free_mem - getattr(settings, "PROXMOX_PLACEMENT_RESERVED_RAM", 1024) * MB < ram_mb * MB:
+            return False
+        if storage and self.storages.get(storage, 0) < min_storage_free:
+            return False
+        return True
+
+    def reserve(self, ram_mb: int, cores: int):
+        self.free_mem -= ram_mb * MB
+        self.allocated_cores += cores
+
+
+def cluster_model(resources: list) -> dict:
+    """node name -> NodeCapacity for the online nodes found in a /cluster/resources list"""
+    storages = {}
+    for resource in resources:
+        if resource.get('type') == 'storage' and resource.get('status', 'available') == 'available':
+            storages.setdefault(resource['node'], {})[resource['storage']] = \
+                resource.get('maxdisk', 0) - resource.get('disk', 0)
+    return {
+        resource['node']: NodeCapacity(resource['node'], resource.get('maxmem', 0), resource.get('mem', 0),
+                                       resource.get('maxcpu', 1), resource.get('cpu', 0),
+                                       storages.get(resource['node']))
+        for resource in resources
+        if resource.get('type') == 'node' and resource.get('status') == 'online'
+    }
+
+
+class PlacementScheduler(object):
+
+    def __init__(self, nodes: dict, strategy: str = None, storage: str = None, activity_vms: dict = None):
+        """
+        nodes: node name -> NodeCapacity, see cluster_model
+        activity_vms: activity pool -> Counter of node names already hosting that activity's VMs (anti-affinity)
+        """
+        self.nodes = nodes
+        self.strategy = strategy or getattr(settings, "PROXMOX_PLACEMENT_STRATEGY", SPREAD)
+        self.storage = storage if storage is not None else getattr(settings, "PROXMOX_CLONE_STORAGE", None)
+        self.min_storage_free = getattr(settings, "PROXMOX_PLACEMENT_MIN_STORAGE_FREE", 20 * 1024 * MB)
+        self.activity_vms = activity_vms if activity_vms is not None else {}
+
+    @classmethod
+    def from_inventory(cls, snapshot, **kwargs):
+        resources = list(snapshot.nodes.values()) + list(snapshot.storages.values())
+        activity_vms = {pool: Counter(vm.get('node') for vm in vms) for pool, vms in snapshot.by_pool.items()}
+        return cls(cluster_model(resources), activity_vms=activity_vms, **kwargs)
+
+    def _score(self, node: NodeCapacity, ram_mb: int):
+        if self.strategy == BINPACK:
+            # the fullest node that still fits
+            return node.free_mem - ram_mb * MB
+        return -node.mem_ratio + node.cpu_ratio
+
+    def place(self, ram_mb: int, cores: int, activity: str = None) -> str:
+        candidates = [node for node in self.nodes.values()
+                      if node.fits(ram_mb, self.storage, self.min_storage_free)]
+        if not candidates:
+            raise ProxmoxDriverException("No node can host a VM with {ram} MB of RAM".format(ram=ram_mb))
+        siblings = self.activity_vms.setdefault(activity, Counter()) if activity else Counter()
+        node = min(candidates, key=lambda node: (siblings[node.name], self._score(node, ram_mb), node.name))
+        node.reserve(ram_mb, cores)
+        siblings[node.name] += 1
+        return node.name
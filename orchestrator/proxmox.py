@@ -1,10 +1,21 @@
 from django.conf import settings
 from proxmoxer import ProxmoxAPI
 from proxmoxer.core import ResourceException
-from django.core.cache import cache
-from requests.exceptions import ConnectionError, ConnectTimeout
-from singletonify import singleton
-import random
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, ReadTimeout, RequestException
+from .cache import read_through, invalidate
+from .clusters import cluster_settings, default_cluster
+from .vmconfig import VMConfigBuilder
+from .scope import memoized, forget
+from .metrics import instrumented, instrument_session
+from .admission import admit_session
+from .resilience import resilient_session, breaker_for, classify, LOCKED, TRANSIENT
+from .cloudinit.media import build_iso, write_snippets, content_hash
+from functools import wraps
+from urllib.parse import quote
+import threading
+import time
+import re
 import logging
 logger = logging.getLogger("orchestrator")
 
@@ -17,21 +28,60 @@ class ProxmoxNotConnectedException(ProxmoxDriverException):
     pass
 
 
+class ProxmoxTransientError(ProxmoxDriverException):
+    """The call failed for a reason that may go away by itself, and still failed after the retries"""
+
+
+class ProxmoxLockedError(ProxmoxTransientError):
+    pass
+
+
+class ProxmoxPermanentError(ProxmoxDriverException):
+    pass
+
+
+CONNECTION_ERRORS = (ConnectionError,
+                     ConnectionRefusedError,
+                     ConnectionAbortedError,
+                     ConnectionResetError,
+                     ConnectTimeout,
+                     ReadTimeout)
+
+
+def default_node(node: str = None, cluster: str = None) -> str:
+    """Resolved at call time, so that settings overrides and placement decisions are honoured"""
+    return node or cluster_settings(cluster)["NODE_NAME"]
+
+
 def if_reachable(func):
+    """
+    Requests are retried and each node is guarded by a circuit breaker at session level (orchestrator.resilience),
+    so a connection error reaching this point is final for this call only and does not mark the cluster unreachable
+    """
+    @instrumented
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        if cache.get_or_set("proxmox_reachable", args[0].reachable, 15) is True:
-            return func(*args, **kwargs)
-        else:
+        connector = args[0]
+        if not connector.reachable():
             raise ProxmoxNotConnectedException
+        try:
+            return func(*args, **kwargs)
+        except CONNECTION_ERRORS as e:
+            raise ProxmoxNotConnectedException(str(e)) from e
     return wrapper
 
 
-def if_vm_exists(arg_name, node=settings.PROXMOX_NODE_NAME):
+def if_vm_exists(arg_name, node=None):
     def first_level_wrapper(func):
+        @wraps(func)
         def sec_level_wrapper(*args, **kwargs):
             if not arg_name in kwargs:
                 raise ValueError("{} not specified".format(arg_name))
-            if args[0].nodes(node).qemu(kwargs[arg_name]).get():
+            vmid = kwargs[arg_name]
+            vm_node = kwargs.get('node') or default_node(node, args[0].cluster_name)
+            # fresh: the memoized config is the one VMConfigBuilder diffs against
+            if memoized(('vm_config', args[0].cluster_name, vm_node, vmid),
+                        lambda: args[0].get_vm_config(vmid, node=vm_node, fresh=True)):
                 return func(*args, **kwargs)
             else:
                 raise ProxmoxDriverException
@@ -39,12 +89,16 @@ def if_vm_exists(arg_name, node=settings.PROXMOX_NODE_NAME):
     return first_level_wrapper
 
 
-def if_network_interface_exists(arg_name, type='bridge', node=settings.PROXMOX_NODE_NAME):
+def if_network_interface_exists(arg_name, type='bridge', node=None):
     def first_level_wrapper(func):
+        @wraps(func)
         def sec_level_wrapper(*args, **kwargs):
             if not arg_name in kwargs:
                 raise ValueError("{} not specified".format(arg_name))
-            if [1 for it in args[0].get_interfaces_list(type=type, node=node) if it['iface'] == kwargs[arg_name]]:
+            iface_node = kwargs.get('node') or default_node(node, args[0].cluster_name)
+            interfaces = memoized(('interfaces', args[0].cluster_name, iface_node, type),
+                                  lambda: args[0].get_interfaces_list(type=type, node=iface_node))
+            if [1 for it in interfaces if it['iface'] == kwargs[arg_name]]:
                 return func(*args, **kwargs)
             else:
                 raise ProxmoxDriverException("Network does not exists")
@@ -52,8 +106,9 @@ def if_network_interface_exists(arg_name, type='bridge', node=settings.PROXMOX_N
     return first_level_wrapper
 
 
-def if_vm_has_network(vm_arg_name, net_arg_name, node=settings.PROXMOX_NODE_NAME):
+def if_vm_has_network(vm_arg_name, net_arg_name, node=None):
     def first_level_wrapper(func):
+        @wraps(func)
         def sec_level_wrapper(*args, **kwargs):
             if not vm_arg_name in kwargs:
                 raise ValueError("{} not specified".format(vm_arg_name))
@@ -61,7 +116,9 @@ def if_vm_has_network(vm_arg_name, net_arg_name, node=settings.PROXMOX_NODE_NAME
                 raise ValueError("{} not specified".format(net_arg_name))
             vmid = kwargs[vm_arg_name]
             network = kwargs[net_arg_name]
-            if network in args[0].nodes(node).qemu(vmid).config.get():
+            vm_node = kwargs.get('node') or default_node(node, args[0].cluster_name)
+            if network in memoized(('vm_config', args[0].cluster_name, vm_node, vmid),
+                                   lambda: args[0].get_vm_config(vmid, node=vm_node, fresh=True)):
                 return func(*args, **kwargs)
             else:
                 raise ProxmoxDriverException("VM {vm} has not a nic named {network}".format(vm=vmid,
@@ -71,116 +128,329 @@ def if_vm_has_network(vm_arg_name, net_arg_name, node=settings.PROXMOX_NODE_NAME
 
 def if_resource_pool_exists(rpool_arg_name:str, exists:bool):
     def first_level_wrapper(func):
+        @wraps(func)
         def sec_level_wrapper(*args, **kwargs):
             if not rpool_arg_name in kwargs:
                 raise ValueError("{} not specified".format(rpool_arg_name))
             rpool = kwargs[rpool_arg_name]
-            if (rpool in [pool.get('poolid') for pool in args[0].pools.get()]) == exists:
+            pools = memoized(('pools', args[0].cluster_name), args[0].get_pools)
+            if (rpool in [pool.get('poolid') for pool in pools]) == exists:
                 return func(*args, **kwargs)
             else:
                 raise ProxmoxDriverException("Pool {poolid} {exists}".format(poolid=rpool, exists="doesn't exist" if exists else "already exists"))
         return sec_level_wrapper
     return first_level_wrapper
 
+def translate_resource_exception(e: ResourceException) -> ProxmoxDriverException:
+    """proxmoxer messages start with the HTTP status, followed by the reason sent by PVE"""
+    match = re.match(r"(\d{3})", str(e))
+    kind = classify(int(match.group(1)) if match else 0, str(e))
+    if kind == LOCKED:
+        return ProxmoxLockedError(str(e))
+    if kind == TRANSIENT:
+        return ProxmoxTransientError(str(e))
+    return ProxmoxPermanentError(str(e))
+
+
 def trap_resource_exception(func):
+    @wraps(func)
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except ResourceException as e:
-            raise ProxmoxDriverException("Resource not found or already exists") from e
+            raise translate_resource_exception(e) from e
     return wrapper
 
 
-@singleton
 class ProxmoxConnector(ProxmoxAPI):
-
-    def __init__(self):
-        """Do nothing"""
-
+    """One connector per cluster: ProxmoxConnector(cluster) always returns the same instance for that cluster"""
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __new__(cls, cluster: str = None):
+        cluster = cluster or default_cluster()
+        with cls._instances_lock:
+            if cluster not in cls._instances:
+                instance = super(ProxmoxConnector, cls).__new__(cls)
+                instance._setup(cluster)
+                cls._instances[cluster] = instance
+            return cls._instances[cluster]
+
+    def __init__(self, cluster: str = None):
+        """Instances are set up once by __new__"""
+
+    def _setup(self, cluster: str):
+        """
+        The session is opened lazily by reachable() and then kept for the whole process lifetime:
+        the PVE ticket is renewed in background and reachability is tracked from the outcome of real requests.
+        """
+        self.cluster_name = cluster
+        self._lock = threading.RLock()
+        self._connected = False
+        self._last_attempt = 0
+        self._nextid_lock = threading.Lock()
+        self._renewal_timer = None
+
+    def _read(self, family: str, *parts, loader=None):
+        return read_through(family, *parts, loader=loader, namespace=self.cluster_name)
+
+    def _invalidate(self, family: str, *parts):
+        invalidate(family, *parts, namespace=self.cluster_name)
+
+    @instrumented
     def connection_attempt(self):
-        ProxmoxAPI.__init__(self, settings.PROXMOX_URL, user=settings.PROXMOX_USER, password=settings.PROXMOX_PWD,
-                            verify_ssl=settings.PROXMOX_VERIFY_SSL, port=getattr(settings, "PROXMOX_PORT", 8006))
+        config = cluster_settings(self.cluster_name)
+        ProxmoxAPI.__init__(self, config["URL"], user=config["USER"], password=config["PWD"],
+                            verify_ssl=config["VERIFY_SSL"], port=config["PORT"])
+        pool_size = getattr(settings, "PROXMOX_HTTP_POOL_SIZE", 10)
+        self._store["session"].mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        instrument_session(self._store["session"], self.cluster_name)
+        admit_session(self._store["session"], self.cluster_name)
+        resilient_session(self._store["session"], self.cluster_name)
+        self._schedule_ticket_renewal()
+        if getattr(settings, "PROXMOX_EVENT_WATCHER", False):
+            from .events import watcher_for
+            watcher_for(self.cluster_name).start()
+
+    def _schedule_ticket_renewal(self):
+        if self._renewal_timer:
+            self._renewal_timer.cancel()
+        self._renewal_timer = threading.Timer(getattr(settings, "PROXMOX_TICKET_RENEWAL_INTERVAL", 3600),
+                                              self.renew_ticket)
+        self._renewal_timer.daemon = True
+        self._renewal_timer.start()
+
+    @instrumented
+    def renew_ticket(self):
+        """PVE tickets expire after two hours, a valid ticket can be exchanged for a new one used as password"""
+        session = self._store["session"]
+        try:
+            # ProxmoxHttpSession.request has no json argument, so requests' post() helper cannot be used
+            response = session.request("POST", self._store["base_url"] + "/access/ticket",
+                                       data={"username": cluster_settings(self.cluster_name)["USER"],
+                                             "password": session.auth.pve_auth_cookie})
+            response.raise_for_status()
+            data = response.json()["data"]
+            session.cookies.set("PVEAuthCookie", data["ticket"])
+            session.auth.pve_auth_cookie = data["ticket"]
+            session.auth.csrf_prevention_token = data["CSRFPreventionToken"]
+            self._schedule_ticket_renewal()
+        except (RequestException, KeyError, ValueError):
+            logger.exception("Proxmox ticket renewal failed, a new login will be performed on next request")
+            with self._lock:
+                self._connected = False
 
     def reachable(self):
-        try:
-            self.connection_attempt()
+        """
+        Logged in, and the breaker guarding the cluster-wide endpoints is not suspending requests: once the session
+        exists, reachability follows the outcome of the real requests seen by orchestrator.resilience
+        """
+        if self._connected:
+            return not breaker_for(self.cluster_name, "cluster").suspended
+        with self._lock:
+            if self._connected:
+                return True
+            if time.time() - self._last_attempt < getattr(settings, "PROXMOX_RECONNECT_INTERVAL", 15):
+                return False
+            self._last_attempt = time.time()
+            try:
+                self.connection_attempt()
+                self._connected = True
+            except CONNECTION_ERRORS:
+                return False
             return True
-        except (ConnectionError,
-                ConnectionRefusedError,
-                ConnectionAbortedError,
-                ConnectionResetError,
-                ConnectTimeout):
-            return False
 
     @if_reachable
     @trap_resource_exception
-    def get_interfaces_list(self, node=settings.PROXMOX_NODE_NAME, type='bridge'):
-        return cache.get_or_set('network_bridges_{node}'.format(node=node), self.nodes(node).network.get(type=type), 20)
+    def get_interfaces_list(self, node=None, type='bridge'):
+        node = default_node(node, self.cluster_name)
+        return self._read('interfaces', node, type, loader=lambda: self.nodes(node).network.get(type=type))
+
+    @if_reachable
+    @trap_resource_exception
+    def get_vms(self, node=None):
+        node = default_node(node, self.cluster_name)
+        return self._read('vms', node, loader=lambda: self.nodes(node).qemu.get())
+
+    @if_reachable
+    @trap_resource_exception
+    def get_vm(self, vmid: str, node: str=None):
+        node = default_node(node, self.cluster_name)
+        return self._read('vm', node, vmid, loader=lambda: self.nodes(node).qemu(vmid).get())
 
     @if_reachable
     @trap_resource_exception
-    def get_vms(self, node=settings.PROXMOX_NODE_NAME):
-        return cache.get_or_set('vms_{node}'.format(node=node), self.nodes(node).qemu.get())
+    def get_vm_config(self, vmid: str, node: str=None, fresh: bool = False):
+        """fresh skips the cached config (refreshing it), for callers about to write a change computed from it"""
+        node = default_node(node, self.cluster_name)
+        if fresh:
+            self._invalidate('vm_config', node, vmid)
+        return self._read('vm_config', node, vmid, loader=lambda: self.nodes(node).qemu(vmid).config.get())
 
     @if_reachable
     @trap_resource_exception
-    def get_vm(self, vmid: str, node: str=settings.PROXMOX_NODE_NAME):
-        return cache.get_or_set('vm_{vmid}'.format(vmid=vmid, node=node), self.nodes(node).qemu(vmid).get(),10)
+    def get_cluster_resources(self):
+        return self.cluster.resources.get()
 
     @if_reachable
     @trap_resource_exception
-    def clone_vm(self, name, template, node=settings.PROXMOX_NODE_NAME, pool=None):
-        next_id = self.cluster.nextid.get()
-        self.nodes(node).qemu(template).clone.create(newid=next_id, name=name, pool=pool)
+    def get_pools(self):
+        return self._read('pools', loader=lambda: self.pools.get())
+
+    @if_reachable
+    @trap_resource_exception
+    def get_users(self):
+        return self._read('users', loader=lambda: self.access.users.get())
+
+    @if_reachable
+    @trap_resource_exception
+    def get_acl(self):
+        return self._read('acl', loader=lambda: self.access.acl.get())
+
+    @if_reachable
+    @trap_resource_exception
+    def get_cluster_tasks(self):
+        return self.cluster.tasks.get()
+
+    @if_reachable
+    @trap_resource_exception
+    def get_cluster_log(self, max: int = 50):
+        return self.cluster.log.get(max=max)
+
+    @if_reachable
+    @trap_resource_exception
+    def get_task_status(self, upid: str, node: str=None):
+        node = default_node(node, self.cluster_name)
+        return self.nodes(node).tasks(upid).status.get()
+
+    @if_reachable
+    @trap_resource_exception
+    def clone_vm_async(self, name, template, node=None, pool=None, target=None):
+        """
+        Start the clone and return the new vmid along with a Future resolved when the clone task ends.
+        node is where the template lives, target the node that will host the clone (same node when omitted).
+        """
+        node = default_node(node, self.cluster_name)
+        from .upid import tracker_for
+        options = {'target': target} if target and target != node else {}
+        attempts = getattr(settings, "PROXMOX_CLONE_ID_ATTEMPTS", 3)
+        # /cluster/nextid hands out the same id until the clone has created its config: ids are taken one at a
+        # time in this process, and taken again when another process got the same one first
+        with self._nextid_lock:
+            for attempt in range(attempts):
+                next_id = self.cluster.nextid.get()
+                try:
+                    upid = self.nodes(node).qemu(template).clone.create(newid=next_id, name=name, pool=pool,
+                                                                         **options)
+                    break
+                except ResourceException as e:
+                    if "already exists" not in str(e) or attempt + 1 >= attempts:
+                        raise
+                    logger.warning("VM id %s of %s taken meanwhile, asking for another one", next_id,
+                                   self.cluster_name)
+        self._invalidate('vms', node)
+        self._invalidate('vms', target or node)
+        self._invalidate('pool')
+        self._invalidate('inventory')
+        return next_id, tracker_for(self.cluster_name).track(upid)
+
+    @instrumented
+    def clone_vm(self, name, template, node=None, pool=None, target=None):
+        from .upid import task_result
+        next_id, task = self.clone_vm_async(name, template, node=node, pool=pool, target=target)
+        task_result(task)
         return next_id
 
     @if_reachable
     @trap_resource_exception
-    def assign_ram(self, vmid, maxram, minram=settings.PROXMOX_VM_MIN_RAM, node=settings.PROXMOX_NODE_NAME):
-        self.nodes(node).qemu(vmid).config.post(balloon=minram, memory=maxram)
+    def configure_vm(self, vmid, node=None) -> VMConfigBuilder:
+        """Read the VM config once; changes collected on the builder are written by a single apply()"""
+        node = default_node(node, self.cluster_name)
+        return VMConfigBuilder(self, vmid, node)
+
+    @if_reachable
+    @trap_resource_exception
+    def assign_ram(self, vmid, maxram, minram=None, node=None):
+        node = default_node(node, self.cluster_name)
+        minram = settings.PROXMOX_VM_MIN_RAM if minram is None else minram
+        self.configure_vm(vmid, node=node).memory(maxram, minram).apply()
         return vmid
 
     @if_reachable
     @trap_resource_exception
-    def set_cores(self, vmid, cores, node=settings.PROXMOX_NODE_NAME):
-        self.nodes(node).qemu(vmid).config.post(cores=cores)
+    def set_cores(self, vmid, cores, node=None):
+        node = default_node(node, self.cluster_name)
+        self.configure_vm(vmid, node=node).cores(cores).apply()
         return vmid
 
+    @if_reachable
+    @trap_resource_exception
+    def stop_vm_async(self, vmid=None, node=None):
+        """Hard stop, returns a Future resolved when the stop task ends"""
+        from .upid import tracker_for
+        node = default_node(node, self.cluster_name)
+        upid = self.nodes(node).qemu(vmid).status.stop.post()
+        self._invalidate('vm', node, vmid)
+        self._invalidate('inventory')
+        return tracker_for(self.cluster_name).track(upid)
+
+    @if_reachable
+    @trap_resource_exception
+    def delete_vm_async(self, vmid=None, node=None, purge=False):
+        """
+        Destroy without a prior existence check (a missing VM makes the call fail), returns a Future resolved
+        when the destroy task ends. purge also drops the VM from ACLs, backup and replication jobs and removes
+        the disks not referenced by its config (PROXMOX_DESTROY_UNREFERENCED_DISKS, PVE 7+).
+        """
+        from .upid import tracker_for
+        node = default_node(node, self.cluster_name)
+        options = {}
+        if purge:
+            options['purge'] = 1
+            if getattr(settings, "PROXMOX_DESTROY_UNREFERENCED_DISKS", True):
+                options['destroy-unreferenced-disks'] = 1
+        upid = self.nodes(node).qemu(vmid).delete(**options)
+        forget(('vm_config', self.cluster_name, node, vmid))
+        self._invalidate('vm', node, vmid)
+        self._invalidate('vm_config', node, vmid)
+        self._invalidate('vms', node)
+        self._invalidate('pool')
+        self._invalidate('inventory')
+        return tracker_for(self.cluster_name).track(upid)
+
     @if_reachable
     @trap_resource_exception
     @if_vm_exists("vmid")
-    def delete_vm(self, vmid=None, node=settings.PROXMOX_NODE_NAME):
+    def delete_vm(self, vmid=None, node=None):
+        node = default_node(node, self.cluster_name)
         self.nodes(node).qemu(vmid).delete()
+        forget(('vm_config', self.cluster_name, node, vmid))
+        self._invalidate('vm', node, vmid)
+        self._invalidate('vm_config', node, vmid)
+        self._invalidate('vms', node)
+        self._invalidate('pool')
+        self._invalidate('inventory')
         return True
 
     @if_reachable
     @trap_resource_exception
     @if_vm_exists("vmid")
     @if_network_interface_exists("bridge")
-    def attach_net_to_vm(self, vmid=None, bridge=None, node=settings.PROXMOX_NODE_NAME):
-        current_config = self.nodes(node).qemu(vmid).config.get()
-        nets = [int(item.replace('net', '')) for item in current_config if item.startswith("net")]
-        if not nets:
-            next_net = 0
-        else:
-            next_net = max(nets)+1
-        int_number = next_net
-        next_net = "net" + str(next_net)
-        mac_address = ":"\
-            .join(['52', '54', '00'] + [str("%0x" % random.randint(0, 0xFFFFFF))[i:i+2] for i in range(0, 3)])\
-            .upper()
-        self.nodes(node).qemu(vmid).config.post(**{
-            next_net: "model=virtio,bridge={bridge},macaddr={mac_address}"
-                                                .format(bridge=bridge, mac_address=mac_address)
-        })
-        return "eth" + str(int_number), mac_address
+    def attach_net_to_vm(self, vmid=None, bridge=None, node=None):
+        node = default_node(node, self.cluster_name)
+        config = self.configure_vm(vmid, node=node)
+        net, mac_address = config.add_net(bridge)
+        config.apply()
+        return net.replace("net", "eth"), mac_address
 
     @if_reachable
     @trap_resource_exception
     @if_vm_exists("vmid")
     @if_vm_has_network("vmid", "network")
-    def detach_net_from_vm(self, vmid: int=None, network: str='', node: str=settings.PROXMOX_NODE_NAME):
-        self.nodes(node).qemu(vmid).config.post(delete=network)
+    def detach_net_from_vm(self, vmid: int=None, network: str='', node: str=None):
+        node = default_node(node, self.cluster_name)
+        self.configure_vm(vmid, node=node).delete(network).apply()
         return True
 
     @if_reachable
@@ -188,6 +458,9 @@ class ProxmoxConnector(ProxmoxAPI):
     @if_resource_pool_exists("poolid", False)
     def create_resource_pool(self, poolid="", comment=""):
         self.pools.create(poolid=poolid, comment=comment)
+        forget(('pools', self.cluster_name))
+        self._invalidate('pools')
+        self._invalidate('pool', poolid)
         return poolid
 
     @if_reachable
@@ -195,15 +468,76 @@ class ProxmoxConnector(ProxmoxAPI):
     @if_resource_pool_exists("poolid", True)
     def delete_resource_pool(self, poolid: str = ""):
         self.pools.delete(poolid)
+        forget(('pools', self.cluster_name))
+        self._invalidate('pools')
+        self._invalidate('pool', poolid)
         return True
 
+    @if_reachable
+    @trap_resource_exception
+    def update_acl(self, path: str, roles: list, users: list, delete: bool = False, propagate: bool = True):
+        """Grant (or revoke) every role to every user on path in a single call"""
+        params = {"path": path, "roles": ",".join(roles), "users": ",".join(users), "propagate": int(propagate)}
+        if delete:
+            params["delete"] = 1
+        self.access.acl.put(**params)
+        self._invalidate('acl')
+        return True
+
+    @if_reachable
+    @trap_resource_exception
+    def move_vm_to_pool(self, vmid, source: str, target: str):
+        self.pools(source).put(vms=vmid, delete=1)
+        self.pools(target).put(vms=vmid)
+        self._invalidate('pool', source)
+        self._invalidate('pool', target)
+        self._invalidate('inventory')
+        return vmid
+
+    @if_reachable
+    @trap_resource_exception
+    def rename_vm(self, vmid, name: str, node=None):
+        node = default_node(node, self.cluster_name)
+        self.configure_vm(vmid, node=node).name(name).apply()
+        return vmid
+
     @if_reachable
     @trap_resource_exception
     def get_resource_pool(self, poolid: str):
-        return self.pools(poolid).get()
+        return self._read('pool', poolid, loader=lambda: self.pools(poolid).get())
 
-    def cloudinit_prepare(self, ip, cidr, root_pwd):
-        pass
+    @if_reachable
+    @trap_resource_exception
+    @if_vm_exists("vmid")
+    def cloudinit_prepare(self, vmid=None, documents: dict = None, node=None):
+        """
+        Publish rendered cloud-init documents for a VM, as a NoCloud ISO uploaded to PROXMOX_CLOUDINIT_STORAGE
+        and attached on PROXMOX_CLOUDINIT_DRIVE, or as snippets referenced through cicustom when
+        PROXMOX_CLOUDINIT_MODE is "snippets". The previous ISO of the VM is removed once replaced.
+        """
+        from .upid import tracker_for
+        node = default_node(node, self.cluster_name)
+        storage = getattr(settings, "PROXMOX_CLOUDINIT_STORAGE", "local")
+        name = "vm-{vmid}-cloudinit-{digest}".format(vmid=vmid, digest=content_hash(documents)[:12])
+        config = self.configure_vm(vmid, node=node)
+        if getattr(settings, "PROXMOX_CLOUDINIT_MODE", "iso") == "snippets":
+            files = write_snippets(documents, getattr(settings, "PROXMOX_CLOUDINIT_SNIPPETS_DIR",
+                                                        "/var/lib/vz/snippets"), name)
+            cicustom = ",".join("{kind}={storage}:snippets/{file}".format(kind=kind, storage=storage, file=file)
+                                for kind, file in sorted(files.items()))
+            config.set("cicustom", cicustom).apply()
+            return cicustom
+        drive = getattr(settings, "PROXMOX_CLOUDINIT_DRIVE", "ide3")
+        previous = config.current.get(drive, "").split(",")[0]
+        upid = self.nodes(node).storage(storage).upload.post(content="iso",
+                                                             filename=build_iso(documents, name + ".iso"))
+        if upid:
+            tracker_for(self.cluster_name).wait(upid)
+        volume = "{storage}:iso/{name}.iso".format(storage=storage, name=name)
+        config.set(drive, volume + ",media=cdrom").apply()
+        if previous and previous != volume and "-cloudinit-" in previous:
+            self.nodes(node).storage(storage).content(quote(previous, safe="")).delete()
+        return volume
 
     @if_reachable
     @trap_resource_exception
@@ -0,0 +1,141 @@
+from django.db import transaction
+from django.utils import timezone
+from collections import Counter, defaultdict
+from .models import Activity, VirtualMachine, Tester, SyncState
+from .proxmox import ProxmoxConnector
+from .inventory import inventory
+from .clusters import default_cluster
+import hashlib
+import json
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Reconciliation of the Django models against a bulk snapshot of each cluster.
+
+A pass reads the cluster once (inventory snapshot, pools, users, ACLs) and, for every activity, virtual machine and
+tester, hashes the inputs of its check: the model fields involved plus the slice of the snapshot they refer to.
+Objects whose hash equals the stored one are left alone; the others are evaluated and their SyncState row is
+written in bulk. Admin pages read these rows instead of querying Proxmox while rendering.
+"""
+
+
+def input_hash(inputs) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ClusterSnapshot(object):
+
+    def __init__(self, cluster: str):
+        connector = ProxmoxConnector(cluster)
+        self.cluster = cluster
+        self.inventory = inventory.snapshot(cluster)
+        self.pools = {pool.get('poolid') for pool in connector.get_pools()}
+        self.users = {user.get('userid') for user in connector.get_users()}
+        self.acl = defaultdict(list)
+        for entry in connector.get_acl():
+            self.acl[entry.get('path')].append((entry.get('ugid'), entry.get('roleid')))
+
+
+def check_activity(activity: Activity, snapshot: ClusterSnapshot):
+    path = "/pool/{poolid}".format(poolid=activity.px_pool_id)
+    userids = sorted(tester.px_userid for tester in activity.testers.all())
+    inputs = [activity.px_pool_id, userids, activity.px_pool_id in snapshot.pools, sorted(snapshot.acl.get(path, [])),
+              [userid in snapshot.users for userid in userids], any(vm.vmid for vm in activity.vms.all())]
+
+    def evaluate():
+        if activity.px_pool_id not in snapshot.pools:
+            status = SyncState.MISSING if inputs[-1] else SyncState.PENDING
+            return status, {"pool": activity.px_pool_id}
+        granted = {ugid for ugid, role in snapshot.acl.get(path, [])}
+        detail = {
+            "pool": activity.px_pool_id,
+            "missing_users": [userid for userid in userids if userid not in snapshot.users],
+            "missing_authorizations": [userid for userid in userids if userid not in granted],
+        }
+        drifted = detail["missing_users"] or detail["missing_authorizations"]
+        return SyncState.DRIFTED if drifted else SyncState.IN_SYNC, detail
+    return inputs, evaluate
+
+
+def check_vm(vm: VirtualMachine, snapshot: ClusterSnapshot):
+    resource = snapshot.inventory.get_vm(vm.vmid) if vm.vmid else None
+    expected = {"name": vm.hostname, "pool": vm.activity.px_pool_id if vm.activity else None}
+    actual = {key: resource.get(key) for key in ("name", "pool", "status", "lock", "node")} if resource else None
+    inputs = [vm.vmid, expected, actual]
+
+    def evaluate():
+        if not vm.vmid:
+            return SyncState.PENDING, {}
+        if actual is None:
+            return SyncState.MISSING, {"vmid": vm.vmid}
+        differences = [key for key, value in expected.items() if value and actual.get(key) != value]
+        return SyncState.DRIFTED if differences else SyncState.IN_SYNC, dict(actual, differences=differences)
+    return inputs, evaluate
+
+
+def check_tester(tester: Tester, snapshot: ClusterSnapshot):
+    inputs = [tester.px_userid, tester.px_userid in snapshot.users]
+
+    def evaluate():
+        return (SyncState.IN_SYNC if inputs[1] else SyncState.PENDING), {"userid": tester.px_userid}
+    return inputs, evaluate
+
+
+def _objects(cluster: str):
+    default = default_cluster()
+    activities = [activity for activity in Activity.objects.prefetch_related("testers", "vms")
+                  if (activity.cluster or default) == cluster]
+    vms = [vm for vm in VirtualMachine.objects.select_related("activity") if (vm.px_cluster or default) == cluster]
+    return [("activity", activities, check_activity),
+            ("virtualmachine", vms, check_vm),
+            ("tester", list(Tester.objects.all()), check_tester)]
+
+
+def reconcile(cluster: str = None, snapshot: ClusterSnapshot = None) -> Counter:
+    """One pass over a cluster; returns how many objects were skipped, created, updated and removed"""
+    cluster = cluster or default_cluster()
+    snapshot = snapshot or ClusterSnapshot(cluster)
+    stored = {(state.kind, state.object_id): state for state in SyncState.objects.filter(cluster=cluster)}
+    now = timezone.now()
+    created, updated, seen = [], [], set()
+    counts = Counter()
+    for kind, objects, check in _objects(cluster):
+        for obj in objects:
+            seen.add((kind, obj.pk))
+            inputs, evaluate = check(obj, snapshot)
+            digest = input_hash(inputs)
+            state = stored.get((kind, obj.pk))
+            if state is not None and state.input_hash == digest:
+                counts["skipped"] += 1
+                continue
+            status, detail = evaluate()
+            if state is None:
+                created.append(SyncState(kind=kind, object_id=obj.pk, cluster=cluster, status=status,
+                                         detail=json.dumps(detail), input_hash=digest, changed_at=now))
+                continue
+            if state.status != status:
+                state.changed_at = now
+            state.status, state.detail, state.input_hash, state.checked_at = status, json.dumps(detail), digest, now
+            updated.append(state)
+    removed = [state.pk for key, state in stored.items() if key not in seen]
+    with transaction.atomic():
+        SyncState.objects.bulk_create(created)
+        SyncState.objects.bulk_update(updated, ["status", "detail", "input_hash", "checked_at", "changed_at"])
+        SyncState.objects.filter(pk__in=removed).delete()
+    counts.update(created=len(created), updated=len(updated), removed=len(removed))
+    return counts
+
+
+def sync_states(kind: str, object_ids=None) -> dict:
+    """object id -> SyncState for one kind; for objects checked on several clusters the least healthy one wins"""
+    order = [SyncState.MISSING, SyncState.DRIFTED, SyncState.PENDING, SyncState.IN_SYNC]
+    states = SyncState.objects.filter(kind=kind)
+    if object_ids is not None:
+        states = states.filter(object_id__in=object_ids)
+    result = {}
+    for state in states:
+        current = result.get(state.object_id)
+        if current is None or order.index(state.status) < order.index(current.status):
+            result[state.object_id] = state
+    return result
@@ -0,0 +1,175 @@
+from django.conf import settings
+from requests.exceptions import ConnectionError, ConnectTimeout, SSLError, Timeout
+from urllib3.exceptions import NewConnectionError
+from .admission import BULK, current_lane, node_of
+import threading
+import random
+import time
+import re
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Error classification, retries and circuit breakers for the requests sent to the Proxmox API.
+
+Failures are classified as transient (gateway errors, 595/596 from the pveproxy of another node, timeouts, refused
+connections), locked (the VM or its config file is locked by another task) or permanent (everything else: PVE
+answers 500 to most invalid requests; TLS handshake and certificate errors are permanent too, even though requests
+raises them as connection errors). Transient failures are retried with full-jitter exponential backoff when
+the request is idempotent or was never executed; lock contention is always retried since PVE rejects the call
+before doing anything, with a longer backoff. Interactive requests retry once at most, see orchestrator.admission.
+
+Each node has a circuit breaker: PROXMOX_BREAKER_THRESHOLD transient failures in a row open it, and requests to
+the node fail at once with CircuitOpenError until PROXMOX_BREAKER_COOLDOWN has passed; then a single trial request
+goes through and closes it again on success.
+"""
+
+TRANSIENT = "transient"
+LOCKED = "locked"
+PERMANENT = "permanent"
+
+TRANSIENT_STATUSES = (502, 503, 504, 595, 596)
+NOT_EXECUTED_STATUSES = (595,)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT")
+LOCK_PATTERN = re.compile(r"is locked|can't lock file|got timeout", re.IGNORECASE)
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+def classify(status: int, message: str = "") -> str:
+    if LOCK_PATTERN.search(message or ""):
+        return LOCKED
+    if status in TRANSIENT_STATUSES:
+        return TRANSIENT
+    return PERMANENT
+
+
+def _not_sent(exception) -> bool:
+    if isinstance(exception, ConnectTimeout):
+        return True
+    reason = getattr(exception.args[0], "reason", None) if exception.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def retry_delay(kind: str, method: str, attempt: int, executed: bool = True):
+    """Seconds to wait before attempt + 1, or None when the request must not be retried"""
+    if kind == LOCKED:
+        attempts = getattr(settings, "PROXMOX_LOCK_RETRY_ATTEMPTS", 5)
+        base = getattr(settings, "PROXMOX_LOCK_RETRY_DELAY", 1)
+        cap = getattr(settings, "PROXMOX_LOCK_RETRY_MAX_DELAY", 10)
+    elif kind == TRANSIENT and (method.upper() in IDEMPOTENT_METHODS or not executed):
+        attempts = getattr(settings, "PROXMOX_RETRY_ATTEMPTS", 4)
+        base = getattr(settings, "PROXMOX_RETRY_DELAY", 0.2)
+        cap = getattr(settings, "PROXMOX_RETRY_MAX_DELAY", 5)
+    else:
+        return None
+    if current_lane() != BULK:
+        attempts = min(attempts, 2)
+    if attempt + 1 >= attempts:
+        return None
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < getattr(settings, "PROXMOX_BREAKER_COOLDOWN", 15):
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._failures >= getattr(settings, "PROXMOX_BREAKER_THRESHOLD", 5):
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """End a trial request that neither reached the node nor failed to"""
+        with self._lock:
+            self._trial = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    @property
+    def suspended(self) -> bool:
+        """Open and not letting a trial request through yet"""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            return self._trial or time.monotonic() - self._opened_at < getattr(settings, "PROXMOX_BREAKER_COOLDOWN", 15)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(cluster: str, node: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if (cluster, node) not in _breakers:
+            _breakers[(cluster, node)] = CircuitBreaker()
+        return _breakers[(cluster, node)]
+
+
+def resilient_session(session, cluster: str):
+    """Retry the requests of the (proxmoxer) requests session and guard every node with a circuit breaker"""
+    request = session.request
+
+    def resilient_request(method, url, *args, **kwargs):
+        node = node_of(url)
+        breaker = breaker_for(cluster, node)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError("Node {node} of {cluster} is failing, requests suspended".format(
+                    node=node, cluster=cluster))
+            try:
+                response = request(method, url, *args, **kwargs)
+            except SSLError:
+                # a certificate mismatch will not heal by retrying, and says nothing about the node health
+                breaker.release()
+                raise
+            except (ConnectionError, Timeout) as e:
+                breaker.failure()
+                delay = retry_delay(TRANSIENT, method, attempt, executed=not _not_sent(e))
+                if delay is None:
+                    raise
+                failure = e
+            except Exception:
+                breaker.release()
+                raise
+            else:
+                kind = classify(response.status_code, response.reason) if response.status_code >= 400 else None
+                if kind == TRANSIENT:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                delay = retry_delay(kind, method, attempt, executed=response.status_code not in NOT_EXECUTED_STATUSES)
+                if delay is None:
+                    return response
+                failure = "{status} {reason}".format(status=response.status_code, reason=response.reason)
+            logger.warning("%s %s failed (%s), retrying in %.2fs", method, url, failure, delay)
+            time.sleep(delay)
+            attempt += 1
+    session.request = resilient_request
+    return session
@@ -0,0 +1,42 @@
+from contextlib import contextmanager
+from .metrics import observe_cache
+import threading
+
+"""
+Request or flow scoped memoization of the lookups made by the precondition decorators.
+
+Inside a lookup_scope() each key is fetched at most once, and the wrapped connector method can reuse it.
+Scopes are per thread: every provisioning thread opens its own. Outside a scope memoized() just calls the loader.
+"""
+
+_local = threading.local()
+
+
+@contextmanager
+def lookup_scope():
+    if getattr(_local, "values", None) is not None:
+        yield _local.values
+        return
+    _local.values = {}
+    try:
+        yield _local.values
+    finally:
+        _local.values = None
+
+
+def memoized(key: tuple, loader):
+    values = getattr(_local, "values", None)
+    if values is None:
+        return loader()
+    if key not in values:
+        observe_cache("scope", key[1], key[0], "miss")
+        values[key] = loader()
+    else:
+        observe_cache("scope", key[1], key[0], "hit")
+    return values[key]
+
+
+def forget(key: tuple):
+    values = getattr(_local, "values", None)
+    if values is not None:
+        values.pop(key, None)
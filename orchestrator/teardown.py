@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db import connection
+from concurrent.futures import ThreadPoolExecutor
+from .models import Activity, VirtualMachine
+from .proxmox import ProxmoxConnector, ProxmoxDriverException
+from .inventory import inventory
+from .limits import KeyedSemaphore
+from .scope import lookup_scope
+from .upid import task_result
+from .clusters import default_cluster
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Teardown of an activity: every VM of its pool is stopped, waited for and destroyed with its disks, then the pool
+is removed.
+
+Each VM goes through its own stop -> destroy pipeline on a worker thread, so stops and destroys of different VMs
+overlap, while PROXMOX_MAX_DESTROYS_PER_NODE bounds the destroy tasks running on a node. Every step starts from
+the current inventory (a stopped VM is not stopped again, a missing one is considered destroyed), so a teardown
+interrupted half way can simply be run again. VMs are destroyed through the connector of their cluster
+(VirtualMachine.px_cluster).
+"""
+
+destroy_slots_per_node = KeyedSemaphore("PROXMOX_MAX_DESTROYS_PER_NODE", 4)
+
+
+class TeardownIncomplete(ProxmoxDriverException):
+    pass
+
+
+def destroy_vm(connector: ProxmoxConnector, vmid, progress=None):
+    """Stop (when running) and destroy a single VM; a VM that no longer exists counts as destroyed"""
+    step = "VM {vmid}".format(vmid=vmid)
+
+    def report(state):
+        if progress:
+            progress(step, state)
+    vm = inventory.snapshot(connector.cluster_name).get_vm(vmid)
+    if vm is None:
+        report("DESTROYED")
+        return
+    node = vm['node']
+    if vm.get('status') == 'running':
+        report("STOPPING")
+        task_result(connector.stop_vm_async(vmid=vmid, node=node))
+    report("DESTROYING")
+    with destroy_slots_per_node(node):
+        task_result(connector.delete_vm_async(vmid=vmid, node=node, purge=True))
+    report("DESTROYED")
+
+
+def _destroy(connector: ProxmoxConnector, vmid, pks: list, progress=None):
+    try:
+        with lookup_scope():
+            destroy_vm(connector, vmid, progress)
+        VirtualMachine.objects.filter(pk__in=pks).update(vmid=None, node=None, cloudinit_hash=None)
+    finally:
+        connection.close()
+
+
+def _targets(activity: Activity) -> dict:
+    """(cluster, vmid) -> pks of the VirtualMachine rows holding that vmid, for the pool VMs and the activity ones"""
+    cluster = activity.cluster or default_cluster()
+    targets = {(cluster, str(vm['vmid'])): [] for vm in inventory.snapshot(cluster).vms_in_pool(activity.px_pool_id)}
+    for vm in activity.vms.filter(vmid__isnull=False):
+        targets.setdefault((vm.px_cluster or default_cluster(), str(vm.vmid)), []).append(vm.pk)
+    return targets
+
+
+def teardown_activity(activity: Activity, progress=None) -> dict:
+    """
+    Destroy the VMs of the activity pool (and the ones of the activity still holding a vmid)
+    concurrently, then delete the pool. Returns (cluster, vmid) -> None or the raised exception; raises
+    TeardownIncomplete, keeping the pool, when some VM could not be destroyed.
+    """
+    targets = _targets(activity)
+    connectors = {cluster: ProxmoxConnector(cluster) for cluster, vmid in targets}
+    results = {}
+    with ThreadPoolExecutor(max_workers=getattr(settings, "PROXMOX_PROVISIONING_WORKERS", 8)) as executor:
+        futures = {(cluster, vmid): executor.submit(_destroy, connectors[cluster], vmid, pks, progress)
+                   for (cluster, vmid), pks in sorted(targets.items())}
+        for (cluster, vmid), future in futures.items():
+            exception = future.exception()
+            if exception:
+                logger.error("Teardown of VM %s on %s failed: %s", vmid, cluster, exception)
+            results[(cluster, vmid)] = exception
+    failures = ["{vmid}@{cluster}".format(vmid=vmid, cluster=cluster)
+                for (cluster, vmid), exception in results.items() if exception]
+    if failures:
+        raise TeardownIncomplete("VMs not removed: {vmids}".format(vmids=", ".join(failures)))
+    if progress:
+        progress("pool", "DESTROYING")
+    activity.px_delete_pool()
+    if progress:
+        progress("pool", "DESTROYED")
+    return results
@@ -1,3 +1,1104 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+from collections import defaultdict
+from concurrent.futures import Future
+from .models import Job, Company, Tester, Activity, VirtualMachine, SyncState, Network, VMNet, TesterIpAddress
+from .inventory import InventorySnapshot
+from .placement import PlacementScheduler, cluster_model, BINPACK, SPREAD, MB
+from .proxmox import ProxmoxDriverException
+from .cloudinit import engine as cloudinit, media
+from . import cache as px_cache
+from . import ipam
+from . import macs
+from . import jobs
+from . import reconciler
+from . import teardown
+from . import admission, limits, resilience
+from . import events
+from . import acl
+import io
+import ipaddress
+import os
+import tempfile
+import pycdlib
+import yaml
 
-# Create your tests here.
+GB = 1024 * MB
+
+
+def failing_handler(job, progress):
+    raise RuntimeError("boom")
+
+
+def succeeding_handler(job, progress):
+    progress("step", "SUCCESS")
+
+
+@override_settings(ORCHESTRATOR_JOB_RETRY_DELAY=10, ORCHESTRATOR_JOB_LEASE=120)
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(jobs.JOB_HANDLERS, {"failing": failing_handler, "succeeding": succeeding_handler})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_due(self, job):
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+
+    def test_claim_moves_the_oldest_due_job_to_running(self):
+        first = jobs.enqueue("succeeding")
+        jobs.enqueue("succeeding")
+        job = jobs.claim_next()
+        self.assertEqual(job.pk, first.pk)
+        self.assertEqual(job.status, Job.RUNNING)
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.started_at)
+        self.assertGreater(job.lease_expires_at, timezone.now())
+
+    def test_claim_is_a_compare_and_set(self):
+        job = jobs.enqueue("succeeding")
+        self.assertEqual(jobs.claim_next().pk, job.pk)
+        self.assertIsNone(jobs.claim_next())
+        self.assertEqual(Job.objects.get(pk=job.pk).attempts, 1)
+
+    def test_claim_skips_jobs_not_due_yet(self):
+        job = jobs.enqueue("succeeding")
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now() + timedelta(minutes=5))
+        self.assertIsNone(jobs.claim_next())
+
+    def test_success(self):
+        jobs.enqueue("succeeding")
+        job = jobs.run_job(jobs.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.steps, {"step": "SUCCESS"})
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(job.lease_expires_at)
+
+    def test_failure_is_retried_with_backoff_then_failed(self):
+        jobs.enqueue("failing", max_attempts=2)
+        job = jobs.run_job(jobs.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertIn("boom", job.error)
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=9))
+        self.assertIsNone(jobs.claim_next())
+        self.make_due(job)
+        job = jobs.run_job(jobs.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_retry_delay_grows_exponentially(self):
+        for attempts, low, high in ((1, 10, 15), (2, 20, 30), (3, 40, 60)):
+            delay = jobs.retry_delay(attempts).total_seconds()
+            self.assertGreaterEqual(delay, low)
+            self.assertLessEqual(delay, high)
+
+    def test_retry_restarts_a_failed_job(self):
+        jobs.enqueue("failing", max_attempts=1)
+        job = jobs.run_job(jobs.claim_next())
+        jobs.retry(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(job.attempts, 0)
+        self.assertEqual(job.error, "")
+
+    def test_retry_leaves_a_leased_job_alone(self):
+        jobs.enqueue("succeeding")
+        job = jobs.claim_next()
+        jobs.retry(job)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.RUNNING)
+
+    def test_retry_takes_back_a_job_with_an_expired_lease(self):
+        jobs.enqueue("succeeding")
+        job = jobs.claim_next()
+        Job.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        jobs.retry(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(job.attempts, 0)
+
+    def test_expired_lease_is_requeued_by_the_next_claim(self):
+        jobs.enqueue("succeeding", max_attempts=2)
+        job = jobs.claim_next()
+        Job.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        job = jobs.claim_next()
+        self.assertEqual(job.status, Job.RUNNING)
+        self.assertEqual(job.attempts, 2)
+
+    def test_expired_lease_without_attempts_left_fails(self):
+        jobs.enqueue("succeeding", max_attempts=1)
+        job = jobs.claim_next()
+        Job.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(jobs.claim_next())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_progress_renews_the_lease(self):
+        jobs.enqueue("succeeding")
+        job = jobs.claim_next()
+        Job.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() + timedelta(seconds=1))
+        jobs.ProgressRecorder(job)("step", "RUNNING")
+        self.assertGreater(Job.objects.get(pk=job.pk).lease_expires_at, timezone.now() + timedelta(seconds=60))
+
+    def test_outcome_of_a_job_that_lost_its_lease_is_discarded(self):
+        def requeued_meanwhile(job, progress):
+            Job.objects.filter(pk=job.pk).update(status=Job.PENDING, lease_expires_at=None)
+        jobs.enqueue("requeued")
+        with mock.patch.dict(jobs.JOB_HANDLERS, {"requeued": requeued_meanwhile}):
+            job = jobs.run_job(jobs.claim_next())
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.PENDING)
+
+
+def fake_resources(vms=()):
+    """A /cluster/resources list: two online nodes with local-lvm, one offline node, plus the given VMs"""
+    return [
+        {"type": "node", "node": "pve1", "status": "online", "maxmem": 64 * GB, "mem": 8 * GB, "maxcpu": 16,
+         "cpu": 0.1},
+        {"type": "node", "node": "pve2", "status": "online", "maxmem": 64 * GB, "mem": 40 * GB, "maxcpu": 16,
+         "cpu": 0.2},
+        {"type": "node", "node": "pve3", "status": "offline"},
+        {"type": "storage", "node": "pve1", "storage": "local-lvm", "status": "available", "maxdisk": 500 * GB,
+         "disk": 100 * GB},
+        {"type": "storage", "node": "pve2", "storage": "local-lvm", "status": "available", "maxdisk": 500 * GB,
+         "disk": 495 * GB},
+    ] + list(vms)
+
+
+@override_settings(PROXMOX_PLACEMENT_RESERVED_RAM=1024, PROXMOX_PLACEMENT_MIN_STORAGE_FREE=10 * GB,
+                   PROXMOX_CLONE_STORAGE=None, PROXMOX_PLACEMENT_STRATEGY=SPREAD)
+class PlacementTests(TestCase):
+
+    def scheduler(self, **kwargs):
+        return PlacementScheduler(cluster_model(fake_resources()), **kwargs)
+
+    def test_cluster_model_keeps_the_online_nodes(self):
+        nodes = cluster_model(fake_resources())
+        self.assertEqual(set(nodes), {"pve1", "pve2"})
+        self.assertEqual(nodes["pve1"].free_mem, 56 * GB)
+        self.assertEqual(nodes["pve1"].storages, {"local-lvm": 400 * GB})
+
+    def test_spread_picks_the_emptiest_node(self):
+        self.assertEqual(self.scheduler().place(2048, 2), "pve1")
+
+    def test_binpack_picks_the_fullest_node_that_fits(self):
+        self.assertEqual(self.scheduler(strategy=BINPACK).place(2048, 2), "pve2")
+
+    def test_nodes_without_storage_headroom_are_skipped(self):
+        self.assertEqual(self.scheduler(strategy=BINPACK, storage="local-lvm").place(2048, 2), "pve1")
+
+    def test_placements_reserve_capacity(self):
+        scheduler = self.scheduler(strategy=BINPACK)
+        self.assertEqual([scheduler.place(8192, 2) for _ in range(3)], ["pve2", "pve2", "pve1"])
+        self.assertEqual(scheduler.nodes["pve2"].allocated_cores, 4)
+
+    def test_vms_of_an_activity_are_spread_across_nodes(self):
+        scheduler = self.scheduler()
+        self.assertEqual([scheduler.place(1024, 1, activity="ACT1") for _ in range(2)], ["pve1", "pve2"])
+
+    def test_no_node_fits(self):
+        with self.assertRaises(ProxmoxDriverException):
+            self.scheduler().place(100 * 1024, 1)
+
+    def test_from_inventory_accounts_for_the_vms_already_placed(self):
+        snapshot = InventorySnapshot(fake_resources([
+            {"type": "qemu", "vmid": 101, "node": "pve1", "pool": "ACT1", "name": "kali-1", "status": "running"},
+        ]))
+        self.assertEqual(PlacementScheduler.from_inventory(snapshot).place(1024, 1, activity="ACT1"), "pve2")
+
+
+class FakeClusterSnapshot(object):
+    """Stands in for reconciler.ClusterSnapshot, built from a resources list instead of the API"""
+
+    def __init__(self, resources, pools=(), users=(), acl=None):
+        self.cluster = "default"
+        self.inventory = InventorySnapshot(resources)
+        self.pools = set(pools)
+        self.users = set(users)
+        self.acl = defaultdict(list, acl or {})
+
+
+@override_settings(PROXMOX_USER_REALM="pve", PROXMOX_DEFAULT_CLUSTER="default", PROXMOX_TESTER_ROLE="PVEVMUser")
+class ReconcilerTests(TestCase):
+
+    def setUp(self):
+        company = Company.objects.create(name="ACME")
+        self.tester = Tester.objects.create(name="Mario Rossi", tester_identifier="T001", company=company)
+        self.activity = Activity.objects.create(activity_identifier="ACT1", target_application_identifier="APP1",
+                                                target_application_name="Portale")
+        self.activity.testers.add(self.tester)
+        self.vm = VirtualMachine.objects.create(name="Kali 1", os="Kali", ram=1024, cpu=1, activity=self.activity)
+
+    def snapshot(self, vms=(), pools=("ACT1",), users=("t001@pve",), acl=None):
+        if acl is None:
+            acl = {"/pool/ACT1": [("t001@pve", "PVEVMUser")]}
+        return FakeClusterSnapshot(fake_resources(vms), pools=pools, users=users, acl=acl)
+
+    def evaluate(self, check, obj, snapshot):
+        return check(obj, snapshot)[1]()
+
+    def placed(self, **changes):
+        vm = {"type": "qemu", "vmid": 101, "node": "pve1", "pool": "ACT1", "name": "kali-1", "status": "stopped"}
+        vm.update(changes)
+        return [vm]
+
+    def test_activity_in_sync(self):
+        status, detail = self.evaluate(reconciler.check_activity, self.activity, self.snapshot())
+        self.assertEqual(status, SyncState.IN_SYNC)
+
+    def test_activity_without_authorization_drifted(self):
+        status, detail = self.evaluate(reconciler.check_activity, self.activity, self.snapshot(acl={}))
+        self.assertEqual(status, SyncState.DRIFTED)
+        self.assertEqual(detail["missing_authorizations"], ["t001@pve"])
+
+    def test_activity_pool_pending_then_missing(self):
+        status, detail = self.evaluate(reconciler.check_activity, self.activity, self.snapshot(pools=()))
+        self.assertEqual(status, SyncState.PENDING)
+        self.vm.vmid = "101"
+        self.vm.save()
+        activity = Activity.objects.get(pk=self.activity.pk)
+        status, detail = self.evaluate(reconciler.check_activity, activity, self.snapshot(pools=()))
+        self.assertEqual(status, SyncState.MISSING)
+
+    def test_vm_states(self):
+        self.assertEqual(self.evaluate(reconciler.check_vm, self.vm, self.snapshot())[0], SyncState.PENDING)
+        self.vm.vmid = "101"
+        self.assertEqual(self.evaluate(reconciler.check_vm, self.vm, self.snapshot())[0], SyncState.MISSING)
+        self.assertEqual(self.evaluate(reconciler.check_vm, self.vm, self.snapshot(self.placed()))[0],
+                         SyncState.IN_SYNC)
+        status, detail = self.evaluate(reconciler.check_vm, self.vm, self.snapshot(self.placed(pool="OTHER")))
+        self.assertEqual(status, SyncState.DRIFTED)
+        self.assertEqual(detail["differences"], ["pool"])
+
+    def test_tester_states(self):
+        self.assertEqual(self.evaluate(reconciler.check_tester, self.tester, self.snapshot())[0], SyncState.IN_SYNC)
+        self.assertEqual(self.evaluate(reconciler.check_tester, self.tester, self.snapshot(users=()))[0],
+                         SyncState.PENDING)
+
+    def test_reconcile_skips_unchanged_objects(self):
+        self.vm.vmid = "101"
+        self.vm.save()
+        snapshot = self.snapshot(self.placed())
+        with mock.patch.object(reconciler, "ClusterSnapshot", return_value=snapshot):
+            self.assertEqual(reconciler.reconcile("default")["created"], 3)
+            counts = reconciler.reconcile("default")
+            self.assertEqual((counts["skipped"], counts["updated"]), (3, 0))
+            snapshot.inventory = InventorySnapshot(fake_resources(self.placed(pool="OTHER")))
+            counts = reconciler.reconcile("default")
+            self.assertEqual((counts["skipped"], counts["updated"]), (2, 1))
+        state = SyncState.objects.get(kind="virtualmachine", object_id=self.vm.pk)
+        self.assertEqual(state.status, SyncState.DRIFTED)
+
+
+    def test_reconcile_removes_the_states_of_deleted_objects(self):
+        with mock.patch.object(reconciler, "ClusterSnapshot", return_value=self.snapshot()):
+            reconciler.reconcile("default")
+            self.vm.delete()
+            self.assertEqual(reconciler.reconcile("default")["removed"], 1)
+        self.assertFalse(SyncState.objects.filter(kind="virtualmachine").exists())
+
+    def test_least_healthy_state_wins_across_clusters(self):
+        SyncState.objects.create(kind="tester", object_id=self.tester.pk, cluster="a", status=SyncState.IN_SYNC,
+                                 detail="{}", input_hash="x")
+        SyncState.objects.create(kind="tester", object_id=self.tester.pk, cluster="b", status=SyncState.PENDING,
+                                 detail="{}", input_hash="x")
+        self.assertEqual(reconciler.sync_states("tester")[self.tester.pk].cluster, "b")
+
+class CloudInitTests(TestCase):
+
+    def setUp(self):
+        company = Company.objects.create(name="ACME")
+        self.tester = Tester.objects.create(name="Rossi: Mario", tester_identifier="T001", company=company)
+        activity = Activity.objects.create(activity_identifier="ACT1", target_application_identifier="APP1",
+                                           target_application_name="Portale")
+        activity.testers.add(self.tester)
+        self.vm = VirtualMachine.objects.create(name="Kali 1", os="Kali", ram=1024, cpu=1, activity=activity,
+                                                vmid="101")
+        lan = Network.objects.create(network_description="LAN", bridge_name="vmbr1")
+        dmz = Network.objects.create(network_description="DMZ", bridge_name="vmbr2")
+        ip = TesterIpAddress.objects.create(ip="10.0.0.10", cidr=24, gateway="10.0.0.1", tester=self.tester)
+        VMNet.objects.create(net=lan, vm=self.vm, ip=ip)
+        VMNet.objects.create(net=dmz, vm=self.vm)
+        self.config = {"net0": "virtio=52:54:00:AA:BB:01,bridge=vmbr1", "net1": "virtio=52:54:00:AA:BB:02,bridge=vmbr2"}
+
+    def render(self):
+        return cloudinit.render(self.vm, self.config, [self.tester])
+
+    def test_user_data(self):
+        document = self.render()["user-data"]
+        self.assertTrue(document.startswith("#cloud-config\n"))
+        data = yaml.safe_load(document)
+        self.assertEqual(data["hostname"], "kali-1")
+        self.assertEqual(data["users"][1], {"name": "t001", "gecos": "Rossi: Mario", "lock_passwd": True,
+                                            "groups": ["sudo"]})
+
+    def test_meta_data(self):
+        self.assertEqual(yaml.safe_load(self.render()["meta-data"]),
+                         {"instance-id": "vmid-101", "local-hostname": "kali-1"})
+
+    def test_network_config_matches_nics_by_bridge(self):
+        config = yaml.safe_load(self.render()["network-config"])["config"]
+        self.assertEqual([nic["mac_address"] for nic in config], ["52:54:00:aa:bb:01", "52:54:00:aa:bb:02"])
+        self.assertEqual(config[0]["subnets"], [{"type": "static", "address": "10.0.0.10/24",
+                                                 "gateway": "10.0.0.1"}])
+        self.assertEqual(config[1]["subnets"], [{"type": "dhcp"}])
+
+    def test_iso_holds_the_documents(self):
+        documents = self.render()
+        iso = pycdlib.PyCdlib()
+        iso.open_fp(media.build_iso(documents, "seed.iso"))
+        for name, content in documents.items():
+            extracted = io.BytesIO()
+            iso.get_file_from_iso_fp(extracted, rr_path="/" + name)
+            self.assertEqual(extracted.getvalue().decode(), content)
+        iso.close()
+
+    def test_snippets(self):
+        documents = self.render()
+        with tempfile.TemporaryDirectory() as directory:
+            files = media.write_snippets(documents, directory, "vm-101")
+            self.assertEqual(files["user"], "vm-101-user-data.yaml")
+            self.assertEqual(sorted(os.listdir(directory)), sorted(files.values()))
+            with open(os.path.join(directory, files["network"])) as snippet:
+                self.assertEqual(snippet.read(), documents["network-config"])
+
+    def test_unchanged_documents_are_not_published_again(self):
+        documents = self.render()
+        self.vm.cloudinit_hash = media.content_hash(documents)
+        self.assertFalse(cloudinit.publish(self.vm, documents))
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class InlineThread(object):
+    """Runs the target when started, so that background refreshes happen before the test goes on"""
+    started = 0
+
+    def __init__(self, target=None, args=(), daemon=None, name=None):
+        self.target, self.args = target, args
+
+    def start(self):
+        InlineThread.started += 1
+        self.target(*self.args)
+
+
+class ReadThroughCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeClock()
+        for patcher in (mock.patch.object(px_cache, "time", self.clock),
+                        mock.patch.object(px_cache.threading, "Thread", InlineThread)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        InlineThread.started = 0
+        self.loads = []
+
+    def loader(self, value):
+        def load():
+            self.loads.append(value)
+            return value
+        return load
+
+    def read(self, value, family="vms", *parts, namespace="a"):
+        return px_cache.read_through(family, *(parts or ("pve1",)), loader=self.loader(value), namespace=namespace)
+
+    def test_miss_loads_once(self):
+        self.assertEqual(self.read(1), 1)
+        self.assertEqual(self.read(2), 1)
+        self.assertEqual(self.loads, [1])
+
+    def test_stale_entry_is_served_while_refreshed(self):
+        self.read(1)
+        self.clock.now += px_cache.DEFAULT_TTLS["vms"] + 1
+        self.assertEqual(self.read(2), 1)
+        self.assertEqual(self.loads, [1, 2])
+        self.assertEqual(self.read(3), 2)
+
+    def test_single_refresh_per_stale_entry(self):
+        self.read(1)
+        self.clock.now += px_cache.DEFAULT_TTLS["vms"] + 1
+        with mock.patch.object(InlineThread, "start", lambda thread: setattr(InlineThread, "started",
+                                                                             InlineThread.started + 1)):
+            self.read(2)
+            self.read(3)
+        self.assertEqual(InlineThread.started, 1)
+
+    def test_invalidate_a_single_key(self):
+        self.read(1, "vms", "pve1")
+        self.read(1, "vms", "pve2")
+        px_cache.invalidate("vms", "pve1", namespace="a")
+        self.assertEqual(self.read(2, "vms", "pve1"), 2)
+        self.assertEqual(self.read(2, "vms", "pve2"), 1)
+
+    def test_invalidate_a_family_bumps_its_version(self):
+        self.read(1, "vms", "pve1")
+        self.read(1, "pools", "x")
+        version = px_cache.family_version("vms", "a")
+        px_cache.invalidate("vms", namespace="a")
+        self.assertEqual(px_cache.family_version("vms", "a"), version + 1)
+        self.assertEqual(self.read(2, "vms", "pve1"), 2)
+        self.assertEqual(self.read(2, "pools", "x"), 1)
+
+    def test_namespaces_are_separate(self):
+        self.read(1, namespace="a")
+        self.read(1, namespace="b")
+        px_cache.invalidate("vms", namespace="a")
+        self.assertEqual(self.read(2, namespace="a"), 2)
+        self.assertEqual(self.read(2, namespace="b"), 1)
+
+    def test_watched_clusters_use_the_long_ttls(self):
+        px_cache.mark_watched("a", self.clock.now + 10)
+        self.addCleanup(px_cache._watched_until.clear)
+        self.assertEqual(px_cache.get_ttl("vms", "a"), px_cache.WATCHED_TTLS["vms"])
+        self.assertEqual(px_cache.get_ttl("pools", "a"), px_cache.DEFAULT_TTLS["pools"])
+        self.assertEqual(px_cache.get_ttl("vms", "b"), px_cache.DEFAULT_TTLS["vms"])
+        self.clock.now += 11
+        self.assertEqual(px_cache.get_ttl("vms", "a"), px_cache.DEFAULT_TTLS["vms"])
+
+
+def address(pk, ip, cidr=24, gateway="10.0.0.1"):
+    return TesterIpAddress(pk=pk, ip=ip, cidr=cidr, gateway=gateway)
+
+
+class SubnetIndexTests(SimpleTestCase):
+
+    def index(self, *addresses, used=()):
+        index = ipam.SubnetIndex(ipaddress.ip_network("10.0.0.0/24"))
+        for item in addresses:
+            index.add(item, used=item.pk in used)
+        return index
+
+    def test_allocates_the_lowest_free_address(self):
+        index = self.index(address(1, "10.0.0.30"), address(2, "10.0.0.10"), address(3, "10.0.0.20"), used={2})
+        self.assertEqual(index.free_count(), 2)
+        self.assertEqual(index.allocate().pk, 3)
+        self.assertEqual(index.allocate().pk, 1)
+        self.assertIsNone(index.allocate())
+
+    def test_release(self):
+        first = address(1, "10.0.0.10")
+        index = self.index(first, used={1})
+        self.assertIsNone(index.allocate())
+        index.release(first)
+        self.assertEqual(index.allocate(), first)
+
+    def test_network_broadcast_and_gateway_are_invalid(self):
+        index = self.index(address(1, "10.0.0.0"), address(2, "10.0.0.255"), address(3, "10.0.0.1"),
+                           address(4, "10.0.0.2"))
+        self.assertEqual([item.pk for item in index.invalid], [1, 2, 3])
+        self.assertEqual([item.pk for item in index.free_addresses()], [4])
+
+    def test_duplicates_are_conflicts(self):
+        index = self.index(address(1, "10.0.0.10"), address(2, "10.0.0.10"))
+        self.assertEqual([item.pk for item in index.conflicts["10.0.0.10"]], [1, 2])
+        self.assertEqual(index.free_count(), 1)
+
+    def test_manager_keeps_to_the_network_subnet(self):
+        manager = ipam.AddressManager([address(1, "10.0.1.10"), address(2, "192.168.0.10", gateway=None)], set())
+        lan = Network(network_description="LAN", bridge_name="vmbr1", subnet="10.0.0.0", cidr=16)
+        anything = Network(network_description="Any", bridge_name="vmbr2")
+        self.assertEqual([item.pk for item in manager.free_addresses(lan)], [1])
+        self.assertEqual(manager.allocate(lan).pk, 1)
+        self.assertIsNone(manager.allocate(lan))
+        self.assertEqual(manager.allocate(anything).pk, 2)
+
+
+class IpamAssignmentTests(TestCase):
+
+    def setUp(self):
+        company = Company.objects.create(name="ACME")
+        self.tester = Tester.objects.create(name="Mario Rossi", tester_identifier="T001", company=company)
+        self.activity = Activity.objects.create(activity_identifier="ACT1", target_application_identifier="APP1",
+                                                target_application_name="Portale")
+        self.activity.testers.add(self.tester)
+        self.lan = Network.objects.create(network_description="LAN", bridge_name="vmbr1", subnet="10.0.0.0", cidr=24)
+
+    def test_allocate_activity_gives_distinct_addresses(self):
+        for ip in ("10.0.0.11", "10.0.0.10"):
+            TesterIpAddress.objects.create(ip=ip, cidr=24, gateway="10.0.0.1", tester=self.tester)
+        for index in range(3):
+            vm = VirtualMachine.objects.create(name="vm {index}".format(index=index), os="Kali", ram=1024, cpu=1,
+                                               activity=self.activity)
+            VMNet.objects.create(net=self.lan, vm=vm)
+        allocated = ipam.allocate_activity(self.activity)
+        self.assertEqual(sorted(item.ip for item in allocated.values()), ["10.0.0.10", "10.0.0.11"])
+        self.assertEqual(VMNet.objects.filter(ip__isnull=True).count(), 1)
+
+    def test_check_assignment(self):
+        outside = TesterIpAddress.objects.create(ip="10.0.1.10", cidr=24, tester=self.tester)
+        with self.assertRaises(ipam.IPAMError):
+            ipam.check_assignment(self.lan, outside)
+        inside = TesterIpAddress.objects.create(ip="10.0.0.10", cidr=24, tester=self.tester)
+        vm = VirtualMachine.objects.create(name="vm", os="Kali", ram=1024, cpu=1, activity=self.activity)
+        ipam.check_assignment(self.lan, inside)
+        VMNet.objects.create(net=self.lan, vm=vm, ip=inside)
+        with self.assertRaises(ipam.IPAMError):
+            ipam.check_assignment(self.lan, inside)
+
+
+def qemu(vmid, node="pve1", **extra):
+    return dict({"type": "qemu", "vmid": vmid, "node": node, "name": "vm{vmid}".format(vmid=vmid)}, **extra)
+
+
+class MacAddressIndexTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.configs = {
+            "101": {"net0": "virtio=52:54:00:00:00:01,bridge=vmbr0", "net1": "virtio=52:54:00:00:00:02,bridge=vmbr1"},
+            "102": {"net0": "e1000=52:54:00:00:00:03,bridge=vmbr0"},
+        }
+        self.snapshot = InventorySnapshot([qemu(101), qemu(102)])
+        self.fetched = []
+        inventory_patcher = mock.patch.object(macs, "inventory", mock.Mock(snapshot=lambda cluster: self.snapshot))
+        fetch_patcher = mock.patch.object(macs, "fetch_vm_configs", self.fetch)
+        for patcher in (inventory_patcher, fetch_patcher):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.index = macs.MacAddressIndex("test")
+
+    def fetch(self, vms, cluster):
+        self.fetched.append(sorted(vmid for node, vmid in vms))
+        return {vmid: self.configs[vmid] for node, vmid in vms}
+
+    def test_sync_indexes_the_vm_configs(self):
+        self.index.sync()
+        self.assertTrue(self.index.is_used("52:54:00:00:00:02"))
+        self.assertTrue(self.index.is_used("52:54:00:00:00:03"))
+        self.assertFalse(self.index.is_used("52:54:00:00:00:04"))
+
+    def test_sync_is_incremental(self):
+        self.index.sync()
+        self.index.sync()
+        self.configs["103"] = {"net0": "virtio=52:54:00:00:00:04,bridge=vmbr0"}
+        self.snapshot = InventorySnapshot([qemu(102), qemu(103)])
+        self.index.sync()
+        self.assertEqual(self.fetched, [["101", "102"], ["103"]])
+        self.assertFalse(self.index.is_used("52:54:00:00:00:01"))
+        self.assertTrue(self.index.is_used("52:54:00:00:00:04"))
+
+    def test_allocation_skips_used_and_reserved_addresses(self):
+        cache.add("px_test_mac_52:54:00:00:00:05", True)
+        with mock.patch.object(macs.random, "getrandbits", side_effect=[1, 3, 5, 6]):
+            self.assertEqual(self.index.allocate(vmid=104), "52:54:00:00:00:06")
+        self.assertTrue(self.index.is_used("52:54:00:00:00:06"))
+
+    def test_allocated_addresses_are_unique(self):
+        allocated = [self.index.allocate() for _ in range(200)]
+        self.assertEqual(len(set(allocated)), 200)
+        for mac_address in allocated:
+            self.assertRegex(mac_address, r"^52:54:00(:[0-9A-F]{2}){3}$")
+
+    def test_release_and_register(self):
+        self.index.sync()
+        self.index.release(101, "52:54:00:00:00:01")
+        self.assertFalse(self.index.is_used("52:54:00:00:00:01"))
+        self.index.register(102, "52:54:00:00:00:aa")
+        self.assertTrue(self.index.is_used("52:54:00:00:00:AA"))
+        self.snapshot = InventorySnapshot([qemu(101)])
+        self.index.sync()
+        self.assertFalse(self.index.is_used("52:54:00:00:00:AA"))
+
+
+def done_future(result=None, exception=None):
+    future = Future()
+    if exception:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+class InlineExecutor(object):
+    """ThreadPoolExecutor stand-in running the submitted calls right away, inside the test transaction"""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            return done_future(fn(*args, **kwargs))
+        except Exception as exception:
+            return done_future(exception=exception)
+
+
+class FakeTeardownConnector(object):
+    """Stops and destroys the VMs of a resources list, failing the destroy of the vmids in failing"""
+
+    def __init__(self, resources, cluster_name="default"):
+        self.resources = resources
+        self.cluster_name = cluster_name
+        self.failing = set()
+        self.calls = []
+
+    def _vm(self, vmid):
+        return next(resource for resource in self.resources if str(resource.get("vmid")) == str(vmid))
+
+    def stop_vm_async(self, vmid=None, node=None):
+        self.calls.append(("stop", str(vmid)))
+        self._vm(vmid)["status"] = "stopped"
+        return done_future("OK")
+
+    def delete_vm_async(self, vmid=None, node=None, purge=False):
+        self.calls.append(("delete", str(vmid)))
+        if str(vmid) in self.failing:
+            return done_future(exception=ProxmoxDriverException("VM {vmid} is locked".format(vmid=vmid)))
+        self.resources.remove(self._vm(vmid))
+        return done_future("OK")
+
+
+@override_settings(PROXMOX_DEFAULT_CLUSTER="default")
+class TeardownTests(TestCase):
+
+    def setUp(self):
+        self.activity = Activity.objects.create(activity_identifier="ACT1", target_application_identifier="APP1",
+                                                target_application_name="Portale")
+        self.vm = VirtualMachine.objects.create(name="Kali 1", os="Kali", ram=1024, cpu=1, activity=self.activity,
+                                                vmid="101", node="pve1")
+        self.resources = fake_resources([qemu(101, status="running", pool="ACT1"),
+                                         qemu(102, node="pve2", status="stopped", pool="ACT1"),
+                                         qemu(103, status="running", pool="OTHER")])
+        self.connector = FakeTeardownConnector(self.resources)
+        self.progress = []
+        for patcher in (
+                mock.patch.object(teardown, "inventory",
+                                  mock.Mock(snapshot=lambda cluster: InventorySnapshot(self.resources))),
+                mock.patch.object(teardown, "ProxmoxConnector", lambda cluster: self.connector),
+                mock.patch.object(teardown, "ThreadPoolExecutor", InlineExecutor),
+                mock.patch.object(teardown, "connection"),
+                mock.patch.object(Activity, "px_delete_pool")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def report(self, step, state):
+        self.progress.append((step, state))
+
+    def test_running_vm_is_stopped_then_destroyed(self):
+        teardown.destroy_vm(self.connector, 101, self.report)
+        self.assertEqual(self.connector.calls, [("stop", "101"), ("delete", "101")])
+        self.assertEqual([state for step, state in self.progress], ["STOPPING", "DESTROYING", "DESTROYED"])
+
+    def test_stopped_vm_is_not_stopped_again(self):
+        teardown.destroy_vm(self.connector, 102)
+        self.assertEqual(self.connector.calls, [("delete", "102")])
+
+    def test_missing_vm_counts_as_destroyed(self):
+        teardown.destroy_vm(self.connector, 999, self.report)
+        self.assertEqual(self.connector.calls, [])
+        self.assertEqual(self.progress, [("VM 999", "DESTROYED")])
+
+    def test_teardown_destroys_the_pool_vms_and_the_pool(self):
+        results = teardown.teardown_activity(self.activity)
+        self.assertEqual(results, {("default", "101"): None, ("default", "102"): None})
+        self.assertEqual(set(InventorySnapshot(self.resources).vms), {"103"})
+        self.vm.refresh_from_db()
+        self.assertIsNone(self.vm.vmid)
+        Activity.px_delete_pool.assert_called_once_with()
+
+    def test_incomplete_teardown_keeps_the_pool_and_can_be_resumed(self):
+        self.connector.failing = {"102"}
+        with self.assertRaises(teardown.TeardownIncomplete):
+            teardown.teardown_activity(self.activity)
+        Activity.px_delete_pool.assert_not_called()
+        self.vm.refresh_from_db()
+        self.assertIsNone(self.vm.vmid)
+
+        self.connector.failing = set()
+        self.connector.calls = []
+        teardown.teardown_activity(self.activity)
+        self.assertEqual(self.connector.calls, [("delete", "102")])
+        Activity.px_delete_pool.assert_called_once_with()
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(limits, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bucket = limits.TokenBucket(rate=10, burst=8)
+
+    def test_burst_then_rate(self):
+        for _ in range(8):
+            self.assertEqual(self.bucket.try_take(), 0)
+        self.assertAlmostEqual(self.bucket.try_take(), 0.1)
+        self.clock.now += 0.1
+        self.assertEqual(self.bucket.try_take(), 0)
+
+    def test_floor_reserves_the_last_tokens(self):
+        for _ in range(5):
+            self.assertEqual(self.bucket.try_take(floor=3), 0)
+        self.assertAlmostEqual(self.bucket.try_take(floor=3), 0.1)
+        for _ in range(3):
+            self.assertEqual(self.bucket.try_take(), 0)
+        self.assertAlmostEqual(self.bucket.try_take(floor=3), 0.4)
+
+    def test_refill_is_capped_at_burst(self):
+        for _ in range(8):
+            self.bucket.try_take()
+        self.clock.now += 60
+        for _ in range(8):
+            self.assertEqual(self.bucket.try_take(), 0)
+        self.assertGreater(self.bucket.try_take(), 0)
+
+    def test_no_rate_means_no_limit(self):
+        bucket = limits.TokenBucket(rate=0, burst=0)
+        self.assertEqual(bucket.try_take(floor=5), 0)
+
+
+class KeyedSemaphoreTests(SimpleTestCase):
+
+    @override_settings(PROXMOX_TEST_SLOTS=1)
+    def test_one_bounded_semaphore_per_key(self):
+        slots = limits.KeyedSemaphore("PROXMOX_TEST_SLOTS", 3)
+        self.assertIs(slots(("a", "pve1")), slots(("a", "pve1")))
+        self.assertTrue(slots(("a", "pve1")).acquire(blocking=False))
+        self.assertFalse(slots(("a", "pve1")).acquire(blocking=False))
+        self.assertTrue(slots(("b", "pve1")).acquire(blocking=False))
+
+    def test_default_bound(self):
+        slots = limits.KeyedSemaphore("PROXMOX_TEST_SLOTS", 2)
+        semaphore = slots("pve1")
+        self.assertTrue(semaphore.acquire(blocking=False))
+        self.assertTrue(semaphore.acquire(blocking=False))
+        self.assertFalse(semaphore.acquire(blocking=False))
+
+    def test_clone_slots_take_the_storage_slot_only_when_known(self):
+        node_slots = limits.KeyedSemaphore("PROXMOX_TEST_SLOTS", 1)
+        storage_slots = limits.KeyedSemaphore("PROXMOX_TEST_SLOTS", 1)
+        with mock.patch.object(limits, "clone_slots_per_node", node_slots), \
+                mock.patch.object(limits, "clone_slots_per_storage", storage_slots):
+            with limits.clone_slots("a", "pve1"):
+                self.assertFalse(node_slots(("a", "pve1")).acquire(blocking=False))
+                self.assertEqual(storage_slots._semaphores, {})
+                self.assertTrue(node_slots(("a", "pve2")).acquire(blocking=False))
+            with limits.clone_slots("a", "pve3", "local-lvm"):
+                self.assertFalse(storage_slots(("a", "pve3", "local-lvm")).acquire(blocking=False))
+                self.assertTrue(storage_slots(("b", "pve3", "local-lvm")).acquire(blocking=False))
+            self.assertTrue(node_slots(("a", "pve1")).acquire(blocking=False))
+
+
+class AdmissionTests(SimpleTestCase):
+
+    def test_lanes(self):
+        self.assertEqual(admission.current_lane(), admission.BULK)
+        with admission.interactive_lane():
+            self.assertEqual(admission.current_lane(), admission.INTERACTIVE)
+            self.assertEqual(admission._floor(admission.current_lane()), 0)
+        self.assertEqual(admission.current_lane(), admission.BULK)
+
+    @override_settings(PROXMOX_RATE_INTERACTIVE_RESERVE=7)
+    def test_bulk_lane_leaves_the_reserve(self):
+        self.assertEqual(admission._floor(admission.BULK), 7)
+
+    def test_heavy_calls_and_nodes(self):
+        self.assertTrue(admission.is_heavy("POST", "/api2/json/nodes/pve1/qemu/100/clone"))
+        self.assertFalse(admission.is_heavy("GET", "/api2/json/nodes/pve1/qemu/100/config"))
+        self.assertEqual(admission.node_of("/api2/json/nodes/pve2/qemu/100/config"), "pve2")
+        self.assertEqual(admission.node_of("/api2/json/cluster/resources"), "cluster")
+
+
+def response(status_code, reason="OK"):
+    return mock.Mock(status_code=status_code, reason=reason)
+
+
+class ResilienceTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        for patcher in (mock.patch.object(resilience, "time", self.clock),
+                        mock.patch.object(resilience.random, "uniform", lambda low, high: high),
+                        mock.patch.dict(resilience._breakers, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def session(self, *outcomes):
+        """A session whose requests return (or raise) the given outcomes in order"""
+        self.request = mock.Mock(side_effect=list(outcomes))
+        return resilience.resilient_session(mock.Mock(request=self.request), "default")
+
+    def test_classify(self):
+        self.assertEqual(resilience.classify(500, "VM 100 is locked (clone)"), resilience.LOCKED)
+        self.assertEqual(resilience.classify(500, "can't lock file '/var/lock/qemu-server/lock-100.conf'"),
+                         resilience.LOCKED)
+        self.assertEqual(resilience.classify(502, "Bad Gateway"), resilience.TRANSIENT)
+        self.assertEqual(resilience.classify(595, "Connection refused"), resilience.TRANSIENT)
+        self.assertEqual(resilience.classify(500, "unable to parse value"), resilience.PERMANENT)
+        self.assertEqual(resilience.classify(403, "Permission check failed"), resilience.PERMANENT)
+
+    def test_transient_failures_are_retried_when_idempotent_or_not_executed(self):
+        self.assertIsNotNone(resilience.retry_delay(resilience.TRANSIENT, "GET", 0))
+        self.assertIsNotNone(resilience.retry_delay(resilience.TRANSIENT, "put", 0))
+        self.assertIsNone(resilience.retry_delay(resilience.TRANSIENT, "POST", 0))
+        self.assertIsNotNone(resilience.retry_delay(resilience.TRANSIENT, "POST", 0, executed=False))
+        self.assertIsNone(resilience.retry_delay(resilience.PERMANENT, "GET", 0))
+        self.assertIsNone(resilience.retry_delay(None, "GET", 0))
+
+    @override_settings(PROXMOX_RETRY_ATTEMPTS=4, PROXMOX_RETRY_DELAY=1, PROXMOX_RETRY_MAX_DELAY=3,
+                       PROXMOX_LOCK_RETRY_ATTEMPTS=6)
+    def test_backoff_is_capped_and_attempts_bounded(self):
+        delays = [resilience.retry_delay(resilience.TRANSIENT, "GET", attempt) for attempt in range(4)]
+        self.assertEqual(delays, [1, 2, 3, None])
+        self.assertIsNotNone(resilience.retry_delay(resilience.LOCKED, "POST", 4))
+        self.assertIsNone(resilience.retry_delay(resilience.LOCKED, "POST", 5))
+
+    def test_interactive_lane_retries_once(self):
+        with admission.interactive_lane():
+            self.assertIsNotNone(resilience.retry_delay(resilience.LOCKED, "POST", 0))
+            self.assertIsNone(resilience.retry_delay(resilience.LOCKED, "POST", 1))
+
+    @override_settings(PROXMOX_BREAKER_THRESHOLD=2, PROXMOX_BREAKER_COOLDOWN=10)
+    def test_breaker_transitions(self):
+        breaker = resilience.CircuitBreaker()
+        breaker.failure()
+        self.assertFalse(breaker.is_open)
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+        self.assertTrue(breaker.suspended)
+        self.assertFalse(breaker.allow())
+        self.clock.now += 10
+        self.assertFalse(breaker.suspended)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertTrue(breaker.suspended)
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        self.clock.now += 10
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+    @override_settings(PROXMOX_BREAKER_THRESHOLD=2, PROXMOX_BREAKER_COOLDOWN=10)
+    def test_released_trial_lets_the_next_request_through(self):
+        breaker = resilience.CircuitBreaker()
+        breaker.failure()
+        breaker.failure()
+        self.clock.now += 10
+        self.assertTrue(breaker.allow())
+        breaker.release()
+        self.assertTrue(breaker.allow())
+
+    def test_session_retries_transient_errors(self):
+        session = self.session(response(502, "Bad Gateway"), resilience.Timeout(), response(200))
+        self.assertEqual(session.request("GET", "https://pve:8006/api2/json/nodes/pve1/status").status_code, 200)
+        self.assertEqual(self.request.call_count, 3)
+        self.assertFalse(resilience.breaker_for("default", "pve1").is_open)
+
+    def test_session_does_not_retry_executed_posts(self):
+        session = self.session(response(502, "Bad Gateway"), response(200))
+        self.assertEqual(session.request("POST", "https://pve:8006/api2/json/nodes/pve1/qemu/100/clone").status_code,
+                         502)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_session_does_not_retry_tls_errors(self):
+        session = self.session(resilience.SSLError("certificate verify failed"), response(200))
+        with self.assertRaises(resilience.SSLError):
+            session.request("GET", "https://pve:8006/api2/json/nodes/pve1/status")
+        self.assertEqual(self.request.call_count, 1)
+        self.assertFalse(resilience.breaker_for("default", "pve1").is_open)
+
+    @override_settings(PROXMOX_BREAKER_THRESHOLD=2, PROXMOX_RETRY_ATTEMPTS=2)
+    def test_session_fails_fast_on_an_open_breaker(self):
+        session = self.session(response(503), response(503), response(200))
+        self.assertEqual(session.request("GET", "https://pve:8006/api2/json/nodes/pve1/status").status_code, 503)
+        with self.assertRaises(resilience.CircuitOpenError):
+            session.request("GET", "https://pve:8006/api2/json/nodes/pve1/status")
+        self.assertEqual(session.request("GET", "https://pve:8006/api2/json/nodes/pve2/status").status_code, 200)
+
+
+def upid(node, kind, vmid, starttime="65A0B1C2"):
+    return "UPID:{node}:0000A1B2:0012C3D4:{starttime}:{kind}:{vmid}:root@pam:".format(
+        node=node, kind=kind, vmid=vmid, starttime=starttime)
+
+
+class EventWatcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tasks = []
+        self.log = []
+        connector = mock.Mock(get_cluster_tasks=lambda: self.tasks, get_cluster_log=lambda max: self.log)
+        self.invalidated = []
+        for patcher in (mock.patch.object(events, "ProxmoxConnector", lambda cluster: connector),
+                        mock.patch.object(events, "invalidate", self.invalidate)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.watcher = events.EventWatcher("default")
+
+    def invalidate(self, family, *parts, namespace=None):
+        self.assertEqual(namespace, "default")
+        self.invalidated.append((family,) + parts)
+
+    def poll(self):
+        self.invalidated = []
+        self.watcher.poll()
+        return set(self.invalidated)
+
+    def test_parse_upid(self):
+        self.assertEqual(events.parse_upid(upid("pve2", "qmstart", "101")),
+                         {"upid": upid("pve2", "qmstart", "101"), "node": "pve2", "type": "qmstart", "id": "101",
+                          "user": "root@pam"})
+
+    def test_invalidations(self):
+        self.assertEqual(events.invalidations("qmstop", "pve1", "101"),
+                         [("vm", "pve1", "101"), ("vms", "pve1"), ("inventory",)])
+        self.assertIn(("vm_config", "pve1", "101"), events.invalidations("qmconfig", "pve1", "101"))
+        self.assertIn(("vms",), events.invalidations("qmclone", "pve1", "100"))
+        self.assertIn(("vm_config",), events.invalidations("qmigrate", "pve1", "101"))
+        self.assertEqual(events.invalidations("srvreload", "pve1", "networking"),
+                         [("interfaces",), ("network_index",)])
+        self.assertEqual(events.invalidations("srvreload", "pve1", "pveproxy"), [])
+        self.assertEqual(events.invalidations("vzdump", "pve1", "101"), [("vms", "pve1"), ("inventory",)])
+        self.assertEqual(events.invalidations("aptupdate", "pve1", ""), [])
+
+    def test_first_poll_drops_everything(self):
+        self.assertIn(("inventory",), self.poll())
+        self.assertIn(("vm_config",), self.invalidated)
+
+    def test_tasks_and_log_lines_are_handled_once(self):
+        self.tasks = [{"upid": upid("pve1", "qmstop", "101"), "type": "qmstop", "node": "pve1", "id": "101",
+                       "endtime": 1000}]
+        self.poll()
+        self.tasks.append({"upid": upid("pve2", "qmconfig", "102"), "type": "qmconfig", "node": "pve2",
+                           "id": "102", "endtime": 1010})
+        self.log = [{"node": "pve3", "uid": 7, "time": 1011,
+                     "msg": "end task {upid} OK".format(upid=upid("pve3", "qmstart", "103"))},
+                    {"node": "pve1", "uid": 8, "time": 1012, "msg": "update VM 104: -memory 2048"}]
+        self.assertEqual(self.poll(), {("vm", "pve2", "102"), ("vm_config", "pve2", "102"), ("vms", "pve2"),
+                                       ("vm", "pve3", "103"), ("vms", "pve3"),
+                                       ("vm", "pve1", "104"), ("vm_config", "pve1", "104"), ("vms", "pve1"),
+                                       ("inventory",)})
+        self.assertEqual(self.poll(), set())
+
+    @override_settings(PROXMOX_EVENT_WINDOW=600)
+    def test_events_older_than_the_window_are_forgotten(self):
+        seen = {}
+        self.assertEqual(self.watcher._new(seen, [("a", 1000, "a"), ("b", 1500, "b")]), ["a", "b"])
+        self.assertEqual(self.watcher._new(seen, [("a", 1000, "a"), ("c", 1700, "c"), ("d", 900, "d")]), ["c"])
+        self.assertEqual(set(seen), {"b", "c"})
+
+
+class FakeAclConnector(object):
+
+    def __init__(self, users=(), pools=(), acl=()):
+        self.users = users
+        self.pools = pools
+        self.acl = list(acl)
+        self.updates = []
+
+    def get_users(self):
+        return [{"userid": userid} for userid in self.users]
+
+    def get_pools(self):
+        return [{"poolid": poolid} for poolid in self.pools]
+
+    def get_acl(self):
+        return self.acl
+
+    def update_acl(self, path=None, roles=None, users=None, delete=False):
+        self.updates.append((path, roles, users, delete))
+        for userid in users:
+            entry = {"path": path, "roleid": roles[0], "type": "user", "ugid": userid, "propagate": 1}
+            if delete:
+                self.acl = [current for current in self.acl if current != entry]
+            else:
+                self.acl.append(entry)
+
+
+def acl_entry(path, userid, roleid="PVEVMUser", kind="user"):
+    return {"path": path, "roleid": roleid, "type": kind, "ugid": userid, "propagate": 1}
+
+
+@override_settings(PROXMOX_USER_REALM="pve", PROXMOX_DEFAULT_CLUSTER="default", PROXMOX_TESTER_ROLE="PVEVMUser")
+class AclSyncTests(TestCase):
+
+    def setUp(self):
+        company = Company.objects.create(name="ACME")
+        self.testers = [Tester.objects.create(name="Tester {n}".format(n=n), tester_identifier="T00{n}".format(n=n),
+                                              company=company) for n in range(1, 4)]
+        self.activity = Activity.objects.create(activity_identifier="ACT1", target_application_identifier="APP1",
+                                                target_application_name="Portale")
+        self.activity.testers.add(*self.testers[:2])
+        self.connector = FakeAclConnector(users=("t001@pve", "t002@pve", "t003@pve"), pools=("ACT1", "OTHER"))
+        patcher = mock.patch.object(acl, "ProxmoxConnector", lambda cluster: self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_grants_the_missing_entries(self):
+        result = acl.plan()
+        self.assertEqual(dict(result.grants), {"/pool/ACT1": {"t001@pve", "t002@pve"}})
+        self.assertEqual(dict(result.revokes), {})
+        self.assertEqual(list(result.batches()), [("/pool/ACT1", ["t001@pve", "t002@pve"], False)])
+
+    def test_revokes_stale_entries_and_keeps_unmanaged_ones(self):
+        self.connector.acl = [acl_entry("/pool/ACT1", "t001@pve"), acl_entry("/pool/ACT1", "t003@pve"),
+                              acl_entry("/pool/OTHER", "t002@pve"), acl_entry("/pool/OTHER", "admin@pve"),
+                              acl_entry("/pool/ACT1", "auditor@pve", roleid="PVEAuditor"),
+                              acl_entry("/vms/100", "t003@pve")]
+        result = acl.plan()
+        self.assertEqual(dict(result.grants), {"/pool/ACT1": {"t002@pve"}})
+        self.assertEqual(dict(result.revokes), {"/pool/ACT1": {"t003@pve"}, "/pool/OTHER": {"t002@pve"}})
+        self.assertEqual(list(result.batches()), [("/pool/ACT1", ["t003@pve"], True),
+                                                  ("/pool/OTHER", ["t002@pve"], True),
+                                                  ("/pool/ACT1", ["t002@pve"], False)])
+
+    def test_scoped_plan_only_touches_the_given_pools(self):
+        self.connector.acl = [acl_entry("/pool/OTHER", "t002@pve")]
+        result = acl.plan(activities=[self.activity])
+        self.assertEqual(dict(result.revokes), {})
+        self.assertEqual(dict(result.grants), {"/pool/ACT1": {"t001@pve", "t002@pve"}})
+
+    def test_missing_users_and_pools(self):
+        self.connector.users = ("t001@pve",)
+        other = Activity.objects.create(activity_identifier="ACT2", target_application_identifier="APP2",
+                                        target_application_name="Intranet")
+        other.testers.add(self.testers[2])
+        result = acl.plan()
+        self.assertEqual(result.missing_users, {"t002@pve"})
+        self.assertEqual(result.missing_pools, {"ACT2"})
+        self.assertEqual(dict(result.grants), {"/pool/ACT1": {"t001@pve"}})
+
+    def test_sync_makes_no_call_once_in_sync(self):
+        acl.sync()
+        self.assertEqual(len(self.connector.updates), 1)
+        result = acl.sync()
+        self.assertFalse(result)
+        self.assertEqual(len(self.connector.updates), 1)
+
+    @override_settings(PROXMOX_ACL_BATCH_SIZE=2)
+    def test_batches_are_bounded(self):
+        self.activity.testers.add(self.testers[2])
+        self.assertEqual([users for path, users, delete in acl.plan().batches()],
+                         [["t001@pve", "t002@pve"], ["t003@pve"]])
+
+    def test_only_activities_of_the_cluster(self):
+        Activity.objects.filter(pk=self.activity.pk).update(cluster="other")
+        self.assertFalse(acl.plan("default"))
@@ -0,0 +1,137 @@
+from django.conf import settings
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from .proxmox import ProxmoxConnector, ProxmoxDriverException
+from .clusters import default_cluster
+import threading
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Tracks asynchronous Proxmox tasks (UPIDs) with a single poller thread per cluster.
+
+Every round sweeps /cluster/tasks once for all pending UPIDs and falls back to per-task status calls only for the
+UPIDs missing from the sweep. The interval backs off while nothing completes and resets when new tasks are tracked
+or some task finishes.
+"""
+
+
+class ProxmoxTaskFailed(ProxmoxDriverException):
+    pass
+
+
+class ProxmoxTaskTimeout(ProxmoxDriverException):
+    pass
+
+
+def task_result(future: Future, timeout: float = None):
+    """Wait for a tracked task; one still running after timeout seconds raises ProxmoxTaskTimeout"""
+    timeout = timeout or getattr(settings, "PROXMOX_TASK_TIMEOUT", 1800)
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        raise ProxmoxTaskTimeout("Task still running after {timeout}s".format(timeout=timeout)) from None
+
+
+def node_of(upid: str) -> str:
+    # UPID:{node}:{pid}:{pstart}:{starttime}:{type}:{id}:{user}:
+    return upid.split(":")[1]
+
+
+class TaskTracker(object):
+
+    def __init__(self, cluster: str):
+        self.cluster = cluster
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}
+        self._thread = None
+
+    def track(self, upid: str) -> Future:
+        with self._lock:
+            if upid not in self._pending:
+                self._pending[upid] = Future()
+            future = self._pending[upid]
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll_loop, daemon=True,
+                                                name="proxmox-task-tracker-" + self.cluster)
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def wait(self, upid: str, timeout: float = None):
+        try:
+            return task_result(self.track(upid), timeout)
+        except ProxmoxTaskTimeout as e:
+            raise ProxmoxTaskTimeout("{upid}: {error}".format(upid=upid, error=e)) from None
+
+    def _resolve(self, upid: str, status: str, entry: dict):
+        with self._lock:
+            future = self._pending.pop(upid, None)
+        if future is None:
+            return
+        # PVE ends a task that completed with warnings with "WARNINGS: <count>"
+        if status == "OK" or str(status).startswith("WARNINGS"):
+            future.set_result(entry)
+        else:
+            future.set_exception(ProxmoxTaskFailed("Task {upid} failed: {status}".format(upid=upid, status=status)))
+
+    def sweep(self) -> int:
+        """Resolve every finished pending task, returns how many were resolved"""
+        with self._lock:
+            pending = list(self._pending)
+        if not pending:
+            return 0
+        connector = ProxmoxConnector(self.cluster)
+        finished = 0
+        tasks = {task.get("upid"): task for task in connector.get_cluster_tasks()}
+        for upid in pending:
+            # a task whose status cannot be read is tried again on the next round, without holding up the others
+            try:
+                task = tasks.get(upid)
+                if task is not None:
+                    if task.get("status"):
+                        self._resolve(upid, task["status"], task)
+                        finished += 1
+                    continue
+                status = connector.get_task_status(upid, node=node_of(upid))
+                if status.get("status") == "stopped":
+                    self._resolve(upid, status.get("exitstatus"), status)
+                    finished += 1
+            except Exception:
+                logger.exception("Could not read the status of task %s", upid)
+        return finished
+
+    def _poll_loop(self):
+        min_interval = getattr(settings, "PROXMOX_TASK_POLL_MIN_INTERVAL", 1)
+        max_interval = getattr(settings, "PROXMOX_TASK_POLL_MAX_INTERVAL", 10)
+        interval = min_interval
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+            try:
+                interval = min_interval if self.sweep() else min(interval * 2, max_interval)
+            except Exception:
+                # the thread must survive anything, or every pending future would wait for its timeout
+                logger.exception("Could not poll Proxmox tasks")
+                interval = max_interval
+            if self._wakeup.wait(interval):
+                self._wakeup.clear()
+                interval = min_interval
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def tracker_for(cluster: str = None) -> TaskTracker:
+    cluster = cluster or default_cluster()
+    with _trackers_lock:
+        if cluster not in _trackers:
+            _trackers[cluster] = TaskTracker(cluster)
+        return _trackers[cluster]
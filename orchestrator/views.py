@@ -1,35 +1,91 @@
 from django.shortcuts import render
 
 from django.conf import settings
-from django.views.generic.list import BaseListView
+from django.core.paginator import Paginator
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import JsonResponse
-from orchestrator.proxmox import ProxmoxConnector, ProxmoxNotConnectedException
+from django.http import JsonResponse, HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.decorators import method_decorator
+from django.views.generic import View, TemplateView
+from orchestrator.proxmox import ProxmoxDriverException
+from orchestrator.metrics import registry
+from orchestrator.models import Network
+from orchestrator.networks import network_index
+from orchestrator.clusters import cluster_names
 from django.contrib.auth.mixins import LoginRequiredMixin
+import hashlib
+import json
 
 
-class PxeNetworks(LoginRequiredMixin, BaseListView):
+class PxeNetworks(LoginRequiredMixin, View):
+    """
+    Select2 data view over orchestrator.networks, of every cluster or of the one given by cluster: filtered by term,
+    paginated by page, without the bridges already bound to a Network other than the one given by network (the one
+    being edited). Responses carry ETag/Last-Modified so that repeated lookups end in a 304.
+    """
 
     def get(self, request, *args, **kwargs):
         try:
-            bridges = ProxmoxConnector().get_interfaces_list()
+            cluster = request.GET.get('cluster')
+            index = network_index(cluster if cluster in cluster_names() else None)
+        except ProxmoxDriverException:
             return JsonResponse({
                 'results': [
                     {
-                        'text': obj.get('iface'),
-                        'id': obj.get('iface'),
+                        'text': "Could not connect to Proxmox!",
+                        'disabled': True
                     }
-                    for obj in bridges if obj.get('iface')
                 ],
                 'more': False
-            })
-        except ProxmoxNotConnectedException:
-            return JsonResponse({
+            }, status=500)
+        term = request.GET.get('term', '')
+        page_number = request.GET.get('page', 1)
+        bound = Network.objects.all()
+        if request.GET.get('network', '').isdigit():
+            bound = bound.exclude(pk=request.GET['network'])
+        bound = set(bound.values_list('bridge_name', flat=True))
+        etag = quote_etag(hashlib.sha1(json.dumps([index.digest, sorted(bound), term, page_number]).encode())
+                          .hexdigest())
+        response = get_conditional_response(request, etag=etag, last_modified=index.built_at)
+        if response is None:
+            paginator = Paginator(index.search(term, exclude=bound),
+                                  getattr(settings, "PXE_NETWORKS_PAGE_SIZE", 25))
+            page = paginator.get_page(page_number)
+            response = JsonResponse({
                 'results': [
                     {
-                        'text': "Could not connect to Proxmox!",
-                        'disabled': True
+                        'text': entry['text'],
+                        'id': entry['id'],
                     }
+                    for entry in page
                 ],
-                'more': False
-            }, status=500)
+                'more': page.has_next()
+            })
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(index.built_at)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class ProxmoxMetrics(View):
+    """Prometheus exposition of orchestrator.metrics, for staff users or bearing ORCHESTRATOR_METRICS_TOKEN"""
+
+    def get(self, request, *args, **kwargs):
+        token = getattr(settings, "ORCHESTRATOR_METRICS_TOKEN", None)
+        authorization = request.META.get("HTTP_AUTHORIZATION", "")
+        if not (request.user.is_active and request.user.is_staff) and \
+                not (token and constant_time_compare(authorization, "Bearer {token}".format(token=token))):
+            return HttpResponse("Forbidden", status=403, content_type="text/plain")
+        return HttpResponse(registry.render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class ProxmoxMetricsSummary(TemplateView):
+    template_name = "admin/orchestrator/proxmox_metrics.html"
+
+    def get_context_data(self, **kwargs):
+        context = super(ProxmoxMetricsSummary, self).get_context_data(**kwargs)
+        context.update(registry.summary(), title="Metriche Proxmox")
+        return context
@@ -1,9 +1,21 @@
-from .models import VirtualMachine
+from .models import VirtualMachine, Activity
 import taskflow.engines
 from taskflow.patterns import linear_flow as lf
 from taskflow import task
-from .proxmox import ProxmoxConnector
-from django.utils.text import slugify
+from taskflow.types import failure, notifier
+from .proxmox import ProxmoxConnector, ProxmoxDriverException
+from .limits import clone_slots
+from . import warmpool
+from .cloudinit.engine import render_vm, publish as publish_cloudinit, prepare_activity as prepare_cloudinit
+from .scope import lookup_scope
+from .inventory import inventory
+from .placement import PlacementScheduler
+from .macs import mac_index_for
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection
+import logging
+logger = logging.getLogger("orchestrator")
 
 """
 PRE : Ensure pool exists, if not create related pool (bind this to the parent activity)
@@ -20,44 +32,105 @@ PRE : Ensure pool exists, if not create related pool (bind this to the parent ac
 
 
 
+def create_pool(activity: Activity):
+    """(poolid, whether this call created it)"""
+    created = not activity.px_has_pool_been_created()
+    return activity.px_create_pool(), created
+
+
+def revert_pool(activity: Activity, result):
+    """
+    Remove the pool only when it was created by the reverted task and holds no VM: the pool is shared by all the
+    VMs of the activity, and a failed revert would abort the whole engine
+    """
+    if isinstance(result, failure.Failure) or not result or not result[1]:
+        return
+    try:
+        if not ProxmoxConnector(activity.cluster).get_resource_pool(result[0]).get('members'):
+            activity.px_delete_pool()
+    except ProxmoxDriverException:
+        logger.exception("Could not remove pool %s while reverting its creation", result[0])
+
 class CreatePool(task.Task):
+    default_provides = ('poolid', 'pool_created')
+
     def execute(self, vm: VirtualMachine, *args, **kwargs):
-        if not vm.activity.px_has_pool_been_created():
-            return ProxmoxConnector().create_resource_pool(
-                poolid=slugify(vm.activity.activity_identifier).upper(),
-                comment='{activity_identifier} - {target_application_identifier} {target_application_name}'.format(
-                    activity_identifier=vm.activity.activity_identifier,
-                    target_application_identifier=vm.activity.target_application_identifier,
-                    target_application_name=vm.activity.target_application_name
-                )
-            )
-        return slugify(vm.activity.activity_identifier).upper()
-
-    def rollback(self, vm: VirtualMachine, *args, **kwargs):
-        return ProxmoxConnector().delete_resource_pool(poolid=slugify(vm.activity.activity_identifier))
+        return create_pool(vm.activity)
+
+    def revert(self, vm: VirtualMachine, result, *args, **kwargs):
+        revert_pool(vm.activity, result)
+
+class CreateActivityPool(task.Task):
+    default_provides = ('poolid', 'pool_created')
+
+    def execute(self, activity: Activity, *args, **kwargs):
+        return create_pool(activity)
+
+    def revert(self, activity: Activity, result, *args, **kwargs):
+        revert_pool(activity, result)
+
+class PlaceVM(task.Task):
+    default_provides = 'node'
+
+    def execute(self, vm: VirtualMachine, poolid: str, *args, **kwargs):
+        if not vm.node:
+            scheduler = PlacementScheduler.from_inventory(inventory.snapshot(vm.px_cluster))
+            vm.node = scheduler.place(vm.ram, vm.cpu, activity=poolid)
+            vm.save(update_fields=["node"])
+        return vm.node
 
 class CloneTemplate(task.Task):
-    def execute(self, vm: VirtualMachine, *args, **kwargs):
-        vm.px_create_vm() # # @todo Add pool returned above here
+    default_provides = 'vmid'
 
-class SetRAM(task.Task):
-    def execute(self, vm: VirtualMachine, *args, **kwargs):
-        vm.set
-        pass
+    def execute(self, vm: VirtualMachine, poolid: str, node: str, *args, **kwargs):
+        storage = getattr(settings, "PROXMOX_CLONE_STORAGE", None)
+        vmid = warmpool.claim(vm.os, poolid, node=node, cluster=vm.px_cluster)
+        if vmid is None:
+            template = settings.PROXMOX_TEMPLATES[vm.os]
+            template_vm = inventory.snapshot(vm.px_cluster).get_vm(template)
+            with clone_slots(vm.px_cluster, node, storage):
+                vmid = ProxmoxConnector(vm.px_cluster).clone_vm(vm.hostname, template, pool=poolid, target=node,
+                                                   node=template_vm['node'] if template_vm else node)
+        else:
+            # a warm VM on another node than the placed one is used where it is, see orchestrator.warmpool
+            node = inventory.snapshot(vm.px_cluster).get_vm(vmid)['node']
+        vm.vmid, vm.node = vmid, node
+        vm.save(update_fields=["vmid", "node"])
+        return vmid
 
-class SetCPU(task.Task):
-    def execute(self, vm: VirtualMachine, *args, **kwargs):
-        pass
+    def revert(self, vm: VirtualMachine, *args, **kwargs):
+        if vm.vmid:
+            try:
+                ProxmoxConnector(vm.px_cluster).delete_vm(vmid=vm.vmid, node=vm.node)
+            except ProxmoxDriverException:
+                logger.exception("Could not remove VM %s while reverting its creation", vm.vmid)
+            vm.vmid = None
+            vm.save(update_fields=["vmid"])
 
-class AssignNetworks(task.Task):
-    def execute(self, vm: VirtualMachine, *args, **kwargs):
-        pass
+class ConfigureVM(task.Task):
+    """Name, RAM, CPU, networks and cloud-init ipconfig, written with a single config POST"""
+
+    def execute(self, vm: VirtualMachine, vmid: str, *args, **kwargs):
+        config = ProxmoxConnector(vm.px_cluster).configure_vm(vmid, node=vm.node)
+        config.name(vm.hostname).memory(vm.ram, settings.PROXMOX_VM_MIN_RAM).cores(vm.cpu)
+        for vmnet in vm.vmnet_set.select_related("net", "ip").order_by("pk"):
+            net, mac_address = config.ensure_net(vmnet.net.bridge_name)
+            if vmnet.ip:
+                config.ipconfig(int(net[3:]), vmnet.ip.ip, vmnet.ip.cidr, vmnet.ip.gateway)
+            else:
+                config.ipconfig(int(net[3:]))
+        return config.apply()
 
 class PrepareCloudInit(task.Task):
-    pass
+    default_provides = 'cloudinit'
+
+    def execute(self, vm: VirtualMachine, vmid: str, *args, **kwargs):
+        return render_vm(vm)
 
 class AttachCloudInit(task.Task):
-    pass
+
+    def execute(self, vm: VirtualMachine, cloudinit: dict, *args, **kwargs):
+        return publish_cloudinit(vm, cloudinit)
 
 class CreateEvidenceStorage(task.Task):
     pass
@@ -66,6 +139,76 @@ class AttachEvidenceStorage(task.Task):
     pass
 
 
+def build_vm_flow(vm: VirtualMachine):
+    return lf.Flow('vm_{pk}_creation_flow'.format(pk=vm.pk)).add(
+        PlaceVM(),
+        CloneTemplate(),
+        ConfigureVM(),
+    )
+
+
 vm_creation_flow = lf.Flow('vm_creation_flow').add(
-    CreatePool()
-)
\ No newline at end of file
+    CreatePool(),
+    PlaceVM(),
+    CloneTemplate(),
+    ConfigureVM(),
+    PrepareCloudInit(),
+    AttachCloudInit(),
+)
+
+
+def run_flow(flow, store: dict, progress=None):
+    """Run a flow, reporting every task state change to progress(task_name, state) when given"""
+    engine = taskflow.engines.load(flow, store=store)
+    if progress:
+        engine.atom_notifier.register(notifier.Notifier.ANY,
+                                      lambda state, details: progress(details.get('task_name') or details.get('atom_name'), state))
+    engine.run()
+    return engine.storage.fetch_all()
+
+
+def _run_vm_flow(vm: VirtualMachine, poolid: str, progress=None):
+    try:
+        with lookup_scope():
+            run_flow(build_vm_flow(vm), {'vm': vm, 'poolid': poolid},
+                     progress=(lambda step, state: progress("{vm}: {step}".format(vm=vm, step=step), state))
+                     if progress else None)
+    finally:
+        connection.close()
+
+
+def provision_activity(activity: Activity, progress=None) -> dict:
+    """
+    Create the activity pool once, then clone and configure every VM of the activity concurrently.
+    Each VM runs in its own engine, so a failure only reverts that VM.
+    Cloud-init documents are then rendered for the whole activity at once and uploaded where they changed.
+    Returns a dict mapping VirtualMachine pk to None on success or to the raised exception.
+    """
+    poolid = run_flow(lf.Flow('activity_pool_flow').add(CreateActivityPool()), {'activity': activity},
+                      progress=progress)['poolid']
+    vms = [vm for vm in activity.vms.all() if not vm.px_has_vm_been_created()]
+    scheduler = PlacementScheduler.from_inventory(inventory.snapshot(activity.cluster))
+    for vm in vms:
+        if not vm.node:
+            vm.node = scheduler.place(vm.ram, vm.cpu, activity=poolid)
+            vm.save(update_fields=["node"])
+    # index the cluster MAC addresses once, before the concurrent NIC attachments need it
+    mac_index_for(activity.cluster).sync()
+    results = {}
+    with ThreadPoolExecutor(max_workers=getattr(settings, "PROXMOX_PROVISIONING_WORKERS", 8)) as executor:
+        futures = {vm.pk: executor.submit(_run_vm_flow, vm, poolid, progress) for vm in vms}
+        for pk, future in futures.items():
+            exception = future.exception()
+            if exception:
+                logger.error("Provisioning of VM %s failed: %s", pk, exception)
+            results[pk] = exception
+    if progress:
+        progress("cloud-init", "RUNNING")
+    prepare_cloudinit(activity)
+    if progress:
+        progress("cloud-init", "SUCCESS")
+        progress("authorizations", "RUNNING")
+    activity.px_sync_authorizations()
+    if progress:
+        progress("authorizations", "SUCCESS")
+    return results
@@ -0,0 +1,118 @@
+from .scope import memoized, forget
+
+"""
+Collects the desired changes of a VM configuration and writes them with a single config POST.
+
+The current config is read once (or taken from the lookup scope, see orchestrator.scope); apply() sends only the keys whose value differs (plus the deletions of keys that
+actually exist), guarded by the config digest, and does nothing at all when there is no difference.
+"""
+
+
+def parse_net(value: str) -> dict:
+    """'virtio=52:54:00:AA:BB:CC,bridge=vmbr0' -> {'model': 'virtio', 'macaddr': '52:54:00:AA:BB:CC', 'bridge': 'vmbr0'}"""
+    options = {}
+    for part in value.split(","):
+        key, _, val = part.partition("=")
+        if key in ("virtio", "e1000", "rtl8139", "vmxnet3"):
+            options["model"], options["macaddr"] = key, val
+        else:
+            options[key] = val
+    return options
+
+
+class VMConfigBuilder(object):
+
+    def __init__(self, connector, vmid, node: str):
+        self.connector = connector
+        self.vmid = vmid
+        self.node = node
+        # the scope may already hold it from a precondition decorator, which reads it fresh as well
+        self.current = memoized(('vm_config', connector.cluster_name, node, vmid),
+                                lambda: connector.get_vm_config(vmid, node=node, fresh=True))
+        self.changes = {}
+        self.deletions = set()
+
+    def set(self, key: str, value):
+        self.deletions.discard(key)
+        self.changes[key] = value
+        return self
+
+    def delete(self, key: str):
+        self.changes.pop(key, None)
+        self.deletions.add(key)
+        return self
+
+    def memory(self, maxram: int, minram: int = None):
+        self.set('memory', maxram)
+        if minram is not None:
+            self.set('balloon', minram)
+        return self
+
+    def cores(self, cores: int):
+        return self.set('cores', cores)
+
+    def name(self, name: str):
+        return self.set('name', name)
+
+    def nets(self) -> dict:
+        """netN -> parsed options, as they will be once the pending changes are applied"""
+        merged = dict(self.current)
+        merged.update(self.changes)
+        return {key: parse_net(str(value)) for key, value in merged.items()
+                if key.startswith('net') and key[3:].isdigit() and key not in self.deletions}
+
+    def mac_index(self):
+        from .macs import mac_index_for
+        return mac_index_for(self.connector.cluster_name)
+
+    def add_net(self, bridge: str, mac_address: str = None, model: str = 'virtio'):
+        """Attach a new NIC on bridge, returns (netN, mac address)"""
+        indexes = [int(key[3:]) for key in self.nets()]
+        key = "net{index}".format(index=max(indexes) + 1 if indexes else 0)
+        mac_index = self.mac_index()
+        if mac_address:
+            mac_address = mac_address.upper()
+            mac_index.register(self.vmid, mac_address)
+        else:
+            mac_address = mac_index.allocate(self.vmid)
+        self.set(key, "model={model},bridge={bridge},macaddr={mac_address}".format(model=model, bridge=bridge,
+                                                                                    mac_address=mac_address))
+        return key, mac_address
+
+    def ensure_net(self, bridge: str):
+        """Return the NIC already attached to bridge, or attach a new one"""
+        for key, options in sorted(self.nets().items()):
+            if options.get('bridge') == bridge:
+                return key, options.get('macaddr')
+        return self.add_net(bridge)
+
+    def ipconfig(self, index: int, ip: str = None, cidr: int = None, gateway: str = None):
+        value = "ip=dhcp" if not ip else "ip={ip}/{cidr}".format(ip=ip, cidr=cidr)
+        if ip and gateway:
+            value += ",gw={gateway}".format(gateway=gateway)
+        return self.set("ipconfig{index}".format(index=index), value)
+
+    def diff(self) -> dict:
+        diff = {key: value for key, value in self.changes.items() if str(self.current.get(key)) != str(value)}
+        deletions = sorted(key for key in self.deletions if key in self.current)
+        if deletions:
+            diff['delete'] = ",".join(deletions)
+        return diff
+
+    def apply(self) -> bool:
+        diff = self.diff()
+        if not diff:
+            return False
+        if self.current.get('digest'):
+            diff['digest'] = self.current['digest']
+        self.connector.nodes(self.node).qemu(self.vmid).config.post(**diff)
+        for key in diff.get('delete', '').split(','):
+            if key.startswith('net') and key[3:].isdigit():
+                mac_address = parse_net(str(self.current[key])).get('macaddr')
+                if mac_address:
+                    self.mac_index().release(self.vmid, mac_address)
+        forget(('vm_config', self.connector.cluster_name, self.node, self.vmid))
+        self.connector._invalidate('vm_config', self.node, self.vmid)
+        if 'name' in diff or 'memory' in diff or 'cores' in diff:
+            self.connector._invalidate('inventory')
+        return True
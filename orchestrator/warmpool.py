@@ -0,0 +1,115 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from .models import WarmPoolMetric, Job
+from .proxmox import ProxmoxConnector, ProxmoxDriverException
+from .inventory import inventory
+from .clusters import fan_out
+import logging
+logger = logging.getLogger("orchestrator")
+
+"""
+Pre-cloned, stopped VMs kept per OS in a holding resource pool (PROXMOX_WARM_POOL_ID).
+
+PROXMOX_WARM_POOL maps VirtualMachine.os to the number of VMs to keep ready. Claiming a VM moves it into the
+activity pool and queues a refill job; the provisioning flow then only applies the name/RAM/CPU/network deltas.
+VMs still locked (a clone in progress) are not ready. Claims prefer a VM on the node chosen by the placement, but
+take one from another node rather than cloning: the VM then stays where it is, trading the placement balance for
+the clone time.
+The worker also queues a refill when it starts and every ORCHESTRATOR_WARM_POOL_REFILL_INTERVAL seconds, so the
+pool gets filled before the first claim and recovers from VMs removed by hand.
+"""
+
+
+def holding_pool() -> str:
+    return getattr(settings, "PROXMOX_WARM_POOL_ID", "WARMPOOL")
+
+
+def warm_name(os: str) -> str:
+    return "warm-{os}".format(os=os.lower())
+
+
+def available_in(snapshot, os: str) -> list:
+    return [vm for vm in snapshot.vms_in_pool(holding_pool())
+            if vm.get('name') == warm_name(os) and vm.get('status') == 'stopped' and not vm.get('template')
+            and not vm.get('lock')]
+
+
+def available(os: str, cluster: str = None) -> list:
+    return available_in(inventory.snapshot(cluster), os)
+
+
+def _metric(os: str):
+    return WarmPoolMetric.objects.get_or_create(os=os)[0]
+
+
+def enqueue_refill():
+    if not getattr(settings, "PROXMOX_WARM_POOL", {}):
+        return
+    if not Job.objects.filter(kind="refill_warm_pool", status__in=(Job.PENDING, Job.RUNNING)).exists():
+        Job.objects.create(kind="refill_warm_pool")
+
+
+def claim(os: str, poolid: str, node: str = None, cluster: str = None):
+    """
+    Move a ready VM of the given OS into poolid, preferring the ones already on node.
+    Returns its vmid or None when the pool is empty.
+    """
+    if not getattr(settings, "PROXMOX_WARM_POOL", {}).get(os):
+        return None
+    connector = ProxmoxConnector(cluster)
+    for vm in sorted(available(os, cluster), key=lambda vm: vm.get('node') != node):
+        vmid = str(vm['vmid'])
+        if not cache.add("warm_pool_claim_{vmid}".format(vmid=vmid), True, 300):
+            continue
+        try:
+            connector.move_vm_to_pool(vmid, holding_pool(), poolid)
+        except ProxmoxDriverException:
+            logger.exception("Could not claim warm VM %s", vmid)
+            continue
+        WarmPoolMetric.objects.filter(pk=_metric(os).pk).update(hits=F("hits") + 1)
+        WarmPoolMetric.objects.filter(os=os, depleted_since__isnull=True).update(depleted_since=timezone.now())
+        enqueue_refill()
+        return vmid
+    WarmPoolMetric.objects.filter(pk=_metric(os).pk).update(misses=F("misses") + 1)
+    enqueue_refill()
+    return None
+
+
+def refill(cluster: str = None, node: str = None):
+    """Clone the missing warm VMs from the node hosting each template, onto node when given"""
+    connector = ProxmoxConnector(cluster)
+    if holding_pool() not in [pool.get('poolid') for pool in connector.get_pools()]:
+        connector.create_resource_pool(poolid=holding_pool(), comment="Warm pool")
+    for os, size in getattr(settings, "PROXMOX_WARM_POOL", {}).items():
+        missing = size - len(available(os, cluster))
+        template = settings.PROXMOX_TEMPLATES[os]
+        template_vm = inventory.snapshot(cluster).get_vm(template) if missing > 0 else None
+        if missing > 0 and template_vm is None:
+            logger.error("Template %s of %s not found on %s, its warm pool is not refilled", template, os, cluster)
+            continue
+        for _ in range(missing):
+            connector.clone_vm(warm_name(os), template, node=template_vm['node'], pool=holding_pool(), target=node)
+        metric = _metric(os)
+        if missing > 0:
+            WarmPoolMetric.objects.filter(pk=metric.pk).update(refills=F("refills") + missing)
+        if metric.depleted_since:
+            WarmPoolMetric.objects.filter(pk=metric.pk).update(
+                depleted_since=None, last_refill_lag=(timezone.now() - metric.depleted_since).total_seconds())
+
+
+def _refill_thread(cluster: str):
+    try:
+        refill(cluster)
+    finally:
+        connection.close()
+
+
+def refill_all(clusters: list = None) -> dict:
+    """Refill the warm pool of every cluster in parallel, returns cluster -> None or the raised exception"""
+    for os in getattr(settings, "PROXMOX_WARM_POOL", {}):
+        # created upfront, the per-cluster threads would race on get_or_create
+        _metric(os)
+    return fan_out(_refill_thread, clusters)
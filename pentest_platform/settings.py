@@ -54,6 +54,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'orchestrator.middleware.LookupScopeMiddleware',
+    'orchestrator.middleware.InteractiveLaneMiddleware',
 ]
 
 ROOT_URLCONF = 'pentest_platform.urls'
@@ -136,6 +138,34 @@ PROXMOX_PWD = secret_data.PROXMOX_PWD
 PROXMOX_VERIFY_SSL = False
 PROXMOX_NODE_NAME = "pve"
 PROXMOX_VM_MIN_RAM = 512
+PROXMOX_TEMPLATES = getattr(secret_data, "PROXMOX_TEMPLATES", {})  # VirtualMachine.os -> template vmid
+PROXMOX_MAX_CLONES_PER_NODE = 2
+PROXMOX_MAX_CLONES_PER_STORAGE = 2
+PROXMOX_MAX_DESTROYS_PER_NODE = 4
+PROXMOX_RATE_LIMIT = 20  # requests per second to each cluster, 0 disables the limit
+PROXMOX_RATE_BURST = 40
+PROXMOX_RATE_INTERACTIVE_RESERVE = 5
+PROXMOX_MAX_HEAVY_CALLS_PER_NODE = 2
+PROXMOX_MAX_LIGHT_CALLS_PER_NODE = 4  # per lane
+PROXMOX_RETRY_ATTEMPTS = 4  # transient failures of idempotent requests
+PROXMOX_LOCK_RETRY_ATTEMPTS = 5
+PROXMOX_BREAKER_THRESHOLD = 5  # consecutive transient failures opening the breaker of a node
+PROXMOX_BREAKER_COOLDOWN = 15
+PROXMOX_EVENT_WATCHER = True  # invalidate caches from /cluster/tasks and /cluster/log, allowing long TTLs
+PROXMOX_EVENT_POLL_INTERVAL = 2
+PROXMOX_PROVISIONING_WORKERS = 8
+PROXMOX_PLACEMENT_STRATEGY = "spread"  # or "binpack"
+PROXMOX_WARM_POOL_ID = "WARMPOOL"
+PROXMOX_WARM_POOL = {}  # VirtualMachine.os -> number of pre-cloned VMs kept ready
+ORCHESTRATOR_WARM_POOL_REFILL_INTERVAL = 600  # seconds between the refills queued by the worker
+PROXMOX_CLOUDINIT_MODE = "iso"  # or "snippets", written to PROXMOX_CLOUDINIT_SNIPPETS_DIR
+PROXMOX_CLOUDINIT_STORAGE = "local"
+PROXMOX_CLOUDINIT_SNIPPETS_DIR = "/var/lib/vz/snippets"  # snippets directory of PROXMOX_CLOUDINIT_STORAGE
+PROXMOX_TESTER_ROLE = "PVEVMUser"  # granted to the testers on the pool of their activities
+PXE_NETWORKS_PAGE_SIZE = 25
+ORCHESTRATOR_JOB_LEASE = 120  # seconds a running job is kept by its worker without a heartbeat
+ORCHESTRATOR_METRICS_ENABLED = True
+ORCHESTRATOR_METRICS_TOKEN = getattr(secret_data, "ORCHESTRATOR_METRICS_TOKEN", None)  # Prometheus bearer token
 
 INTERNAL_IPS = [ "127.0.0.1"]
 SELECT2_CSS = ''
@@ -153,12 +183,16 @@ JET_SIDE_MENU_ITEMS = [
     {
         'label': 'Gestione', 'items': [
             {'name': 'orchestrator.activity', 'materialicon': 'event_available'},
+            {'name': 'orchestrator.job', 'materialicon': 'playlist_play'},
         ]
     },
     {
         'label': 'Piattaforma', 'items': [
             {'name': 'orchestrator.network', 'materialicon':'device_hub'},
             {'name': 'orchestrator.virtualmachine', 'materialicon':'laptop'},
+            {'name': 'orchestrator.warmpoolmetric', 'materialicon':'whatshot'},
+            {'name': 'orchestrator.syncstate', 'materialicon':'sync'},
+            {'label': 'Metriche Proxmox', 'url': '/proxmox-metrics/', 'materialicon':'timeline'},
         ]
     },
     {
@@ -17,7 +17,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf.urls.static import static
 from django.conf import settings
-from orchestrator.views import PxeNetworks
+from orchestrator.views import PxeNetworks, ProxmoxMetrics, ProxmoxMetricsSummary
 
 import debug_toolbar
 
@@ -26,6 +26,8 @@ urlpatterns = [
     path('nested_admin/', include('nested_admin.urls')),
     path('select2/', include('django_select2.urls')),
     path('select2/pxe_networks', PxeNetworks.as_view(), name='pxe_networks'),
+    path('metrics', ProxmoxMetrics.as_view(), name='proxmox_metrics'),
+    path('proxmox-metrics/', ProxmoxMetricsSummary.as_view(), name='proxmox_metrics_summary'),
 
     path('__debug__/', include(debug_toolbar.urls)),
     path('', admin.site.urls),